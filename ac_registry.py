@@ -0,0 +1,91 @@
+"""Manage a fleet of A/C units from one process"""
+
+import concurrent.futures
+
+import get_config
+
+ALL_UNITS = 'ALL'
+
+
+class UnitRegistry(object):
+
+    """
+    One connection per configured A/C unit, addressed by unit name or DUID
+
+    Args:
+    config: ConfigParser object with [interface] and any [unit:name] sections
+    factory: callable taking a config section name and the config, returning
+             a connected AirConInterface (or any object with the same methods)
+    callers: threads that may call the registry at once, e.g. the UDP server's workers
+    """
+
+    def __init__(self, config, factory, callers=1):
+
+        sections = get_config.get_unit_sections(config)
+
+        #Every caller can fan out to every unit at once, so a unit that is
+        #offline holds up no caller for more than one RESPONSE_WAIT_TIME
+        self.workers = concurrent.futures.ThreadPoolExecutor(max_workers=callers * len(sections),
+                                                             thread_name_prefix='unit_worker')
+
+        #Waiting for A/C to confirm settings can take MAX_COMMAND_WAIT_TIME, so it
+        #has workers of its own and never holds up GET ALL or scheduled settings
+        self.waiters = concurrent.futures.ThreadPoolExecutor(max_workers=callers * len(sections),
+                                                             thread_name_prefix='unit_waiter')
+
+        #Connect to all units at once, an unreachable unit starts offline
+        #after STARTUP_WAIT rather than holding up the others
+        self.units = list(self.workers.map(lambda section: factory(section, config), sections))
+
+        self.by_key = {}
+        for unit in self.units:
+            self.by_key[unit.name] = unit
+            self.by_key[unit.ac_duid.upper()] = unit
+
+        self.default = self.units[0]
+
+
+    def get(self, key=None):
+
+        """Unit for a name or DUID, the first configured unit if key is None"""
+
+        if key is None:
+            return self.default
+
+        return self.by_key.get(str(key).upper())
+
+
+    def names(self):
+        return [unit.name for unit in self.units]
+
+
+    def __fan_out(self, executor, method, *args):
+
+        """Call method on every unit in parallel on executor, returns dict of unit name to result"""
+
+        futures = {unit.name: executor.submit(getattr(unit, method), *args)
+                   for unit in self.units}
+
+        return {name: future.result() for name, future in futures.items()}
+
+
+    def get_all_settings(self):
+        """Status of every unit, queried in parallel"""
+        return self.__fan_out(self.workers, 'get_all_settings')
+
+
+    def apply_settings(self, settings):
+        """Apply the same settings to every unit, True if all accepted them"""
+        return all(self.__fan_out(self.workers, 'apply_settings', settings).values())
+
+
+    def apply_settings_and_wait(self, settings, timeout):
+        """Apply the same settings to every unit and wait for each to confirm them"""
+        return self.__fan_out(self.waiters, 'apply_settings_and_wait', settings, timeout)
+
+
+    def shutdown(self):
+        for unit in self.units:
+            unit.shutdown()
+        self.workers.shutdown(wait=False)
+        self.waiters.shutdown(wait=False)
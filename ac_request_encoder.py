@@ -0,0 +1,134 @@
+"""Encode requests to A/C WIFI module from precompiled byte templates"""
+
+import functools
+import itertools
+import threading
+import time
+from xml.sax.saxutils import escape
+
+XML_HEADER = b'<?xml version="1.0" encoding="utf-8" ?>'
+LINE_END = b'\r\n'
+
+AUTH_TEMPLATE = XML_HEADER + b'<Request Type="AuthToken"><User Token="%s" /></Request>' + LINE_END
+STATE_TEMPLATE = XML_HEADER + b'<Request Type="DeviceState" DUID="%s" />' + LINE_END
+CONTROL_TEMPLATE = (XML_HEADER + b'<Request Type="DeviceControl">'
+                    b'<Control CommandID="%s" DUID="%s">%s</Control></Request>' + LINE_END)
+ATTR_TEMPLATE = b'<Attr ID="%s" Value="%s" />'
+
+COMMAND_ID_FORMAT = 'cmd%05d'
+PENDING_COMMAND_TIMEOUT = 60 #seconds, unacknowledged commands are forgotten after this
+
+
+def _attribute(value):
+    """Escape a value for use inside a double quoted XML attribute"""
+    return escape(str(value), {'"': '&quot;'}).encode()
+
+
+@functools.lru_cache(maxsize=256)
+def _attr_element(function, value):
+    """<Attr> element for one setting, cached as settings come from a small fixed set"""
+    return ATTR_TEMPLATE % (_attribute(function), _attribute(value))
+
+
+class ControlCommand(object):
+
+    """A DeviceControl request and the data needed to match its acknowledgement"""
+
+    __slots__ = ('command_id', 'attributes', 'payload', 'created', 'sent')
+
+    def __init__(self, command_id, attributes, payload):
+        self.command_id = command_id
+        self.attributes = attributes #Tuple of (function, value) pairs
+        self.payload = payload
+        self.created = time.time()
+        self.sent = None #Set by ACCommunications when written to A/C
+
+
+class RequestEncoder(object):
+
+    """
+    Build requests for one A/C unit as bytes ready to send on the SSL connection
+
+    DeviceControl requests get a unique CommandID and are kept in a
+    pending table until acknowledged by the A/C
+    """
+
+    def __init__(self, duid, token):
+
+        self.duid = _attribute(duid)
+
+        #Requests that never change for this unit are built once
+        self.auth_request = AUTH_TEMPLATE % _attribute(token)
+        self.state_request = STATE_TEMPLATE % self.duid
+
+        self.command_ids = itertools.count(1)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+
+    def auth_token(self):
+        """Request to authenticate with A/C"""
+        return self.auth_request
+
+
+    def device_state(self):
+        """Request for current status of A/C"""
+        return self.state_request
+
+
+    def device_control(self, attributes):
+
+        """
+        Request to update one or more settings on A/C
+
+        Args:
+        Iterable of (function, value) pairs
+
+        Returns:
+        ControlCommand, registered as pending
+        """
+
+        attributes = tuple(attributes)
+        command_id = COMMAND_ID_FORMAT % next(self.command_ids)
+
+        payload = CONTROL_TEMPLATE % (command_id.encode(), self.duid,
+                                      b''.join(_attr_element(f, v) for f, v in attributes))
+
+        command = ControlCommand(command_id, attributes, payload)
+
+        with self.pending_lock:
+            self.__expire_pending(command.created)
+            self.pending[command_id] = command
+
+        return command
+
+
+    def __expire_pending(self, now):
+        """Forget commands the A/C never acknowledged, caller holds pending_lock"""
+        for command_id in [c for c, cmd in self.pending.items()
+                           if now - cmd.created > PENDING_COMMAND_TIMEOUT]:
+            del self.pending[command_id]
+
+
+    def discard(self, command_id):
+        """Forget a pending command that will not be sent"""
+        with self.pending_lock:
+            self.pending.pop(command_id, None)
+
+
+    def acknowledge(self, command_id):
+
+        """
+        Match an acknowledgement from A/C to a pending command
+
+        Returns:
+        (ControlCommand, latency in seconds) or None if command is not pending
+        """
+
+        with self.pending_lock:
+            command = self.pending.pop(command_id, None)
+
+        if command is None:
+            return None
+
+        return command, time.time() - (command.sent or command.created)
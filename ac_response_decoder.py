@@ -0,0 +1,71 @@
+"""Event driven decoder for XML responses from A/C WIFI module"""
+
+from xml.parsers import expat
+
+RESPONSE_TYPE = 'Type'
+RESPONSE_ID = 'ID'
+RESPONSE_VALUE = 'Value'
+RESPONSE_STATUS = 'Status'
+RESPONSE_TYPE_AUTH = 'AuthToken'
+RESPONSE_COMMAND_ID = 'CommandID'
+
+
+class ResponseDecoder(object):
+
+    """
+    Decode A/C responses to (type, id, value) tuples without building a tree
+
+    Elements are handled as expat reports them, only elements with an
+    ID in valid_ids are kept. A CommandID on the root element is
+    returned with RESPONSE_COMMAND_ID as its id
+    """
+
+    def __init__(self, valid_ids):
+        self.valid_ids = frozenset(valid_ids)
+
+
+    def decode(self, xml_string):
+
+        """
+        Decode one XML document
+
+        Args:
+        XML document as str or bytes
+
+        Returns:
+        List of (type, id, value) tuples, or None if the document could not be parsed
+        """
+
+        parser = expat.ParserCreate()
+        valid_ids = self.valid_ids
+        root = []
+        attributes = []
+
+        def start_element(name, attrs):
+
+            if not root:
+                #Root element carries the response type
+                root.append(attrs[RESPONSE_TYPE])
+
+                if root[0] == RESPONSE_TYPE_AUTH:
+                    attributes.append((RESPONSE_TYPE_AUTH, RESPONSE_TYPE_AUTH, attrs[RESPONSE_STATUS]))
+
+                #Acknowledgement of a DeviceControl request
+                if RESPONSE_COMMAND_ID in attrs:
+                    attributes.append((root[0], RESPONSE_COMMAND_ID, attrs[RESPONSE_COMMAND_ID]))
+
+                return
+
+            ident = attrs.get(RESPONSE_ID)
+
+            if ident in valid_ids:
+                attributes.append((root[0], ident, attrs.get(RESPONSE_VALUE)))
+
+        parser.StartElementHandler = start_element
+
+        try:
+            parser.Parse(xml_string, True)
+        except (expat.ExpatError, KeyError):
+            return None
+
+        return attributes
@@ -0,0 +1,518 @@
+#!/usr/bin/python3
+
+"""
+Simulate A/C WIFI modules over TLS for testing without the physical unit
+
+Implements the AuthToken, DeviceState and DeviceControl requests made by
+ACCommunications and AsyncAirConInterface, for any number of DUIDs on one
+port. Response latency, payload size, fragmentation and dropped
+connections can be configured, all random choices come from a seeded
+generator so a run can be repeated
+
+Usage: python3 ac_simulator.py --port 2878 --units 4 --latency 0.05 --drop-rate 0.01
+"""
+
+import sys
+import os
+import ssl
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, THIS_DIR)
+
+import get_config
+import xml_framer
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 2878
+FIRST_DUID = 0x7825AD109303 #Generated DUIDs count up from here
+CERT_DAYS = 3650
+
+XML_HEADER = b'<?xml version="1.0" encoding="utf-8" ?>'
+LINE_END = b'\r\n'
+
+#Sent by the module as soon as a connection is made
+GREETING = XML_HEADER + b'<Update Type="InvalidateAccount"/>' + LINE_END
+
+AUTH_OKAY = XML_HEADER + b'<Response Type="AuthToken" Status="Okay" StartFrom="2017-01-01/00:00:00"/>' + LINE_END
+AUTH_FAIL = XML_HEADER + b'<Response Type="AuthToken" Status="Fail" ErrorCode="301"/>' + LINE_END
+
+STATE_TEMPLATE = (XML_HEADER + b'<Response Type="DeviceState" Status="Okay"><DeviceState>'
+                  b'<Device DUID=%s GroupID="AC" ModelID="AC">%s</Device></DeviceState></Response>' + LINE_END)
+STATE_FAIL_TEMPLATE = XML_HEADER + b'<Response Type="DeviceState" Status="Fail" ErrorCode="103" DUID=%s/>' + LINE_END
+CONTROL_TEMPLATE = (XML_HEADER + b'<Response Type="DeviceControl" Status="%s" DUID=%s CommandID=%s/>'
+                    + LINE_END)
+UPDATE_TEMPLATE = (XML_HEADER + b'<Update Type="Status"><Status DUID=%s GroupID="AC" ModelID="AC">'
+                   b'%s</Status></Update>' + LINE_END)
+STATE_ATTR_TEMPLATE = b'<Attr ID=%s Type="RW" Value=%s/>'
+UPDATE_ATTR_TEMPLATE = b'<Attr ID=%s Value=%s />'
+FILLER_ATTR_TEMPLATE = b'<Attr ID="AC_SG_VENDER%02d" Type="W" Value="0"/>'
+
+#Status of a unit as reported by a real module, AC_FUN_TEMPNOW is randomised per unit
+INITIAL_STATE = (('AC_FUN_ENABLE', 'Enable'),
+                 ('AC_FUN_POWER', 'Off'),
+                 ('AC_FUN_SUPPORTED', '0'),
+                 ('AC_FUN_OPMODE', 'Cool'),
+                 ('AC_FUN_TEMPSET', '24'),
+                 ('AC_FUN_COMODE', 'Off'),
+                 ('AC_FUN_ERROR', '00000000'),
+                 ('AC_FUN_TEMPNOW', '24'),
+                 ('AC_FUN_SLEEP', '0'),
+                 ('AC_FUN_WINDLEVEL', 'Auto'),
+                 ('AC_FUN_DIRECTION', 'Fixed'),
+                 ('AC_ADD_AUTOCLEAN', 'Off'),
+                 ('AC_SG_WIFI', 'Connected'),
+                 ('AC_SG_INTERNET', 'Connected'))
+
+TEMP_NOW = 'AC_FUN_TEMPNOW'
+TEMP_RANGE = (18, 30)
+
+
+def _quote(value):
+    """Quoted XML attribute value as bytes"""
+    return quoteattr(str(value)).encode()
+
+
+def generate_duids(count, first=FIRST_DUID):
+    """count DUIDs in the module's 12 hex digit format"""
+    return ['%012X' % (first + i) for i in range(count)]
+
+
+def create_ssl_context(certfile=None, keyfile=None):
+
+    """
+    Server TLS context offering the module's legacy protocol and cipher
+
+    A self signed certificate is generated if none is given
+    """
+
+    if certfile is None:
+        certfile, keyfile = make_self_signed_cert()
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+
+    try:
+        context.minimum_version = ssl.TLSVersion.TLSv1
+        context.set_ciphers('DEFAULT:AES256-SHA:@SECLEVEL=0')
+    except (ValueError, ssl.SSLError):
+        #Local OpenSSL build does not offer the module's cipher, use its defaults
+        pass
+
+    return context
+
+
+def make_self_signed_cert(directory=None):
+
+    """Write a throwaway certificate and key, returns (certfile, keyfile)"""
+
+    from OpenSSL import crypto
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+
+    cert = crypto.X509()
+    cert.get_subject().CN = 'ac-simulator'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(CERT_DAYS * 24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+
+    directory = directory or tempfile.mkdtemp(prefix='ac_simulator_')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+
+    with open(certfile, 'wb') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    with open(keyfile, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+    return certfile, keyfile
+
+
+
+class SimulatedUnit(object):
+
+    """Settings of one simulated A/C unit"""
+
+    def __init__(self, duid, rng):
+
+        self.duid = duid
+        self.quoted_duid = _quote(duid)
+        self.state = dict(INITIAL_STATE)
+        self.state[TEMP_NOW] = str(rng.randint(*TEMP_RANGE))
+
+    def device_state(self, payload_size=0):
+
+        """DeviceState response, padded with filler attributes up to payload_size bytes"""
+
+        attrs = b''.join(STATE_ATTR_TEMPLATE % (_quote(k), _quote(v)) for k, v in self.state.items())
+        response = STATE_TEMPLATE % (self.quoted_duid, attrs)
+
+        filler = []
+        size = len(response)
+        while size < payload_size:
+            filler.append(FILLER_ATTR_TEMPLATE % (len(filler) % 100))
+            size += len(filler[-1])
+
+        if filler:
+            response = STATE_TEMPLATE % (self.quoted_duid, attrs + b''.join(filler))
+
+        return response
+
+    def update(self, changes):
+        """Apply changes, returns Status update for those that changed value or None"""
+
+        changed = [(k, v) for k, v in changes if self.state.get(k) != v]
+
+        for key, value in changed:
+            self.state[key] = value
+
+        if not changed:
+            return None
+
+        return UPDATE_TEMPLATE % (self.quoted_duid,
+                                  b''.join(UPDATE_ATTR_TEMPLATE % (_quote(k), _quote(v))
+                                           for k, v in changed))
+
+
+
+class ACSimulator(object):
+
+    """
+    TLS server answering as one or more A/C WIFI modules
+
+    Args:
+    duids: DUIDs to simulate, requests for any other DUID fail
+    token: user token to accept, any token is accepted if None
+    latency: seconds before each response is sent
+    jitter: up to this many seconds added to latency at random
+    payload_size: minimum DeviceState response size in bytes
+    fragment_size: send responses in random sized pieces of at most this many bytes, 0 sends whole
+    fragment_delay: seconds between pieces of a fragmented response
+    drop_rate: chance of closing the connection without TLS shutdown instead of responding
+    update_interval: seconds between unsolicited AC_FUN_TEMPNOW updates, 0 disables
+    seed: seed for every random choice
+    """
+
+    def __init__(self, duids, token=None, latency=0, jitter=0, payload_size=0,
+                 fragment_size=0, fragment_delay=0, drop_rate=0, update_interval=0,
+                 seed=0, certfile=None, keyfile=None):
+
+        self.rng = random.Random(seed)
+        self.units = {duid.upper(): SimulatedUnit(duid, self.rng) for duid in duids}
+        self.token = token
+
+        self.latency = latency
+        self.jitter = jitter
+        self.payload_size = payload_size
+        self.fragment_size = fragment_size
+        self.fragment_delay = fragment_delay
+        self.drop_rate = drop_rate
+        self.update_interval = update_interval
+
+        self.ssl_context = create_ssl_context(certfile, keyfile)
+
+        self.server = None
+        self.loop = None
+        self.stats = dict.fromkeys(('connections', 'requests', 'responses', 'updates',
+                                    'drops', 'bytes_sent', 'bytes_received'), 0)
+
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+
+        """Start listening, returns the port in use (useful with port 0)"""
+
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.__serve, host, port, ssl=self.ssl_context)
+
+        return self.server.sockets[0].getsockname()[1]
+
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+    def serve_in_thread(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+
+        """Run on a background event loop, returns the port in use"""
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(name='ac_simulator', target=loop.run_forever, daemon=True).start()
+
+        return asyncio.run_coroutine_threadsafe(self.start(host, port), loop).result()
+
+
+    def stop(self):
+        """Stop a simulator started with serve_in_thread"""
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+    async def __serve(self, reader, writer):
+
+        """Handle one client connection"""
+
+        #Each connection draws from its own generator so concurrent clients do not disturb each other
+        self.stats['connections'] += 1
+        rng = random.Random(self.rng.random())
+
+        connection = _Connection(self, writer, rng)
+        framer = xml_framer.XMLFramer()
+        updater = None
+
+        try:
+
+            await connection.send(GREETING)
+
+            if self.update_interval:
+                updater = asyncio.ensure_future(connection.send_updates())
+
+            while not connection.closed:
+
+                data = await reader.read(4096)
+                if not data:
+                    break
+
+                self.stats['bytes_received'] += len(data)
+
+                for document in framer.feed(data):
+                    await connection.handle(document)
+
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+        finally:
+            if updater:
+                updater.cancel()
+            connection.close()
+
+
+
+class _Connection(object):
+
+    """State of one client connection to ACSimulator"""
+
+    def __init__(self, simulator, writer, rng):
+        self.simulator = simulator
+        self.writer = writer
+        self.rng = rng
+        self.authenticated = False
+        self.duids = set() #Units this client has asked about, sent unsolicited updates
+        self.closed = False
+
+
+    async def handle(self, document):
+
+        """Respond to one request"""
+
+        sim = self.simulator
+        sim.stats['requests'] += 1
+
+        try:
+            root = ET.fromstring(document)
+        except ET.ParseError:
+            return
+
+        request = root.get('Type')
+
+        if request == 'AuthToken':
+            user = root.find('User')
+            token = user.get('Token') if user is not None else None
+            self.authenticated = sim.token is None or token == sim.token
+            await self.respond(AUTH_OKAY if self.authenticated else AUTH_FAIL)
+            return
+
+        if not self.authenticated:
+            return
+
+        if request == 'DeviceState':
+
+            duid = root.get('DUID', '')
+            unit = sim.units.get(duid.upper())
+
+            if unit is None:
+                await self.respond(STATE_FAIL_TEMPLATE % _quote(duid))
+            else:
+                self.duids.add(unit.duid)
+                await self.respond(unit.device_state(sim.payload_size))
+
+        elif request == 'DeviceControl':
+
+            control = root.find('Control')
+            if control is None:
+                return
+
+            duid = control.get('DUID', '')
+            command_id = control.get('CommandID', '')
+            unit = sim.units.get(duid.upper())
+
+            if unit is None:
+                await self.respond(CONTROL_TEMPLATE % (b'Fail', _quote(duid), _quote(command_id)))
+                return
+
+            self.duids.add(unit.duid)
+            update = unit.update([(attr.get('ID'), attr.get('Value')) for attr in control.iter('Attr')])
+
+            await self.respond(CONTROL_TEMPLATE % (b'Okay', unit.quoted_duid, _quote(command_id)))
+
+            #Module follows a change with a Status update
+            if update is not None:
+                await self.send(update)
+
+
+    async def respond(self, response):
+
+        """Send a response after the configured latency, or drop the connection"""
+
+        sim = self.simulator
+
+        if sim.drop_rate and self.rng.random() < sim.drop_rate:
+            sim.stats['drops'] += 1
+            self.close(abort=True)
+            return
+
+        delay = sim.latency + (self.rng.uniform(0, sim.jitter) if sim.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        sim.stats['responses'] += 1
+        await self.send(response)
+
+
+    async def send(self, data):
+
+        """Write data, in random sized fragments if configured"""
+
+        if self.closed:
+            return
+
+        sim = self.simulator
+        sim.stats['bytes_sent'] += len(data)
+
+        if not sim.fragment_size:
+            self.writer.write(data)
+            await self.writer.drain()
+            return
+
+        view = memoryview(data)
+
+        while view:
+
+            size = self.rng.randint(1, sim.fragment_size)
+            self.writer.write(view[:size].tobytes())
+            await self.writer.drain()
+            view = view[size:]
+
+            if view and sim.fragment_delay:
+                await asyncio.sleep(sim.fragment_delay)
+
+
+    async def send_updates(self):
+
+        """Report small changes in room temperature on every unit this client uses"""
+
+        sim = self.simulator
+
+        while True:
+
+            await asyncio.sleep(sim.update_interval)
+
+            for duid in list(self.duids):
+
+                unit = sim.units[duid.upper()]
+                temp = int(unit.state[TEMP_NOW]) + self.rng.choice((-1, 1))
+                temp = min(max(temp, TEMP_RANGE[0]), TEMP_RANGE[1])
+
+                update = unit.update([(TEMP_NOW, str(temp))])
+                if update is not None:
+                    sim.stats['updates'] += 1
+                    await self.send(update)
+
+
+    def close(self, abort=False):
+
+        """Close connection, abort skips TLS shutdown so the client sees an unexpected EOF"""
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if abort:
+            self.writer.transport.abort()
+        else:
+            self.writer.close()
+
+
+
+def config_units(config_file_name):
+
+    """(DUIDs, user token) of every unit in the interface config file"""
+
+    config = get_config.get_config(config_file_name)
+
+    units = [get_config.get_unit_config(config, section)
+             for section in get_config.get_unit_sections(config)]
+
+    return [unit['duid'] for unit in units], units[0]['user_token']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Simulate A/C WIFI modules over TLS')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--units', type=int, default=0,
+                        help='simulate this many generated DUIDs instead of those in the config file')
+    parser.add_argument('--duid', action='append', default=[], help='simulate this DUID, may be repeated')
+    parser.add_argument('--any-token', action='store_true', help='accept any user token')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency, seconds')
+    parser.add_argument('--payload-size', type=int, default=0, help='minimum DeviceState size, bytes')
+    parser.add_argument('--fragment-size', type=int, default=0, help='largest piece of a response, bytes')
+    parser.add_argument('--fragment-delay', type=float, default=0, help='seconds between pieces')
+    parser.add_argument('--drop-rate', type=float, default=0, help='chance of dropping the connection per response')
+    parser.add_argument('--update-interval', type=float, default=0, help='seconds between temperature updates')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cert', help='certificate file, a self signed one is generated if not given')
+    parser.add_argument('--key', help='private key file for --cert')
+    args = parser.parse_args()
+
+    duids, token = config_units('aircontroller_config.txt')
+
+    if args.units:
+        duids = generate_duids(args.units)
+    elif args.duid:
+        duids = args.duid
+
+    simulator = ACSimulator(duids, None if args.any_token else token,
+                            latency=args.latency, jitter=args.jitter,
+                            payload_size=args.payload_size,
+                            fragment_size=args.fragment_size, fragment_delay=args.fragment_delay,
+                            drop_rate=args.drop_rate, update_interval=args.update_interval,
+                            seed=args.seed, certfile=args.cert, keyfile=args.key)
+
+    async def run():
+        port = await simulator.start(args.host, args.port)
+        print('Simulating %d A/C units on %s:%d' % (len(duids), args.host, port))
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print(simulator.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Versioned A/C status that can be read without locking"""
+
+import threading
+
+
+class StatusSnapshot(object):
+
+    """
+    Status of one A/C unit at one version, never modified once published
+
+    Values are held in a tuple indexed by a field map shared by every
+    snapshot of the same record
+    """
+
+    __slots__ = ('fields', 'values', 'version')
+
+    def __init__(self, fields, values, version):
+        self.fields = fields
+        self.values = values
+        self.version = version
+
+    def __getitem__(self, key):
+        return self.values[self.fields[key]]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        index = self.fields.get(key)
+        return default if index is None else self.values[index]
+
+    def copy(self):
+        """Status as a new dict"""
+        return dict(zip(self.fields, self.values))
+
+
+class StatusRecord(object):
+
+    """
+    Current status of one A/C unit
+
+    Readers take snapshot() and get a consistent view of every field.
+    Writers build a new snapshot and publish it by swapping a single
+    reference, so a reader never sees half of an update. Observers are
+    told of every published snapshot, in order
+    """
+
+    def __init__(self, initial):
+
+        """
+        Args:
+        dict of every status field and its initial value
+        """
+
+        self.fields = {key: index for index, key in enumerate(initial)}
+        self.current = StatusSnapshot(self.fields, tuple(initial.values()), 0)
+        self.write_lock = threading.Lock() #Serialises writers only
+        self.observers = []
+
+    def snapshot(self):
+        return self.current
+
+    def subscribe(self, observer):
+        """Call observer(previous, published) with every new snapshot, it must not block"""
+        self.observers = self.observers + [observer]
+
+    def unsubscribe(self, observer):
+        self.observers = [o for o in self.observers if o is not observer]
+
+    def __getitem__(self, key):
+        return self.current[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def publish(self, updates):
+
+        """
+        Apply several field updates as one new version
+
+        Args:
+        dict of field to new value, fields not in the record are ignored
+
+        Returns:
+        Published StatusSnapshot
+        """
+
+        with self.write_lock:
+
+            values = list(self.current.values)
+
+            for key, value in updates.items():
+                index = self.fields.get(key)
+                if index is not None:
+                    values[index] = value
+
+            previous = self.current
+            snapshot = StatusSnapshot(self.fields, tuple(values), previous.version + 1)
+            self.current = snapshot
+
+            #Inside the lock so observers see versions in order
+            for observer in self.observers:
+                observer(previous, snapshot)
+
+        return snapshot
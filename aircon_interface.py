@@ -3,11 +3,12 @@
 import sys
 import os
 import socket
+import errno
 import OpenSSL
 import select
 import struct
-import xml.etree.ElementTree as ET
 import time
+import random
 from time import sleep
 import threading
 
@@ -17,16 +18,64 @@ sys.path.insert(0, THIS_DIR)
 import get_config
 import log_handler
 import pollable_queue
+import poll_scheduler
+import ac_request_encoder
+import ac_response_decoder
+import ac_status
+import command_tracker
+import metrics
+import status_history
+import xml_framer
 
 
 #Global Constants
 CONFIG_FILE_NAME = 'aircontroller_config.txt'
 
-MAX_TRIES = 50
+MAX_TRIES = 50 #Failed connection attempts before logging a critical error
 XML_HEADER = """<?xml version="1.0" encoding="utf-8" ?>"""
 SHUTDOWN_CMD = 'DIE'
-STATUS_POLL_FREQ = 60 #seconds
+RESET_CMD = 'RESET'
+STATUS_POLL_FREQ = 60 #seconds, polls back off from this while a unit is idle
+MAX_POLL_INTERVAL = 300 #seconds
 RESPONSE_WAIT_TIME = 5 #seconds
+COMMAND_WAIT_TIME = 5 #seconds to wait for A/C to confirm settings, by default
+MAX_COMMAND_WAIT_TIME = 30 #seconds
+RECEIVE_BUFFER_SIZE = 4096 #bytes
+
+#Connection to A/C
+CONNECT_TIMEOUT = 10 #seconds to connect and complete the SSL handshake
+AUTH_TIMEOUT = 10 #seconds to wait for AuthToken response
+STARTUP_WAIT = CONNECT_TIMEOUT + AUTH_TIMEOUT #seconds to wait for A/C at startup before carrying on offline
+RECONNECT_DELAY = 1 #seconds, doubled after each failed attempt
+MAX_RECONNECT_DELAY = 300 #seconds
+MAX_HELD_REQUESTS = 100 #Requests kept while link is down
+
+STATE_CONNECTING = 'CONNECTING'
+STATE_AUTHENTICATING = 'AUTHENTICATING'
+STATE_READY = 'READY'
+STATE_BACKOFF = 'BACKOFF'
+
+#What to do with requests while link is down
+OFFLINE_DROP = 'drop' #Discard them
+OFFLINE_COALESCE = 'coalesce' #Hold them until authenticated, latest value of each setting wins
+OFFLINE_REJECT = 'reject' #Refuse new control requests
+
+#Keepalive
+KEEPALIVE_IDLE = STATUS_POLL_FREQ #seconds without traffic, polls included, before probing A/C, 0 disables
+PROBE_TIMEOUT = 10 #seconds to wait for a response before reconnecting
+MAX_SESSION_AGE = 0 #seconds before reconnecting at a quiet moment, 0 disables
+TCP_KEEPALIVE_IDLE = 60 #seconds, 0 disables TCP keepalive
+TCP_KEEPALIVE_INTERVAL = 10 #seconds
+TCP_KEEPALIVE_COUNT = 3
+RTT_SMOOTHING = 0.125 #Weight of each new round trip time sample
+
+#Errors from a link the module has dropped, e.g. SysCallError(-1, 'Unexpected EOF')
+LINK_ERRORS = (OpenSSL.SSL.SysCallError, OpenSSL.SSL.ZeroReturnError, OSError)
+MAX_RESUME_FAILURES = 3 #Failed handshakes offering a session before only full handshakes are used
+#The module's only cipher, OpenSSL 3 refuses it and TLS 1.0 below security level 0
+AC_CIPHERS = 'AES256-SHA:@SECLEVEL=0'
+STATUS_TTL = 5 #seconds, cached status younger than this is returned as-is
+STATUS_MAX_AGE = 60 #seconds, cached status older than this is not served without a refresh
 
 #A/C Properties
 AC_POWER = 'AC_FUN_POWER'
@@ -35,6 +84,8 @@ AC_FAN = 'AC_FUN_WINDLEVEL'
 AC_TEMP = 'AC_FUN_TEMPSET'
 AC_CURRENT_TEMP = 'AC_FUN_TEMPNOW'
 AC_AUTH_TOKEN = 'AuthToken'
+AC_AUTH_OKAY = 'Okay'
+AC_COMMAND_ID = ac_response_decoder.RESPONSE_COMMAND_ID
 
 AC_RESPONSE_TYPE = 'Type'
 AC_RESPONSE_ID = 'ID'
@@ -59,6 +110,7 @@ LAST_UPDATE = 'LAST_UPDATE'
 
 
 AC_CONNECTION_STATUS = 'AC_CONNECTION_STATUS'
+AC_UNCONFIRMED = 'UNCONFIRMED' #Settings sent that A/C has not yet confirmed
 AC_CONN_STATUS_ONLINE = 'ONLINE'
 AC_CONN_STATUS_CACHED = 'CACHED'
 AC_CONN_STATUS_OFFLINE = 'OFFLINE'
@@ -80,58 +132,589 @@ TRANSLATE = {AC_POWER: POWER,
              AC_CURRENT_TEMP: CURRENT_TEMP,
              AC_AUTH_TOKEN: AUTHENTICATION}
 
+#Settings that can be changed, keyed by translated name
+SETTABLE = {POWER: AC_POWER,
+            MODE: AC_MODE,
+            FAN: AC_FAN,
+            TEMP: AC_TEMP}
 
 
-class ACCommunications(object):
 
-    """Maintain reliable communications to A/C WIFI module"""
+def validate_setting(function, val):
+
+    """Sanity check a requested setting, returns value to send or None if invalid"""
+
+    if function == AC_MODE and val == 'FAN': val = 'Wind'
+
+    if function == AC_TEMP:
+        try:
+            val = int(val)
+        except (TypeError, ValueError):
+            return None
+    elif isinstance(val, str):
+        val = val.capitalize()
+
+    if val in VALID_OPERATIONS[function]:
+        return str(val)
+
+    return None
+
+
+def status_value(function, value):
+    """Value as held in status, the A/C calls fan mode Wind"""
+    if function == AC_MODE and value == 'Wind': value = 'Fan'
+    return value
+
+
+def translate_status(status_dict, ttl, max_age, unconfirmed=()):
+
+    """
+    Translate status dictionary key names and classify age of status info
+
+    Args:
+    status_dict: copy of status, translated in place
+    ttl, max_age: status age bounds, seconds
+    unconfirmed: A/C attribute IDs whose value in status A/C has not confirmed
+    """
+
+    for key in TRANSLATE.keys():
+        status_dict[TRANSLATE[key]] = status_dict.pop(key)
+
+    status_dict[AC_UNCONFIRMED] = [TRANSLATE.get(function, function) for function in unconfirmed]
+
+    #Provide feedback on age of status info
+    age = time.time() - status_dict[LAST_UPDATE]
+
+    if age < ttl:
+        status_dict[AC_CONNECTION_STATUS] = AC_CONN_STATUS_ONLINE
+    elif age <= max_age:
+        status_dict[AC_CONNECTION_STATUS] = AC_CONN_STATUS_CACHED
+    else:
+        status_dict[AC_CONNECTION_STATUS] = AC_CONN_STATUS_OFFLINE
+
+    return status_dict
+
+
+
+def translate_settings(attributes):
+    """Settings keyed by A/C attribute ID as POWER/MODE/FAN/TEMP to the value shown in status"""
+    return {TRANSLATE.get(function, function): status_value(function, value)
+            for function, value in attributes.items()}
+
+
+
+def open_history(config):
+
+    """
+    Shared status history store for a unit config, None if history_dir is not set
+
+    Args:
+    dict of unit config options
+    """
+
+    history_dir = config.get('history_dir', '')
+
+    if not history_dir:
+        return None
+
+    return status_history.open_store(os.path.join(THIS_DIR, history_dir),
+                                     int(config.get('history_max_bytes', status_history.MAX_BYTES)))
+
+
+
+
+def link_options(config):
+
+    """
+    ACLink keyword arguments from a unit's config
+
+    Args:
+    dict of unit config options
+    """
+
+    return {'offline_policy': config.get('offline_policy', OFFLINE_COALESCE),
+            'reconnect_delay': float(config.get('reconnect_delay', RECONNECT_DELAY)),
+            'max_reconnect_delay': float(config.get('max_reconnect_delay', MAX_RECONNECT_DELAY)),
+            'keepalive_idle': float(config.get('keepalive_idle', KEEPALIVE_IDLE)),
+            'probe_timeout': float(config.get('probe_timeout', PROBE_TIMEOUT)),
+            'max_session_age': float(config.get('max_session_age', MAX_SESSION_AGE))}
+
+
+
+class ACLink(object):
+
+    """
+    Connection state machine for one A/C, shared by both engines
+
+    The engine owns the socket and reports what happens on it, this
+    decides when to connect, what to do with requests while the link is
+    down and when a quiet link needs probing. States run CONNECTING ->
+    AUTHENTICATING -> READY, or BACKOFF after a failure until the next
+    attempt is due
+
+    Args:
+    open_link: called to start connecting, the engine then calls opened()
+               or open_failed()
+    close_link: called to drop the connection or connection attempt
+    write_link: called with bytes to send, returns False on error
+    encoder: ac_request_encoder.RequestEncoder of the unit
+    log: logger
+    link_lost: called with no arguments when a READY link is lost or
+               replaced, requests sent on it will not be answered
+    link_ready: called with no arguments once the link is READY again
+    """
+
+    def __init__(self, open_link, close_link, write_link, encoder, log,
+                 offline_policy=OFFLINE_COALESCE,
+                 reconnect_delay=RECONNECT_DELAY,
+                 max_reconnect_delay=MAX_RECONNECT_DELAY,
+                 keepalive_idle=KEEPALIVE_IDLE,
+                 probe_timeout=PROBE_TIMEOUT,
+                 max_session_age=MAX_SESSION_AGE,
+                 name=get_config.DEFAULT_UNIT_NAME,
+                 link_lost=None,
+                 link_ready=None):
+
+        self.open_link = open_link
+        self.close_link = close_link
+        self.write_link = write_link
+        self.link_lost = link_lost
+        self.link_ready = link_ready
+        self.encoder = encoder
+        self.logger2 = log
+
+        self.reset_period = max_session_age #Reconnect pre-emptively after this, 0 never
+
+        #Keepalive and round trip time
+        self.keepalive_idle = keepalive_idle
+        self.probe_timeout = probe_timeout
+        self.last_activity = time.time()
+        self.awaiting_since = None #First request sent since last data received
+        self.srtt = None #Smoothed round trip time, seconds
+        self.connected_at = None
+
+        #Timings of the last connection, seconds
+        self.connect_started = None
+        self.handshake_time = None
+        self.session_resumed = False
+        self.auth_time = None
+        self.auth_sent = None
+
+        #Connection state machine
+        self.state = STATE_CONNECTING
+        self.deadline = None #When CONNECTING, AUTHENTICATING or BACKOFF times out
+        self.attempts = 0 #Failed attempts since last READY
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.decoder = ac_response_decoder.ResponseDecoder((AC_AUTH_TOKEN,))
+
+        #Requests waiting for link to be READY
+        self.offline_policy = offline_policy
+        self.held = []
+        self.held_controls = {} #Latest value of each setting, in order first changed
+
+        #Metrics, labelled with the unit name
+        self.metric_connects = metrics.counter('ac_connect_attempts_total',
+                                               'Attempts to connect to A/C', unit=name)
+        self.metric_lost = metrics.counter('ac_connections_lost_total',
+                                           'Connections to A/C that failed or stopped responding', unit=name)
+        self.metric_probes = metrics.counter('ac_keepalive_probes_total',
+                                             'Status requests sent to check an idle link', unit=name)
+        self.metric_bytes_sent = metrics.counter('ac_link_bytes_sent_total',
+                                                 'Bytes written to the SSL connection', unit=name)
+        self.metric_bytes_received = metrics.counter('ac_link_bytes_received_total',
+                                                     'Bytes read from the SSL connection', unit=name)
+        self.metric_rtt = metrics.histogram('ac_module_rtt_seconds',
+                                            'Time from a request to the next response from A/C', unit=name)
+        self.metric_handshake = metrics.histogram('ac_handshake_seconds',
+                                                  'SSL handshake time', unit=name)
+        self.metric_connect_time = metrics.histogram('ac_connect_seconds',
+                                                     'Time from starting to connect to authenticated', unit=name)
+        metrics.gauge('ac_link_ready', 'Whether the link to A/C is authenticated',
+                      unit=name).set_function(lambda: int(self.state == STATE_READY))
+        metrics.gauge('ac_held_requests', 'Requests held while link is down',
+                      unit=name).set_function(lambda: len(self.held) + len(self.held_controls))
+        metrics.gauge('ac_srtt_seconds', 'Smoothed round trip time to A/C',
+                      unit=name).set_function(lambda: self.srtt)
+
+
+    def __set_state(self, state):
+
+        if state == self.state:
+            return
+
+        self.logger2.debug('Connection state %s -> %s', self.state, state)
+        was_ready, self.state = self.state == STATE_READY, state
+
+        if was_ready and self.link_lost is not None:
+            self.link_lost()
+
+
+    def __send(self, data):
+
+        """Write a request to the connection, starting the response timer"""
+
+        self.logger2.debug('Sending some data to A/C')
+
+        if isinstance(data, ac_request_encoder.ControlCommand):
+            data.sent = time.time()
+            data = data.payload
+        elif isinstance(data, str):
+            data = (data + '\r\n').encode()
+
+        if not self.write_link(data):
+            return False
+
+        self.metric_bytes_sent.inc(len(data))
+
+        self.last_activity = time.time()
+        if self.awaiting_since is None:
+            self.awaiting_since = self.last_activity
+
+        return True
+
+
+    def __response_received(self):
+
+        """Note activity on the link and sample round trip time"""
+
+        now = time.time()
+        self.last_activity = now
+
+        if self.awaiting_since is not None:
+            sample = now - self.awaiting_since
+            self.awaiting_since = None
+
+            self.metric_rtt.observe(sample)
+
+            if self.srtt is None:
+                self.srtt = sample
+            else:
+                self.srtt += RTT_SMOOTHING * (sample - self.srtt)
+
+            self.logger2.debug('A/C round trip %.3f seconds, smoothed %.3f', sample, self.srtt)
+
+
+    def start(self):
+        self.__connect()
+
+
+    def __connect(self):
+
+        """Make one attempt to connect, the engine reports back with opened() or open_failed()"""
+
+        self.logger2.info('Attempting to establish connection with A/C...')
+        self.__set_state(STATE_CONNECTING)
+
+        self.awaiting_since = None
+        self.connect_started = time.time()
+        self.deadline = self.connect_started + CONNECT_TIMEOUT
+        self.metric_connects.inc()
+
+        try:
+            self.open_link()
+        except:
+            self.logger2.info('Exception while establishing SSL')
+            self.open_failed('exception while connecting')
+
+
+    def opened(self, handshake_time, resumed=False):
+
+        """Engine has an SSL connection to A/C, authenticate on it"""
+
+        if self.state != STATE_CONNECTING:
+            return
+
+        self.handshake_time = handshake_time
+        self.session_resumed = resumed
+        self.metric_handshake.observe(handshake_time)
+
+        if self.__send(self.encoder.auth_token()):
+            self.logger2.info('A/C connection established, authenticating')
+            self.__set_state(STATE_AUTHENTICATING)
+            self.auth_sent = time.time()
+            self.deadline = self.auth_sent + AUTH_TIMEOUT
+        else:
+            self.__schedule_retry()
+
+
+    def open_failed(self, reason):
+
+        """Engine could not connect to A/C"""
+
+        if self.state != STATE_CONNECTING:
+            return
+
+        self.logger2.info('Unable to connect to A/C: %s', reason)
+        self.__schedule_retry()
+
+
+    def __schedule_retry(self):
+
+        """Disconnect and wait, with capped exponential backoff and jitter, before reconnecting"""
+
+        self.__set_state(STATE_BACKOFF)
+        self.__close()
+
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** min(self.attempts, 16))
+
+        #Spread reconnects over the second half of the delay
+        delay = delay / 2 + random.uniform(0, delay / 2)
+
+        self.attempts += 1
+
+        if self.attempts == MAX_TRIES:
+            self.logger2.critical('Unable to establish SSL connection after %d attempts, still trying', MAX_TRIES)
+
+        self.logger2.info('Connecting to A/C again in %.1f seconds', delay)
+        self.deadline = time.time() + delay
+
+
+    def lost(self, reason):
+        """Connection failed or stopped responding, reconnect after backoff"""
+        self.logger2.warning('%s, reconnecting', reason)
+        self.metric_lost.inc()
+        self.__schedule_retry()
+
+
+    def reset(self, reason):
+
+        """Replace a working connection without waiting, e.g. before A/C drops it"""
+
+        self.logger2.info('%s, reconnecting', reason)
+        self.__close()
+        self.__connect()
+
+
+    def __close(self):
+
+        """Drop the connection, telling A/C first if it is authenticated"""
+
+        if self.state == STATE_READY:
+            self.write_link(b'exit\r\n')
+
+        try:
+            self.close_link()
+        except:
+            self.logger2.info('Exception during disconnect')
+
+
+    def close(self):
+        """Drop the connection at shutdown"""
+        self.__close()
+
 
-    def __create_authentication_request(self):
-        """XML string required to authenticate with A/C server"""
-        return """%s<Request Type="AuthToken"><User Token="%s" /></Request>""" % (XML_HEADER, self.token)
+    def next_deadline(self):
+
+        """Time the next connection timer is due, None if there is none"""
+
+        if self.state != STATE_READY:
+            return self.deadline
+
+        #While waiting for a response only the response timer runs
+        if self.awaiting_since is not None:
+            return self.awaiting_since + self.probe_timeout
+
+        deadlines = []
+
+        #Any poll or other traffic in the window makes the probe unnecessary
+        if self.keepalive_idle:
+            deadlines.append(self.last_activity + self.keepalive_idle)
+        if self.reset_period:
+            deadlines.append(self.connected_at + self.reset_period)
+
+        return min(deadlines) if deadlines else None
+
+
+    def run_timers(self):
+
+        """Act on connection timers that are due"""
+
+        now = time.time()
+
+        if self.state == STATE_BACKOFF and now >= self.deadline:
+            self.__connect()
+
+        elif self.state == STATE_CONNECTING and now >= self.deadline:
+            self.open_failed('No connection in %d seconds' % CONNECT_TIMEOUT)
+
+        elif self.state == STATE_AUTHENTICATING and now >= self.deadline:
+            self.lost('No authentication response from A/C')
+
+        elif self.state != STATE_READY:
+            return
+
+        elif self.awaiting_since is not None:
+            if now >= self.awaiting_since + self.probe_timeout:
+                self.lost('No response from A/C in %d seconds' % self.probe_timeout)
+
+        elif self.reset_period and now >= self.connected_at + self.reset_period:
+            self.reset('SSL session is %d seconds old' % (now - self.connected_at))
+
+        elif self.keepalive_idle and now >= self.last_activity + self.keepalive_idle:
+            self.logger2.debug('Connection idle, probing A/C')
+            self.metric_probes.inc()
+            if not self.__send(self.encoder.device_state()):
+                self.lost('Error probing A/C')
+
+
+    def received(self, nbytes, documents):
+
+        """
+        Note data from A/C, while AUTHENTICATING look for the AuthToken response
+
+        Args:
+        nbytes: bytes read from the connection
+        documents: complete XML documents they finished, as str
+        """
+
+        self.metric_bytes_received.inc(nbytes)
+
+        if documents:
+            self.__response_received()
+
+        for document in documents:
+            if self.state == STATE_AUTHENTICATING:
+                self.__check_authentication(document)
+
+
+    def __check_authentication(self, document):
+
+        """Look for the AuthToken response, moving to READY"""
+
+        for _, function, value in self.decoder.decode(document) or ():
+
+            if function != AC_AUTH_TOKEN:
+                continue
+
+            if value == AC_AUTH_OKAY:
+                self.connected_at = time.time()
+                self.auth_time = self.connected_at - self.auth_sent
+                self.metric_connect_time.observe(self.connected_at - self.connect_started)
+                self.logger2.info('Authenticated with A/C in %.3f seconds '
+                                  '(handshake %.3f %s, auth %.3f)',
+                                  self.connected_at - self.connect_started, self.handshake_time,
+                                  'resumed' if self.session_resumed else 'full', self.auth_time)
+                self.__set_state(STATE_READY)
+                self.attempts = 0
+                self.__flush_held()
+                if self.link_ready is not None:
+                    self.link_ready()
+            else:
+                self.lost('Authentication refused: %s' % value)
+
+            return
+
+
+    def __hold(self, data):
+
+        """Apply offline policy to a request that cannot be sent now"""
+
+        if self.offline_policy != OFFLINE_COALESCE:
+            self.logger2.debug('Link down, dropping request')
+            return
+
+        if isinstance(data, ac_request_encoder.ControlCommand):
+
+            #Later values replace earlier ones, the superseded command is never sent
+            self.encoder.discard(data.command_id)
+
+            for function, value in data.attributes:
+                self.held_controls[function] = value
+
+            return
+
+        #The same request twice is only worth sending once
+        if data in self.held:
+            return
+
+        if len(self.held) >= MAX_HELD_REQUESTS:
+            self.logger2.warning('Too many requests held while link is down, dropping oldest')
+            del self.held[0]
+
+        self.held.append(data)
+
+
+    def __flush_held(self):
+
+        """Send requests held while link was down, all held settings in one request"""
+
+        held, self.held = self.held, []
+        held_controls, self.held_controls = self.held_controls, {}
+
+        if held_controls:
+            self.logger2.info('Sending %d settings held while link was down', len(held_controls))
+            self.transmit(self.encoder.device_control(held_controls.items()))
+
+        if held:
+            self.logger2.info('Sending %d requests held while link was down', len(held))
+
+        for data in held:
+            self.transmit(data)
+
+
+    def transmit(self, data):
+
+        """Send a request if link is READY, otherwise apply offline policy"""
+
+        if self.state != STATE_READY:
+            self.__hold(data)
+        elif self.__send(data):
+            self.logger2.debug('Data sent successfully')
+        else:
+            #Held rather than lost, it goes out again once reconnected
+            self.__hold(data)
+            self.lost('Error sending data to A/C')
+
+
+    def accepting(self):
+        """False if new control requests should be refused, see OFFLINE_REJECT"""
+        return self.state == STATE_READY or self.offline_policy != OFFLINE_REJECT
+
+
+
+class ACCommunications(object):
+
+    """Maintain reliable communications to A/C WIFI module, from a thread of its own"""
 
-    
     def __disconnect(self):
-    
+
         """Disconnect SSL connection"""
-        
+
         self.logger2.info('Disconnecting SSL session')
-        
+
+        if self.connecting:
+            self.__abandon_connect()
+
         if not self.ssl_con:
             return True
-        
-        try:
-            self.__send_data('exit')
-            sleep(1)
-        except:
-            pass
-        
+
         try:
             self.ssl_con.shutdown()
             self.ssl_con.close()
         except:
             pass
-            
-        self.ssl_con = None   
-         
-        if self.ssl_con:
-            self.logger2.warning('Disconnect SSL failed')
-            return False
-            
+
+        self.ssl_con = None
+
         self.logger2.debug('Disconnected SSL session')
 
         return True
-        
-    
+
+
     def __send_data(self, data):
 
         """Send data on SSL connection"""
 
-        self.logger2.debug('Sending some data to A/C')
+        if not self.ssl_con:
+            return False
 
         try:
-            data = self.ssl_con.send((data + '\r\n').encode())
+            self.ssl_con.sendall(data)
             return True
+        except LINK_ERRORS as e:
+            #Expected when the module drops the link, no traceback needed
+            self.logger2.warning('Error sending data on socket: %r', e)
         except:
             self.logger2.exception('Exception sending data on socket')
 
@@ -140,15 +723,41 @@ class ACCommunications(object):
 
     def __receive_data(self):
 
-        """Receive data on SSL connection"""
+        """
+        Receive data on SSL connection, draining any bytes already
+        decrypted by OpenSSL. Returns a list of complete XML documents,
+        empty if only part of a document has arrived, or None on error
+        """
 
         self.logger2.debug('Receiving some data from A/C')
 
+        documents = []
+        received = 0
+
         try:
-            #self.logger2.debug('Number of bytes in receive buffer: %s', self.ssl_con.pending())
-            data = self.ssl_con.recv(1024)
-            data = data.decode()
-            return data.strip('\r''\n')
+
+            while True:
+
+                nbytes = self.ssl_con.recv_into(self.receive_buffer)
+
+                if not nbytes:
+                    self.logger2.warning('A/C closed the connection')
+                    return None
+
+                received += nbytes
+
+                documents.extend(self.framer.feed(self.receive_view[:nbytes]))
+
+                if not self.ssl_con.pending():
+                    break
+
+            documents = [doc.decode() for doc in documents]
+            self.link.received(received, documents)
+
+            return documents
+
+        except LINK_ERRORS as e:
+            self.logger2.warning('Error receiving data on socket: %r', e)
         except:
             self.logger2.exception('Exception receiving data on socket')
 
@@ -157,158 +766,264 @@ class ACCommunications(object):
 
     def __get_ssl_connection(self):
 
-        """Get SSL connection to A/C unit"""
-        
+        """
+        Start a non-blocking connection to A/C unit, the select loop
+        carries on with it in __continue_connect
+        """
+
         self.ssl_con = None
-        
+
         self.logger2.debug('Connecting to %s...', self.server_address)
 
-        # Prefer TLS
-        context = OpenSSL.SSL.Context(OpenSSL.SSL.TLSv1_METHOD)
-        context.set_cipher_list('AES256-SHA')
-        
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #sock.settimeout(5)
-        connection = OpenSSL.SSL.Connection(context, sock)
-        
-        try:
-            connection.connect(self.server_address)
-        except Exception as e:
-            self.logger2.exception('Unable to connect to A/C: %s %s', e.message, e.args)
-            self.ssl_con = None
-            del sock
-            del connection
-            return False
+        sock.setblocking(False)
+        self.__set_tcp_keepalive(sock)
 
-        # Put the socket in blocking mode
+        error = sock.connect_ex(self.server_address)
+
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.link.open_failed(os.strerror(error))
+            return
+
+        connection = OpenSSL.SSL.Connection(self.ssl_context, sock)
+        connection.set_connect_state()
+
+        #Offer the last session so the module can skip the full handshake
+        self.offered = self.tls_session is not None and self.resume_sessions
+        if self.offered:
+            connection.set_session(self.tls_session)
+
+        self.connecting = connection
+        self.handshake_started = None
+        self.want_read = False
+
+
+    def __continue_connect(self):
+
+        """Take the connection in progress one step further, once select says it can"""
+
+        connection = self.connecting
+
+        if self.handshake_started is None:
+
+            error = connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if error:
+                self.__abandon_connect()
+                self.link.open_failed(os.strerror(error))
+                return
+
+            self.logger2.debug('Connected to %s', self.server_address)
+            self.handshake_started = time.time()
+
+        try:
+            connection.do_handshake()
+        except OpenSSL.SSL.WantReadError:
+            self.want_read = True
+            return
+        except OpenSSL.SSL.WantWriteError:
+            self.want_read = False
+            return
+        except OpenSSL.SSL.Error as e:
+            reason = 'handshake failed in %s: %r' % (connection.get_state_string().decode(errors='replace'), e)
+            self.__abandon_connect()
+            self.link.open_failed(reason)
+            return
+
+        handshake_time = time.time() - self.handshake_started
+
+        #Reads wait in select, a blocking socket keeps sendall simple
         connection.setblocking(1)
 
         # Set the timeout using the setsockopt
         connection.setsockopt(socket.SOL_SOCKET,
                               socket.SO_RCVTIMEO,
-                              struct.pack('ii', int(6), int(0)))
+                              struct.pack('ll', int(6), int(0)))
+
+        self.__record_session(connection, self.offered, handshake_time)
+
+        self.connecting = None
+        self.ssl_con = connection
+        self.framer.reset()
 
-        self.logger2.debug('Connected to %s', connection.getpeername())
+        self.link.opened(handshake_time, self.session_resumed)
+
+
+    def __step_connect(self):
+
+        """Continue the connection in progress, any failure is a failed attempt rather than the end of this thread"""
 
         try:
-            connection.do_handshake()
-        #except OpenSSL.SSL.WantReadError:
+            self.__continue_connect()
         except Exception as e:
-            self.logger2.exception('Handshake failed %', connection.state_string())
-            connection.close()
-            self.ssl_con = None
-            del sock
-            del connection
-            return False
+            self.logger2.exception('Exception while connecting')
+            if self.connecting is not None:
+                self.__abandon_connect()
+            self.link.open_failed('%r' % e)
 
-        #self.logger2.debug('State %s', connection.state_string())
-        self.ssl_con = connection
-        self.tx_queue.put(self.__create_authentication_request())
 
-        return True
+    def __abandon_connect(self):
 
-       
-        
-    def __establish_ssl_connection(self):
+        """Drop the connection in progress"""
+
+        if self.handshake_started is not None and self.offered:
+            #Next attempt is a full handshake, in case the module choked on the session
+            self.tls_session = None
+            self.resume_failures += 1
 
-        """Loop until SSL connection established, increase wait time on each loop"""
-        
-        self.logger2.info('Attempting to establish connection with A/C...')
-        
         try:
-            if self.ssl_con: self.__disconnect()
+            self.connecting.close()
         except:
-            self.logger2.info('Exception during disconnect')
+            pass
+
+        self.connecting = None
+
+
+    def __create_ssl_context(self):
+
+        """SSL context for the A/C module, built once and shared by every connection"""
+
+        # Prefer TLS
+        context = OpenSSL.SSL.Context(OpenSSL.SSL.TLSv1_METHOD)
+
+        try:
+            context.set_cipher_list(AC_CIPHERS.encode())
+        except OpenSSL.SSL.Error:
+            #OpenSSL before 1.1 has no security levels, nor needs them
+            context.set_cipher_list(b'AES256-SHA')
+
+        #Keep sessions on the client side so they can be offered on reconnect
+        context.set_session_cache_mode(OpenSSL.SSL.SESS_CACHE_CLIENT)
+
+        return context
+
+
+    def __record_session(self, connection, offered, handshake_time):
+
+        """Note whether the handshake resumed a session, and keep the new one"""
+
+        session = connection.get_session()
+        self.session_resumed = offered and self.__session_reused(connection, session)
+
+        #Only a handshake that really resumed shows the module copes with offered sessions
+        if self.session_resumed:
+            self.resume_failures = 0
+        elif self.resume_failures >= MAX_RESUME_FAILURES and self.resume_sessions:
+            #Handshakes offering a session keep failing where full ones succeed
+            self.logger2.info('A/C does not resume SSL sessions, using full handshakes')
+            self.resume_sessions = False
+
+        self.tls_session = session
+
+        self.logger2.debug('SSL handshake took %.3f seconds (%s)', handshake_time,
+                           'resumed' if self.session_resumed else 'full')
+
+
+    def __session_reused(self, connection, session):
+
+        """
+        Whether the handshake resumed the session offered, pyOpenSSL's
+        Connection has no session_reused() so ask libssl directly
+        """
+
+        try:
+            return bool(OpenSSL.SSL._lib.SSL_session_reused(connection._ssl))
+        except AttributeError:
+            #No libssl binding, a resumed handshake ends with the very session it was offered
+            offered = getattr(self.tls_session, '_session', None)
+            return offered is not None and getattr(session, '_session', None) == offered
+
+
+    def __set_tcp_keepalive(self, sock):
+
+        """Have the kernel probe an idle connection, where the platform allows"""
+
+        if not self.tcp_keepalive_idle:
+            return
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(self.tcp_keepalive_idle))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+
+
+    def accepting(self):
+        """False if new control requests should be refused, see OFFLINE_REJECT"""
+        return self.link.accepting()
 
-        for num in range(MAX_TRIES):
-            
-            try: 
-                if self.__get_ssl_connection():
-                    self.logger2.info('A/C connection established')
-                    return True
-            
-            except:
-                self.logger2.info('Exception while establishing SSL')
-                
-                
-            self.logger2.info('Unable to establish SSL connection, retrying in %d seconds', num * num + num)
-            sleep(num * num + num)
-
-        self.logger2.critical('Unable to establish SSL connection within allowed number of attempts')
-        
-        #Shutdown
-        self.__del__()
-        
 
     def __monitor_socket(self):
 
         """
         Monitor incoming data on SSL connection and transmit queue
+
+        Connection state changes happen inside this loop, select is given
+        a timeout rather than sleeping so the transmit queue is always
+        serviced while waiting to reconnect
         """
 
         self.logger2.debug('Starting SSL connection monitoring')
 
-        #self.__maintain_ssl_connection()
-        self.__establish_ssl_connection()
-
-        inputs = [self.ssl_con, self.tx_queue]
+        self.link.start()
 
         while True:
 
             try:
-                readable, writable, exceptional = select.select(inputs, [], [])
-
-                for s in readable:
-
-                    #Check SSL connection is in select
-                    if not self.ssl_con in inputs:
-                        inputs.append(self.ssl_con)
-                    
-                    #Check number of inputs in select
-                    if len(inputs) != 2:
-                        self.logger2.warning('Number of select inputs is: %d', len(inputs))
-                    
-                    #If input from SSL Connection
-                    if s is self.ssl_con:
-                    
-                        data = self.__receive_data()
-
-                        if data:
+
+                inputs = [self.tx_queue]
+                outputs = []
+                if self.ssl_con:
+                    inputs.append(self.ssl_con)
+
+                #Connecting and handshaking wait here too, never blocking the transmit queue
+                connecting = self.connecting
+                if connecting is not None:
+                    (inputs if self.want_read else outputs).append(connecting)
+
+                deadline = self.link.next_deadline()
+                timeout = None if deadline is None else max(0, deadline - time.time())
+
+                readable, writable, exceptional = select.select(inputs, outputs, [], timeout)
+
+                self.link.run_timers()
+
+                if connecting is not None and connecting is self.connecting and \
+                   (connecting in readable or connecting in writable):
+                    self.__step_connect()
+
+                #If input from SSL Connection
+                if self.ssl_con is not None and self.ssl_con in readable:
+
+                    data = self.__receive_data()
+
+                    if data is not None:
+                        for document in data:
                             self.logger2.debug('Putting received data on rx_queue')
-                            self.rx_queue.put(data)
-                        else:
-                            self.logger2.warning('Error receiving data from A/C')
-                            inputs.remove(s)
-                            self.__establish_ssl_connection()                       
-                    
-                    #If input from transmit queue
-                    elif s is self.tx_queue:
-                    
-                        self.logger2.debug('Getting data from tx_queue')
-
-                        data = self.tx_queue.get()
+                            self.rx_queue.put(document)
+                    else:
+                        self.link.lost('Error receiving data from A/C')
+
+                #If input from transmit queue, send everything waiting
+                if self.tx_queue in readable:
+
+                    self.logger2.debug('Getting data from tx_queue')
+
+                    for data in self.tx_queue.drain():
 
                         if data == SHUTDOWN_CMD:
                             self.logger2.info('Shutdown command received, ending connection monitoring')
                             self.__del__()
                             return None
 
-                        #Transmit to A/C
-                        if self.__send_data(data):
-                            self.logger2.debug('Data sent successfully')
-                        else:
-                            inputs.remove(s)
-                            self.__establish_ssl_connection()
-                            #inputs.append(self.ssl_con)
-                            #readable, writable, exceptional = select.select(inputs, [], inputs)
-                    
-                    #If input from unexpected source
-                    else:
-                        self.logger2.warning('readable input in select is not monitored, removing: %s', str(s))
-                        inputs.remove(s)
+                        if data == RESET_CMD:
+                            self.link.reset('Reset requested')
+                            continue
 
-                for s in exceptional:
-                    self.logger2.exception('Select returned an exceptional event')
+                        #Transmit to A/C
+                        self.link.transmit(data)
 
             except Exception as e:
                 #self.logger2.exception('Exception at select.select: %s %s', e.message, e.args)
@@ -319,52 +1034,76 @@ class ACCommunications(object):
         #Shutdown
         self.__del__()
 
-    
+
     def reset_ssl(self):
-    
-        self.__disconnect()
-        
-        #self.reset_timer = threading.Timer(self.reset_period, self.reset_ssl) 
-        #self.reset_timer.start() 
 
+        """Ask the monitoring thread to replace the SSL connection"""
 
+        self.tx_queue.put(RESET_CMD)
 
-    def __init__(self, s_address, token, send_q, receive_q, log):
 
-        """Setup socket monitoring"""
+
+    def __init__(self, s_address, encoder, send_q, receive_q, log,
+                 tcp_keepalive_idle=TCP_KEEPALIVE_IDLE,
+                 name=get_config.DEFAULT_UNIT_NAME,
+                 **options):
+
+        """
+        Setup socket monitoring
+
+        Args:
+        options: ACLink keyword arguments, see link_options()
+        """
 
         self.server_address = s_address
-        self.token = token
         self.tx_queue = send_q
         self.rx_queue = receive_q
         self.logger2 = log
-        
-        self.reset_period = 90
+        self.tcp_keepalive_idle = tcp_keepalive_idle
+
+        #SSL context is built once, the last session is offered on reconnect
+        self.ssl_context = self.__create_ssl_context()
+        self.tls_session = None
+        self.resume_sessions = True
+        self.resume_failures = 0
+        self.session_resumed = False
 
         self.ssl_con = None
         self.monitor_socket = None
 
+        #Connection being established, until its handshake completes
+        self.connecting = None
+        self.handshake_started = None #None while TCP is still connecting
+        self.want_read = False #Handshake waits for the socket to be readable, not writable
+        self.offered = False #Whether the session was offered on the connection in progress
+
+        #Reusable receive buffer, framed into complete XML documents
+        self.receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.receive_view = memoryview(self.receive_buffer)
+        self.framer = xml_framer.XMLFramer()
+
+        #State, backoff, held requests and keepalive are the link's, this thread does the I/O
+        self.link = ACLink(self.__get_ssl_connection, self.__disconnect, self.__send_data,
+                           encoder, log, name=name, **options)
+
         self.start()
 
         #self.monitor_socket = threading.Thread(name='monitor_ssl_socket',
         #                                      target=self.__monitor_socket)
         #self.monitor_socket.start()
-        
-        #self.reset_timer = threading.Timer(self.reset_period, self.reset_ssl) 
-        #self.reset_timer.start() 
-        
+
     def start(self):
-        
+
         self.monitor_socket = threading.Thread(name='monitor_ssl_socket',
                                                target=self.__monitor_socket)
         self.monitor_socket.start()
-        
+
     def stop(self):
         self.__del__()
 
     def __del__(self):
         self.logger2.info('Deconstructing ACCommunications')
-        self.__disconnect()
+        self.link.close()
         self.tx_queue.put(SHUTDOWN_CMD)
         #self.rx_queue.put(SHUTDOWN_CMD)
 
@@ -374,83 +1113,397 @@ class ACCommunications(object):
 
 
 
-class AirConInterface(object):
+class StatusRequestFlight(object):
 
-    """Provide methods to control A/C unit"""
+    """A status request in flight to A/C, shared by every caller waiting on it"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.waiters = []
+
+    def expired(self):
+        """True once the A/C has had RESPONSE_WAIT_TIME to respond"""
+        return time.time() - self.started >= RESPONSE_WAIT_TIME
+
+    def attach(self, waiter):
+        """Call waiter with no arguments when the response arrives"""
+        self.waiters.append(waiter)
+
+    def finish(self):
+        """Wake every waiting caller"""
+        for waiter in self.waiters:
+            waiter()
+
+
+
+
+class ACUnit(object):
+
+    """
+    Status, settings and status requests of one A/C unit, shared by both engines
+
+    The engine hands over every document received from A/C and waits, in
+    its own way, on the callbacks given here
+
+    Args:
+    name: unit name
+    duid: DUID of the A/C
+    encoder: ac_request_encoder.RequestEncoder of the unit
+    config: dict of unit config options
+    log: logger
+    transmit: called with each request to send to A/C, must not block
+    accepting: called with no arguments, False if settings should be refused
+    """
+
+    def __init__(self, name, duid, encoder, config, log, transmit, accepting):
+
+        self.name = name
+        self.ac_duid = duid
+        self.encoder = encoder
+        self.logger1 = log
+        self.transmit = transmit
+        self.accepting = accepting
+
+        self.status = ac_status.StatusRecord(STATUS_CONTAINER)
+        self.decoder = ac_response_decoder.ResponseDecoder(VALID_OPERATIONS)
+        self.tracker = command_tracker.CommandTracker()
+
+        #Status cache freshness bounds
+        self.status_ttl = float(config.get('status_ttl', STATUS_TTL))
+        self.status_max_age = float(config.get('status_max_age', STATUS_MAX_AGE))
+
+        self.poll_interval = float(config.get('poll_interval', STATUS_POLL_FREQ))
+        self.max_poll_interval = float(config.get('max_poll_interval', MAX_POLL_INTERVAL))
+        self.poller = None
+
+        #Every status received from A/C is kept here, if enabled
+        self.history = open_history(config)
+
+        #Status request currently awaiting a response, shared by all callers
+        self.status_flight = None
+        self.stranded = [] #Waiters of a status request lost with the link
+        self.flight_lock = threading.Lock()
+
+        #Metrics, labelled with the unit name
+        status_reads = 'ac_status_reads_total'
+        status_help = 'get_all_settings calls by how they were answered'
+        self.metric_status_fresh = metrics.counter(status_reads, status_help, unit=name, result='fresh')
+        self.metric_status_stale = metrics.counter(status_reads, status_help, unit=name, result='stale')
+        self.metric_status_refreshed = metrics.counter(status_reads, status_help,
+                                                       unit=name, result='refreshed')
+        self.metric_status_timeout = metrics.counter(status_reads, status_help,
+                                                     unit=name, result='timeout')
+        self.metric_status_wait = metrics.histogram('ac_status_wait_seconds',
+                                                    'Time get_all_settings waited for A/C', unit=name)
+
+        commands = 'ac_commands_total'
+        commands_help = 'apply_settings calls by outcome'
+        self.metric_commands_sent = metrics.counter(commands, commands_help, unit=name, result='sent')
+        self.metric_commands_invalid = metrics.counter(commands, commands_help,
+                                                       unit=name, result='invalid')
+        self.metric_commands_rejected = metrics.counter(commands, commands_help,
+                                                        unit=name, result='rejected')
+        self.metric_ack = metrics.histogram('ac_command_ack_seconds',
+                                            'Time from sending a command to its acknowledgement', unit=name)
+        self.metric_confirm = metrics.histogram('ac_command_confirm_seconds',
+                                                'Time from sending settings to A/C confirming all of them',
+                                                unit=name)
+        self.metric_confirm_timeouts = metrics.counter('ac_command_confirm_timeouts_total',
+                                                       'Waits for A/C to confirm settings that timed out',
+                                                       unit=name)
+
+        metrics.gauge('ac_status_age_seconds', 'Age of the last full status from A/C',
+                      unit=name).set_function(self.status_age)
+
+
+    def start_polling(self, poll):
+
+        """
+        Poll A/C status from the timer shared by all units
 
-    def __create_status_request(self):
-        """XML string to get current status of A/C"""
-        return """%s<Request Type="DeviceState" DUID="%s" />""" % (XML_HEADER, self.ac_duid)
+        Args:
+        poll: called with no arguments to request status, must not block
+        """
 
+        self.poller = poll_scheduler.AdaptivePoller(self.status, poll, self.logger1, self.name,
+                                                    self.poll_interval, self.max_poll_interval)
+        self.poller.start()
 
-    def __create_control_request(self, function, value):
 
-        """Generate XML request to update a setting on A/C"""
+    def stop_polling(self):
+        if self.poller is not None:
+            self.poller.stop()
 
-        root = ET.Element('Request', Type="DeviceControl")
-        child = ET.SubElement(root, 'Control', CommandID="cmd00000", DUID=self.ac_duid)
-        grandchild = ET.SubElement(child, 'Attr', ID=function, Value=value)
-        #print(type(XML_HEADER))
-        #print(type(ET.tostring(root)))
-        return XML_HEADER + (ET.tostring(root)).decode()
 
+    def __update_status_contatiner(self, updates):
 
-    def __parse_xml_input(self, xml_string):
+        """Publish several status updates as one new version of status"""
 
-        """parse xml responses from A/C to a list of dicts"""
+        return self.status.publish({function: status_value(function, value)
+                                    for function, value in updates.items()})
 
-        try:
 
-            root = ET.fromstring(xml_string)
+    def __acknowledge_command(self, command_id):
 
-            if root.attrib[AC_RESPONSE_TYPE] == AC_AUTH_TOKEN:
-                return [{AC_RESPONSE_TYPE: root.attrib[AC_RESPONSE_TYPE],
-                         AC_RESPONSE_ID: AC_AUTH_TOKEN,
-                         AC_RESPONSE_VALUE: root.attrib[AC_RESPONSE_STATUS]}]
+        """Match DeviceControl response to the command that caused it"""
 
-            else:
+        matched = self.encoder.acknowledge(command_id)
+
+        if matched is None:
+            self.logger1.debug('Response for unknown command %s', command_id)
+            return False
+
+        command, latency = matched
+        self.metric_ack.observe(latency)
+        self.tracker.reported(dict(command.attributes), acknowledged=True)
+        self.logger1.debug('Command %s %s acknowledged in %.3f seconds',
+                           command_id, command.attributes, latency)
+        return True
+
+
+    def handle_documents(self, documents):
+
+        """Apply responses from A/C, every one given as a single status update"""
+
+        updates = {}
+        full_update = False
+
+        for document in documents:
+
+            parsed = self.decoder.decode(document)
+
+            if not isinstance(parsed, list):
+                self.logger1.debug('Error parsing XML')
+                continue
 
-                func, value, all_attributes = None, None, []
+            for _, function, value in parsed:
+                if function == AC_COMMAND_ID:
+                    self.__acknowledge_command(value)
+                else:
+                    updates[function] = value
 
-                for node in root.iter():
+            #received full status update
+            if len(parsed) > 0 and parsed[0][0] == AC_RESPONSE_TYPE_DSTATE:
+                full_update = True
+                updates[LAST_UPDATE] = time.time()
 
-                    for n in node.keys():
+        if updates:
+            snapshot = self.__update_status_contatiner(updates)
 
-                        if n == AC_RESPONSE_ID:
-                            func = node.get(n)
-                        elif n == AC_RESPONSE_VALUE:
-                            value = node.get(n)
+            #History starts with the first full status
+            if self.history is not None and snapshot[LAST_UPDATE]:
+                self.history.record(self.ac_duid, snapshot)
 
-                    if func in VALID_OPERATIONS.keys():
-                        all_attributes.append({AC_RESPONSE_TYPE: root.attrib[AC_RESPONSE_TYPE],
-                                               AC_RESPONSE_ID: func,
-                                               AC_RESPONSE_VALUE: value})
+            self.tracker.reported({function: value for function, value in updates.items()
+                                   if function != LAST_UPDATE})
 
-                return all_attributes
+        if full_update:
+            self.__finish_status_flight()
 
 
-        except ET.ParseError:
-            self.logger1.debug('Error parsing XML - ET.ParseError')
-        except KeyError:
-            self.logger1.debug('Error parsing XML - KeyError')
+    def status_age(self):
+        """Seconds since last full status update from A/C"""
+        return time.time() - self.status[LAST_UPDATE]
 
+
+    def translate(self):
+        """Status with translated key names, as get_all_settings returns it"""
+        return translate_status(self.status.snapshot().copy(), self.status_ttl, self.status_max_age,
+                                self.tracker.unconfirmed())
+
+
+    def join_status_flight(self, waiter=None):
+
+        """
+        Attach to the status request in flight, only sending a new
+        request to A/C if none is outstanding
+
+        Args:
+        waiter: called with no arguments when the response arrives
+        """
+
+        with self.flight_lock:
+
+            flight = self.status_flight
+
+            if flight is None or flight.expired():
+                flight = StatusRequestFlight()
+                self.status_flight = flight
+                self.transmit(self.encoder.device_state())
+
+            if waiter is not None:
+                flight.attach(waiter)
+
+    def link_lost(self):
+
+        """
+        Link dropped, the status request in flight on it will not be
+        answered. Its waiters ask again once the link is back and callers
+        from now on start a new request
+        """
+
+        with self.flight_lock:
+            flight, self.status_flight = self.status_flight, None
+            if flight is not None:
+                self.stranded.extend(flight.waiters)
+
+
+    def link_ready(self):
+
+        """Link is back, request status for callers whose request was lost with the link"""
+
+        with self.flight_lock:
+            waiters, self.stranded = self.stranded, []
+
+        if waiters:
+            self.logger1.debug('Requesting status again for %d callers after reconnecting', len(waiters))
+
+        for waiter in waiters:
+            self.join_status_flight(waiter)
+
+
+    def __finish_status_flight(self):
+        """Complete the status request in flight, waking all its waiters"""
+        with self.flight_lock:
+            flight, self.status_flight = self.status_flight, None
+
+        if flight:
+            flight.finish()
+
+
+    def read_status(self, waiter):
+
+        """
+        Start a get_all_settings call, serving status from cache where possible
+
+        Fresh status (younger than status_ttl) is returned, stale status
+        (up to status_max_age) is returned and a single background refresh
+        is requested, anything older joins the status request in flight
+
+        Args:
+        waiter: called with no arguments when the A/C responds
+
+        Returns:
+        Translated status, or None if the caller should wait on waiter for
+        up to RESPONSE_WAIT_TIME and then call status_wait_ended()
+        """
+
+        age = self.status_age()
+        self.poller.status_read()
+
+        if age < self.status_ttl:
+            self.logger1.debug('Returning fresh status, %.1f seconds old', age)
+            self.metric_status_fresh.inc()
+            return self.translate()
+
+        if age <= self.status_max_age:
+            self.logger1.debug('Returning stale status, %.1f seconds old, refreshing', age)
+            self.metric_status_stale.inc()
+            self.join_status_flight()
+            return self.translate()
+
+        self.logger1.debug('Requesting A/C current status')
+        self.join_status_flight(waiter)
         return None
 
 
-    def __update_status_contatiner(self, function, value):
+    def status_wait_ended(self, responded, waited):
 
-        """Update current status container"""
+        """
+        Finish a get_all_settings call that waited for A/C
 
-        if function in self.status:
-            if function == AC_MODE and value == 'Wind': value = 'Fan'
-            self.status[function] = value
-            return True
+        Args:
+        responded: True if the waiter was called in time
+        waited: seconds spent waiting
+        """
+
+        self.metric_status_wait.observe(waited)
+
+        if responded:
+            self.logger1.debug('Received data from A/C')
+            self.metric_status_refreshed.inc()
         else:
-            #self.logger1.exception('Error updating current status dict, no key:', function)
-            return False
+            self.logger1.info('No data received, returning cached data')
+            self.metric_status_timeout.inc()
+
+        return self.translate()
+
+
+    def send_settings(self, settings, callback=None):
+
+        """
+        Validate and send settings, tracking them until A/C confirms them
+
+        Returns:
+        command_tracker.Expectation if callback is given, True if not,
+        None if the settings were not sent
+        """
+
+        attributes = []
+
+        for key, val in settings.items():
+
+            function = SETTABLE.get(key, key)
+
+            if function not in SETTABLE.values():
+                self.logger1.info('Unknown setting: %s', key)
+                self.metric_commands_invalid.inc()
+                return None
+
+            value = validate_setting(function, val)
 
+            if value is None:
+                self.logger1.info('Invalid value for %s: %s', key, val)
+                self.metric_commands_invalid.inc()
+                return None
 
-    def __monitor_input(self, r_event):
+            attributes.append((function, value))
+
+        if not attributes:
+            self.metric_commands_invalid.inc()
+            return None
+
+        if not self.accepting():
+            self.logger1.info('Link to A/C is down, rejecting settings')
+            self.metric_commands_rejected.inc()
+            return None
+
+        expectation = self.tracker.sent(attributes, callback)
+        self.__update_status_contatiner(dict(attributes))
+
+        self.transmit(self.encoder.device_control(attributes))
+        self.metric_commands_sent.inc()
+        self.poller.command_sent()
+        return expectation or True
+
+
+    def settings_wait_ended(self, expectation):
+
+        """
+        Finish an apply_settings_and_wait call
+
+        Returns:
+        (sent, confirmed, latency) as apply_settings_and_wait
+        """
+
+        self.tracker.forget(expectation)
+
+        if expectation.latency is None:
+            self.logger1.info('A/C did not confirm %s', expectation.pending)
+            self.metric_confirm_timeouts.inc()
+        else:
+            self.metric_confirm.observe(expectation.latency)
+
+        return True, translate_settings(expectation.confirmed()), expectation.latency
+
+
+
+
+class AirConInterface(object):
+
+    """Provide methods to control A/C unit"""
+
+    def __monitor_input(self):
 
         """Thread to monitor incoming data from A/C"""
 
@@ -465,23 +1518,18 @@ class AirConInterface(object):
 
                     self.logger1.debug('Getting data from receive queue')
 
-                    data = self.rx_queue.get()
+                    #Every response waiting is applied as one status update
+                    documents = []
 
-                    if data == SHUTDOWN_CMD:
-                        self.logger1.info('Shutting down monitoring of receive queue')
-                        return None
+                    for data in self.rx_queue.drain():
 
-                    parsed = self.__parse_xml_input(data)
+                        if data == SHUTDOWN_CMD:
+                            self.logger1.info('Shutting down monitoring of receive queue')
+                            return None
 
-                    if isinstance(parsed, list):
-                        for attrib in parsed:
-                            self.__update_status_contatiner(attrib[AC_RESPONSE_ID],
-                                                            attrib[AC_RESPONSE_VALUE])
+                        documents.append(data)
 
-                        #received full status update
-                        if len(parsed) > 0 and parsed[0][AC_RESPONSE_TYPE] == AC_RESPONSE_TYPE_DSTATE:
-                            self.__update_status_contatiner(LAST_UPDATE, time.time())
-                            r_event.set()
+                    self.unit.handle_documents(documents)
 
             except TypeError:
                 break
@@ -493,38 +1541,31 @@ class AirConInterface(object):
 
 
 
-    def __poll_status(self):
-
-        """Request A/C status at a regular interval"""
-
-        if self.tx_queue:
-            self.tx_queue.put(self.__create_status_request())
-        else:
-            self.logger1.info('Stopping poll_status thread')
-            return None
-
-        self.polling_thread = threading.Timer(STATUS_POLL_FREQ, self.__poll_status)
-        self.polling_thread.setName('status_polling_thread')
-        self.polling_thread.start()
-
+    def __init__(self, section=get_config.INTERFACE_SECTION, config=None):
 
+        """
+        Args:
+        section: config section of the A/C unit to control
+        config: ConfigParser object, read from CONFIG_FILE_NAME if None
+        """
 
-    def __init__(self):
+        if config is None:
+            config = get_config.get_config(CONFIG_FILE_NAME)
 
-        config = get_config.get_config(CONFIG_FILE_NAME)
+        config = get_config.get_unit_config(config, section)
 
-        log_filename = THIS_DIR + '/' + config.get('interface', 'logfile')
-        ac_address = (config.get('interface', 'ac_addr'),
-                      int(config.get('interface', 'ac_port')))
+        log_filename = THIS_DIR + '/' + config['logfile']
+        ac_address = (config['ac_addr'], int(config['ac_port']))
 
-        ac_token = config.get('interface', 'user_token')
+        ac_token = config['user_token']
 
-        self.ac_duid = config.get('interface', 'duid')
-        self.receive_event = threading.Event() #Set when status update received
-        self.status = STATUS_CONTAINER
+        self.name = get_config.get_unit_name(section)
+        self.ac_duid = config['duid']
+        self.encoder = ac_request_encoder.RequestEncoder(self.ac_duid, ac_token)
 
-        self.logger1 = log_handler.get_log_handler(log_filename, 'info', 'ac.interface')
-        self.logger2 = log_handler.get_log_handler(log_filename, 'info', 'ac.comms')
+        log_suffix = '' if section == get_config.INTERFACE_SECTION else '.' + self.name.lower()
+        self.logger1 = log_handler.get_log_handler(log_filename, 'info', 'ac.interface' + log_suffix)
+        self.logger2 = log_handler.get_log_handler(log_filename, 'info', 'ac.comms' + log_suffix)
 
         self.logger1.info('Starting: AirConInterface')
 
@@ -533,26 +1574,42 @@ class AirConInterface(object):
         #Receive from A/C
         self.rx_queue = pollable_queue.PollableQueue()
 
-        self.logger1.debug('Setting up communications with A/C WIFI module')
-        self.ac_con = ACCommunications(ac_address,
-                                       ac_token, self.tx_queue,
-                                       self.rx_queue, self.logger2)
+        #Status, settings and status requests, shared with the asyncio engine
+        self.unit = ACUnit(self.name, self.ac_duid, self.encoder, config, self.logger1,
+                           self.tx_queue.put, self.__accepting)
+        self.status = self.unit.status
 
-        #Wait for input from ACCommunications, then continue
-        select.select([self.rx_queue], [], [])
+        metrics.gauge('ac_tx_queue_depth', 'Requests waiting to be sent to A/C',
+                      unit=self.name).set_function(self.tx_queue.qsize)
+        metrics.gauge('ac_rx_queue_depth', 'Responses waiting to be processed',
+                      unit=self.name).set_function(self.rx_queue.qsize)
 
-        self.logger1.info('Established communications with A/C WIFI module')
+        self.logger1.debug('Setting up communications with A/C WIFI module')
+        self.ac_con = ACCommunications(ac_address,
+                                       self.encoder, self.tx_queue,
+                                       self.rx_queue, self.logger2,
+                                       float(config.get('tcp_keepalive_idle', TCP_KEEPALIVE_IDLE)),
+                                       self.name,
+                                       link_lost=self.unit.link_lost,
+                                       link_ready=self.unit.link_ready,
+                                       **link_options(config))
+        self.link = self.ac_con.link
+
+        #Wait for input from ACCommunications, then continue. An unreachable
+        #A/C reads as OFFLINE until the link reconnects in the background
+        readable, _, _ = select.select([self.rx_queue], [], [], STARTUP_WAIT)
+
+        if readable:
+            self.logger1.info('Established communications with A/C WIFI module')
+        else:
+            self.logger1.warning('No response from A/C in %d seconds, starting offline', STARTUP_WAIT)
 
         #Start thread to monitor receive queue
         self.monitor_input = threading.Thread(name='monitor_input',
-                                              target=self.__monitor_input,
-                                              args=(self.receive_event,))
-        self.receive_event.clear()
+                                              target=self.__monitor_input)
         self.monitor_input.start()
 
-        #Start thread to poll A/C status
-        self.polling_thread = None
-        self.__poll_status()
+        self.unit.start_polling(self.unit.join_status_flight)
 
 
 
@@ -560,7 +1617,7 @@ class AirConInterface(object):
         self.logger1.info('Shutting down all everything!')
         self.tx_queue.put(SHUTDOWN_CMD)
         self.rx_queue.put(SHUTDOWN_CMD)
-        self.polling_thread.cancel()
+        self.unit.stop_polling()
         sleep(2)
         #del self.tx_queue
         #del self.rx_queue
@@ -574,37 +1631,32 @@ class AirConInterface(object):
         self.__del__()
 
 
-    #Translate self.status dictionary key names
-    def __translate(self):
-        status_dict = self.status.copy()
-        
-        for key in TRANSLATE.keys():
-            status_dict[TRANSLATE[key]] = status_dict.pop(key)
+    def __accepting(self):
+        return self.ac_con.accepting()
 
-        #Provide feedback on age of status info
-        if time.time() - status_dict[LAST_UPDATE] < 5:
-            status_dict[AC_CONNECTION_STATUS] = AC_CONN_STATUS_ONLINE
-        elif time.time() - status_dict[LAST_UPDATE] <= 60:
-            status_dict[AC_CONNECTION_STATUS] = AC_CONN_STATUS_CACHED
-        else:
-            status_dict[AC_CONNECTION_STATUS] = AC_CONN_STATUS_OFFLINE
-            
-        return status_dict
 
     def get_all_settings(self):
-        self.logger1.debug('Requesting A/C current status')
-        self.receive_event.clear()
-        self.tx_queue.put(self.__create_status_request())
 
-        #Wait for response
-        self.receive_event.wait(RESPONSE_WAIT_TIME)
+        """
+        Return A/C status, served from cache where possible
 
-        if self.receive_event.isSet():
-            self.logger1.debug('Received data from A/C')
-        else:
-            self.logger1.info('No data received, returning cached data')
+        Fresh status (younger than status_ttl) is returned immediately,
+        stale status (up to status_max_age) is returned immediately and
+        a single background refresh is requested, anything older blocks
+        for up to RESPONSE_WAIT_TIME waiting for the A/C to respond
+        """
+
+        handle = threading.Event()
+        status = self.unit.read_status(handle.set)
+
+        if status is not None:
+            return status
 
-        return self.__translate()
+        #Wait for response
+        started = time.time()
+        handle.wait(RESPONSE_WAIT_TIME)
+
+        return self.unit.status_wait_ended(handle.is_set(), time.time() - started)
 
     def get_power(self):
         self.get_all_settings()
@@ -627,37 +1679,64 @@ class AirConInterface(object):
         return self.status[AC_CURRENT_TEMP]
 
 
-    def __set(self, function, val, possible_vals):
-        """sanity check request and add to transmit queue"""
-        if isinstance(val, str): val = val.capitalize()
-        
-        if val in possible_vals:
-            if not isinstance(val, str): val = str(val)
-            self.__update_status_contatiner(function, val)
-            self.tx_queue.put(self.__create_control_request(function, val))
-            return True
-        
-        return False
+    def apply_settings(self, settings):
+
+        """
+        Validate several settings and send them in one DeviceControl request
+
+        Args:
+        dict of settings, keyed by POWER/MODE/FAN/TEMP or A/C attribute ID
+
+        Returns:
+        True if all settings were sent, False if any was invalid and none were sent
+        """
+
+        return self.unit.send_settings(settings) is not None
+
+
+    def apply_settings_and_wait(self, settings, timeout=COMMAND_WAIT_TIME):
+
+        """
+        Apply settings and wait for the A/C to confirm them
+
+        Args:
+        settings: as apply_settings
+        timeout: seconds to wait, capped at MAX_COMMAND_WAIT_TIME
+
+        Returns:
+        (sent, confirmed, latency): whether the settings were sent, the
+        settings A/C confirmed keyed by POWER/MODE/FAN/TEMP, and seconds
+        until all were confirmed or None if they were not in time
+        """
+
+        done = threading.Event()
+        expectation = self.unit.send_settings(settings, done.set)
+
+        if expectation is None:
+            return False, {}, None
+
+        done.wait(min(timeout, MAX_COMMAND_WAIT_TIME))
+
+        return self.unit.settings_wait_ended(expectation)
 
     def set_power(self, val):
         self.logger1.debug('Setting power to: %s', val)
-        self.__set(AC_POWER, val, VALID_OPERATIONS[AC_POWER])
+        return self.apply_settings({AC_POWER: val})
 
     def set_mode(self, val):
-        if val == 'FAN': val = 'Wind'
         self.logger1.debug('Setting mode to: %s', val)
-        self.__set(AC_MODE, val, VALID_OPERATIONS[AC_MODE])
+        return self.apply_settings({AC_MODE: val})
 
     def set_fan(self, val):
         self.logger1.debug('Setting fan to: %s', val)
-        self.__set(AC_FAN, val, VALID_OPERATIONS[AC_FAN])
+        return self.apply_settings({AC_FAN: val})
 
     def set_temp(self, val):
         self.logger1.debug('Setting temp to: %s', val)
-        self.__set(AC_TEMP, int(val), VALID_OPERATIONS[AC_TEMP])
+        return self.apply_settings({AC_TEMP: val})
 
     def set_power_on(self):
-        self.set_power('On')
+        return self.set_power('On')
 
     def set_power_off(self):
-        self.set_power('Off')
+        return self.set_power('Off')
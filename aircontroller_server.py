@@ -6,78 +6,381 @@ import os
 import socketserver
 import json
 import sys
+import time
+import threading
+import concurrent.futures
 #import socket
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, THIS_DIR)
 
 import aircon_interface as AIRCON
+import async_aircon_interface
+import ac_registry
+import command_scheduler
 import log_handler
+import metrics
+import subscriptions
+import udp_codec
 import get_config
 
 #HOSTNAME = socket.gethostname()    
 #IPADDR = socket.gethostbyname(HOSTNAME)
 
-"""
-Sleep timer
-"""
+SERVER_MODE_SERIAL = 'serial' #One datagram at a time
+SERVER_MODE_THREADED = 'threaded' #Datagrams handled on a bounded worker pool
+MAX_WORKERS = 8
+MAX_INFLIGHT = 32 #Requests queued or running before replying BUSY
 
+BUSY_RESPONSE = json.dumps({'RESPONSE': 'BUSY'})
+
+ENGINE_THREADS = 'threads' #ACCommunications socket and queue monitoring threads
+ENGINE_ASYNCIO = 'asyncio' #AsyncAirConInterface on a background event loop
+
+METRICS_PORT = 0 #Prometheus text endpoint, 0 disables
+HISTORY_RANGE = 24 * 60 * 60 #seconds of history returned when START is not given
+SCHEDULE_FILE = 'schedules.json' #Scheduled SET commands, kept across restarts
+
+UDP_REQUESTS = metrics.counter('udp_requests_total', 'Datagrams handled')
+UDP_ERRORS = metrics.counter('udp_errors_total', 'Datagrams that could not be decoded as JSON')
+UDP_BINARY = metrics.counter('udp_binary_requests_total', 'Datagrams in the compact binary encoding')
+UDP_BUSY = metrics.counter('udp_busy_total', 'Datagrams answered BUSY as too many were in flight')
+UDP_INFLIGHT = metrics.gauge('udp_inflight', 'Datagrams queued or being handled')
+UDP_LATENCY = metrics.histogram('udp_request_seconds', 'Time from receiving a datagram to replying')
 
 class JSONtoACInterface(object):
 
     """Parse JSON input to AC commands"""
 
-    def __init__(self, log):
+    def __init__(self, log, config=None):
+
+        """Handlers hold no per-request state, parse may be called from several threads"""
+
         self.logger = log
 
-        #Instantiate AC Interface
-        self.aircon = AIRCON.AirConInterface()
+        if config is None:
+            config = get_config.get_config(AIRCON.CONFIG_FILE_NAME)
+
+        engine = config.get('interface', 'engine', fallback=ENGINE_THREADS)
+
+        #Any UDP worker or the scheduler may address ALL units at once
+        callers = config.getint('server', 'max_workers', fallback=MAX_WORKERS) + 1
+
+        #Instantiate AC Interface for every configured unit
+        if engine == ENGINE_ASYNCIO:
+            self.units = ac_registry.UnitRegistry(config, async_aircon_interface.ThreadedAirConInterface,
+                                                  callers)
+        else:
+            self.units = ac_registry.UnitRegistry(config, AIRCON.AirConInterface, callers)
+
+        self.logger.info('Managing A/C units: %s', ', '.join(self.units.names()))
+
+        self.subscriptions = subscriptions.SubscriptionManager(self.units.units, log)
+
+        #Same store the units record to
+        self.history = AIRCON.open_history(get_config.get_unit_config(config, get_config.INTERFACE_SECTION))
+
+        schedule_file = config.get('server', 'schedule_file', fallback=SCHEDULE_FILE)
+        self.scheduler = command_scheduler.CommandScheduler(self.__apply_scheduled, log,
+                                                            os.path.join(THIS_DIR, schedule_file)
+                                                            if schedule_file else None)
 
 
     def __del__(self):
         self.logger.info('Shutting down JSONtoACInterface')
-        self.aircon.shutdown()
+        self.scheduler.shutdown()
+        self.subscriptions.shutdown()
+        self.units.shutdown()
 
     def shutdown(self):
         self.__del__()
 
 
+    def __target(self, cmd):
+
+        """
+        Unit a command is addressed to by its UNIT or DUID field,
+        the registry itself for ALL, or None if no such unit
+        """
+
+        key = cmd.get('UNIT', cmd.get('DUID'))
+
+        if key == ac_registry.ALL_UNITS:
+            return self.units
+
+        return self.units.get(key)
+
+
+    def __fail(self, cmd):
+        if 'ID' in cmd:
+            return {'RESPONSE': 'FAIL', 'ID': cmd['ID']}
+        return {'RESPONSE': 'FAIL'}
+
+
     def __get_settings(self, cmd):
 
         self.logger.debug('Getting A/C status')
 
-        all_settings = self.aircon.get_all_settings()
+        target = self.__target(cmd)
+
+        if target is None:
+            self.logger.info('Unknown unit in %s', cmd)
+            return self.__fail(cmd)
+
+        if target is self.units:
+            all_settings = {'UNITS': target.get_all_settings()}
+        else:
+            all_settings = target.get_all_settings()
 
         self.logger.debug('Received settings')
 
+        if 'UNIT' in cmd:
+            all_settings['UNIT'] = cmd['UNIT']
+
         if 'ID' in cmd:
             all_settings['ID'] = cmd['ID']
 
         return all_settings
 
 
+    def __get_history(self, cmd):
+
+        """Status samples between START and END, downsampled to STEP seconds"""
+
+        target = self.__target(cmd)
+
+        if target is None or self.history is None:
+            self.logger.info('No history for %s', cmd)
+            return self.__fail(cmd)
+
+        try:
+            end = float(cmd.get('END', time.time()))
+            start = float(cmd.get('START', end - HISTORY_RANGE))
+            step = float(cmd['STEP']) if 'STEP' in cmd else None
+        except (TypeError, ValueError):
+            self.logger.info('Invalid history range in %s', cmd)
+            return self.__fail(cmd)
+
+        if target is self.units:
+            response = {'UNITS': {unit.name: self.history.query(unit.ac_duid, start, end, step)
+                                  for unit in target.units}}
+        else:
+            response = {'HISTORY': self.history.query(target.ac_duid, start, end, step)}
+
+        if 'UNIT' in cmd:
+            response['UNIT'] = cmd['UNIT']
+
+        if 'ID' in cmd:
+            response['ID'] = cmd['ID']
+
+        return response
+
+
+    def __subscribe(self, cmd, client):
+
+        """
+        Push status changes to the client until LEASE seconds pass,
+        replying with current status so the client starts in step
+        """
+
+        target = self.__target(cmd)
+
+        if target is None or client is None:
+            self.logger.info('Unable to subscribe %s', cmd)
+            return self.__fail(cmd)
+
+        sock, address = client
+
+        if target is self.units:
+            unit_names = None
+            settings = {'UNITS': target.get_all_settings()}
+        else:
+            unit_names = frozenset((target.name,))
+            settings = target.get_all_settings()
+
+        try:
+            lease = self.subscriptions.subscribe(sock, address, unit_names,
+                                                 cmd.get('LEASE', subscriptions.DEFAULT_LEASE))
+        except (TypeError, ValueError):
+            lease = None
+
+        if lease is None:
+            return self.__fail(cmd)
+
+        response = {'RESPONSE': 'OK', 'LEASE': lease, 'SETTINGS': settings}
+
+        if 'ID' in cmd:
+            response['ID'] = cmd['ID']
+
+        return response
+
+
+    def __unsubscribe(self, cmd, client):
+
+        response = {'RESPONSE': 'OK' if client and self.subscriptions.unsubscribe(client[1]) else 'FAIL'}
+
+        if 'ID' in cmd:
+            response['ID'] = cmd['ID']
+
+        return response
+
+
+    def __apply_scheduled(self, unit, settings):
+
+        """Apply settings of a schedule that has come due"""
+
+        target = self.__target({'UNIT': unit} if unit else {})
+
+        if target is None:
+            self.logger.info('Scheduled unit %s no longer exists', unit)
+            return False
+
+        return target.apply_settings(settings)
+
+
+    def __schedule_settings(self, settings):
+
+        """
+        Apply settings TIMER seconds from now or at time AT, then every
+        REPEAT seconds if given. Settings are checked now so a bad one
+        fails the request rather than the schedule
+        """
+
+        requested = self.__requested(settings)
+
+        if not requested or not all(key in AIRCON.SETTABLE and
+                                    AIRCON.validate_setting(AIRCON.SETTABLE[key], val) is not None
+                                    for key, val in requested.items()):
+            self.logger.info('Invalid scheduled settings in %s', settings)
+            return self.__fail(settings)
+
+        try:
+            at = float(settings['AT']) if 'AT' in settings else time.time() + float(settings['TIMER'])
+            repeat = float(settings['REPEAT']) if settings.get('REPEAT') else None
+        except (TypeError, ValueError):
+            self.logger.info('Invalid schedule time in %s', settings)
+            return self.__fail(settings)
+
+        schedule = self.scheduler.add(settings.get('UNIT', settings.get('DUID')), requested, at, repeat)
+
+        if schedule is None:
+            self.logger.info('Too many schedules, refusing %s', settings)
+            return self.__fail(settings)
+
+        response = {'RESPONSE': 'OK', 'SCHEDULE': schedule.schedule_id, 'AT': schedule.at}
+
+        if 'ID' in settings:
+            response['ID'] = settings['ID']
+
+        return response
+
+
+    def __get_schedules(self, cmd):
+
+        unit = cmd.get('UNIT', cmd.get('DUID'))
+        response = {'SCHEDULES': self.scheduler.list_schedules(None if unit == ac_registry.ALL_UNITS else unit)}
+
+        if 'ID' in cmd:
+            response['ID'] = cmd['ID']
+
+        return response
+
+
+    def __cancel_schedule(self, cmd):
+
+        try:
+            success = self.scheduler.cancel(int(cmd['SCHEDULE']))
+        except (TypeError, ValueError):
+            success = False
+
+        response = {'RESPONSE': 'OK' if success else 'FAIL'}
+
+        if 'ID' in cmd:
+            response['ID'] = cmd['ID']
+
+        return response
+
+
+    def __requested(self, settings):
+
+        """Settings in a SET command, by POWER/MODE/FAN/TEMP"""
+
+        if 'TYPE' in settings:
+            #Backwards compatibility - single command per JSON string
+            return {str(settings['TYPE']): str(settings['VALUE'])}
+
+        return {key: settings[key] for key in AIRCON.SETTABLE if key in settings}
+
+
+    def __confirmation(self, sent, confirmed, latency):
+
+        """Response for one unit's settings sent with WAIT"""
+
+        if not sent:
+            result = 'FAIL'
+        elif latency is None:
+            result = 'UNCONFIRMED'
+        else:
+            result = 'OK'
+
+        return {'RESPONSE': result, 'CONFIRMED': confirmed,
+                'LATENCY': None if latency is None else round(latency, 3)}
+
+
+    def __set_settings_and_wait(self, settings, target):
+
+        """
+        Apply settings and reply once the A/C confirms them, or WAIT
+        seconds pass, with the confirmed values and how long they took
+        """
+
+        try:
+            timeout = float(settings['WAIT'])
+        except (TypeError, ValueError):
+            self.logger.info('Invalid WAIT in %s', settings)
+            return self.__fail(settings)
+
+        requested = self.__requested(settings)
+
+        if target is self.units:
+            units = {name: self.__confirmation(*result) for name, result in
+                     target.apply_settings_and_wait(requested, timeout).items()}
+            results = set(unit['RESPONSE'] for unit in units.values())
+            response = {'RESPONSE': results.pop() if len(results) == 1 else 'UNCONFIRMED',
+                        'UNITS': units}
+        else:
+            response = self.__confirmation(*target.apply_settings_and_wait(requested, timeout))
+
+        if 'ID' in settings:
+            response['ID'] = settings['ID']
+
+        return response
+
+
     def __set_settings(self, settings):
 
         """Control A/C"""
 
+        target = self.__target(settings)
+
+        if target is None:
+            self.logger.info('Unknown unit in %s', settings)
+            return self.__fail(settings)
+
         try:
 
-            if 'TIMER' in settings:
-                pass
-                #start timer thread with 'TIMER' value as sleep time and settings as arg
+            if 'TIMER' in settings or 'AT' in settings:
+                return self.__schedule_settings(settings)
+
+            if 'WAIT' in settings:
+                return self.__set_settings_and_wait(settings, target)
 
             if not 'TYPE' in settings:
 
-                #Combine multiple operations into one JSON command
+                #Combine multiple operations into one JSON command, sent as one request
 
-                if 'POWER' in settings:
-                    self.aircon.set_power(settings['POWER'])
-                if 'MODE' in settings:
-                    self.aircon.set_mode(settings['MODE'])
-                if 'FAN' in settings:
-                    self.aircon.set_fan(settings['FAN'])
-                if 'TEMP' in settings:
-                    self.aircon.set_temp(settings['TEMP'])
+                requested = {key: settings[key] for key in AIRCON.SETTABLE if key in settings}
+                success = target.apply_settings(requested)
 
             else:
 
@@ -86,29 +389,77 @@ class JSONtoACInterface(object):
                 op_type = str(settings['TYPE'])
                 val = str(settings['VALUE'])
 
-                if op_type == 'POWER':
-                    self.aircon.set_power(val)
-                elif op_type == 'MODE':
-                    self.aircon.set_mode(val)
-                elif op_type == 'FAN':
-                    self.aircon.set_fan(val)
-                elif op_type == 'TEMP':
-                    self.aircon.set_temp(val)
+                success = op_type in AIRCON.SETTABLE and \
+                    target.apply_settings({op_type: val})
 
         except KeyError:
             self.logger.exception('Key error when parsing %s', settings)
-            if 'ID' in settings:
-                return {'RESPONSE': 'FAIL', 'ID': settings['ID']}
-            return {'RESPONSE': 'FAIL'}
+            success = False
+
+        response = {'RESPONSE': 'OK' if success else 'FAIL'}
 
         if 'ID' in settings:
-            return {'RESPONSE': 'OK', 'ID': settings['ID']}
-        return {'RESPONSE': 'OK'}
+            response['ID'] = settings['ID']
+        return response
+
+
 
+    def __binary_targets(self, unit):
+        """(index, unit) pairs a binary request addresses, empty if no such unit"""
+        units = self.units.units
+        if unit == udp_codec.UNIT_ALL:
+            return list(enumerate(units))
+        if unit == udp_codec.UNIT_DEFAULT:
+            return [(0, units[0])]
+        return [(unit, units[unit])] if unit < len(units) else []
 
 
-    def parse(self, command):
-        """Handle Set and Get operations"""
+    def parse_binary(self, data):
+
+        """
+        Handle a Get or Set in the udp_codec binary encoding
+
+        Replies to both with the status of every unit addressed, so a
+        panel needs one datagram each way to change and show a setting
+        """
+
+        try:
+            opcode, request_id, unit, settings = udp_codec.decode_request(data)
+        except udp_codec.CodecError as e:
+            self.logger.info('Invalid binary request: %s', e)
+            return udp_codec.error_response(data, udp_codec.RESULT_FAIL)
+
+        targets = self.__binary_targets(unit)
+
+        if not targets:
+            self.logger.info('Unknown unit %d in binary request', unit)
+            return udp_codec.encode_response(opcode, request_id, udp_codec.RESULT_FAIL)
+
+        result = udp_codec.RESULT_OK
+
+        if opcode == udp_codec.OP_SET:
+            target = self.units if unit == udp_codec.UNIT_ALL else targets[0][1]
+            if not settings or not target.apply_settings(settings):
+                result = udp_codec.RESULT_FAIL
+
+        if len(targets) > 1:
+            statuses = self.units.get_all_settings()
+            records = [udp_codec.encode_status(index, statuses[target.name]) for index, target in targets]
+        else:
+            records = [udp_codec.encode_status(index, target.get_all_settings()) for index, target in targets]
+
+        return udp_codec.encode_response(opcode, request_id, result, records)
+
+
+    def parse(self, command, client=None):
+
+        """
+        Handle Set and Get operations
+
+        Args:
+        command: decoded JSON request
+        client: (socket, address) the request came from, needed to SUBSCRIBE
+        """
 
         self.logger.debug('Received: %s', command)
 
@@ -118,6 +469,12 @@ class JSONtoACInterface(object):
                 if command['OPERATION'] == "GET":
                     if command['TYPE'] == 'SETTINGS':
                         return json.dumps(self.__get_settings(command))
+                    if command['TYPE'] == 'METRICS':
+                        return json.dumps(metrics.REGISTRY.snapshot())
+                    if command['TYPE'] == 'HISTORY':
+                        return json.dumps(self.__get_history(command))
+                    if command['TYPE'] == 'SCHEDULES':
+                        return json.dumps(self.__get_schedules(command))
 
                 elif command['OPERATION'] == "SET":
                     #self.__set_settings(command)
@@ -125,6 +482,15 @@ class JSONtoACInterface(object):
                     #return json.dumps(self.__get_settings())
                     return json.dumps(self.__set_settings(command))
 
+                elif command['OPERATION'] == "SUBSCRIBE":
+                    return json.dumps(self.__subscribe(command, client))
+
+                elif command['OPERATION'] == "UNSUBSCRIBE":
+                    return json.dumps(self.__unsubscribe(command, client))
+
+                elif command['OPERATION'] == "CANCEL":
+                    return json.dumps(self.__cancel_schedule(command))
+
             else:
                 self.logger.info('Command contains no Operation')
 
@@ -147,17 +513,74 @@ class UDPHandler(socketserver.BaseRequestHandler):
         return
 
     def handle(self):
-        data = self.request[0].strip().upper()
+        started = time.perf_counter()
+        data = self.request[0]
         socket = self.request[1]
-        data = data.decode()
+
+        UDP_REQUESTS.inc()
+
+        #Binary requests are answered in binary, before any text handling
+        if udp_codec.is_binary(data):
+            UDP_BINARY.inc()
+            socket.sendto(AIRCON_HANDLER.parse_binary(data), self.client_address)
+            UDP_LATENCY.observe(time.perf_counter() - started)
+            return
+
+        data = data.strip().upper().decode()
 
         self.logger.debug("From %s: %s", self.client_address[0], data)
 
         try:
-            response = AIRCON_HANDLER.parse(json.loads(data))
+            response = AIRCON_HANDLER.parse(json.loads(data), (socket, self.client_address))
             socket.sendto(response.encode(), self.client_address)
+            UDP_LATENCY.observe(time.perf_counter() - started)
         except ValueError:
             self.logger.exception('Exception decoding JSON')
+            UDP_ERRORS.inc()
+
+
+class PooledUDPServer(socketserver.UDPServer):
+
+    """
+    UDP server handling datagrams on a bounded pool of worker threads
+
+    At most max_inflight requests are queued or running, further
+    datagrams are answered with BUSY straight from the receive loop
+    """
+
+    def __init__(self, server_address, handler_class, max_workers, max_inflight):
+        socketserver.UDPServer.__init__(self, server_address, handler_class)
+        self.workers = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                             thread_name_prefix='udp_worker')
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+
+    def process_request(self, request, client_address):
+
+        if not self.inflight.acquire(blocking=False):
+            LOGGER1.warning('Too many requests in flight, sending BUSY to %s', client_address[0])
+            if udp_codec.is_binary(request[0]):
+                request[1].sendto(udp_codec.error_response(request[0], udp_codec.RESULT_BUSY), client_address)
+            else:
+                request[1].sendto(BUSY_RESPONSE.encode(), client_address)
+            UDP_BUSY.inc()
+            return
+
+        UDP_INFLIGHT.inc()
+        self.workers.submit(self.__process_request_worker, request, client_address)
+
+    def __process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.inflight.release()
+            UDP_INFLIGHT.dec()
+
+    def server_close(self):
+        socketserver.UDPServer.server_close(self)
+        self.workers.shutdown(wait=False)
 
 
 
@@ -170,16 +593,29 @@ if __name__ == "__main__":
     LOG_FILENAME = THIS_DIR + '/' + CONFIG.get('server', 'logfile')
     HOST = CONFIG.get('server', 'server_ip')
     PORT = int(CONFIG.get('server', 'server_port'))
+    SERVER_MODE = CONFIG.get('server', 'server_mode', fallback=SERVER_MODE_THREADED)
+    METRICS_PORT = CONFIG.getint('server', 'metrics_port', fallback=METRICS_PORT)
 
     LOGGER1 = log_handler.get_log_handler(LOG_FILENAME, 'info', 'aircontroller.UDPHandler')
     #LOGGER1 = log_handler.get_log_handler(LOG_FILENAME, 'debug', 'aircontroller.UDPHandler')
 
     AIRCON_HANDLER = JSONtoACInterface(log_handler.get_log_handler(LOG_FILENAME,
                                                                    'info',
-                                                                   'aircontroller.JSONtoAC'))
+                                                                   'aircontroller.JSONtoAC'),
+                                       CONFIG)
+
+    if METRICS_PORT:
+        LOGGER1.info('Serving metrics at http://%s:%d%s', HOST, METRICS_PORT, metrics.PROMETHEUS_PATH)
+        metrics.start_http_server(HOST, METRICS_PORT)
+
+    LOGGER1.info('Starting UPD server at %s:%d in %s mode', HOST, PORT, SERVER_MODE)
 
-    LOGGER1.info('Starting UPD server at %s:%d', HOST, PORT)
-    SERVER = socketserver.UDPServer((HOST, PORT), UDPHandler)
+    if SERVER_MODE == SERVER_MODE_SERIAL:
+        SERVER = socketserver.UDPServer((HOST, PORT), UDPHandler)
+    else:
+        SERVER = PooledUDPServer((HOST, PORT), UDPHandler,
+                                 CONFIG.getint('server', 'max_workers', fallback=MAX_WORKERS),
+                                 CONFIG.getint('server', 'max_inflight', fallback=MAX_INFLIGHT))
     
     #LOGGER1.info('Starting UPD server at %s:%d', IPADDR, PORT)
     #SERVER = socketserver.UDPServer((IPADDR, PORT), UDPHandler)
@@ -0,0 +1,434 @@
+"""Talk to A/C WIFI Module from an asyncio event loop"""
+
+import sys
+import os
+import ssl
+import time
+import asyncio
+import threading
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, THIS_DIR)
+
+import get_config
+import log_handler
+import xml_framer
+import ac_request_encoder
+import aircon_interface as AIRCON
+
+
+def create_ssl_context():
+
+    """TLS context for the A/C module's self signed certificate and legacy cipher"""
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    try:
+        context.minimum_version = ssl.TLSVersion.TLSv1
+        context.set_ciphers(AIRCON.AC_CIPHERS)
+    except (ValueError, ssl.SSLError):
+        #Local OpenSSL build does not offer the module's cipher, use its defaults
+        pass
+
+    return context
+
+
+
+class AsyncAirConInterface(object):
+
+    """
+    Provide awaitable methods to control A/C unit
+
+    One TLS stream and one timer task per unit, all running on the
+    caller's event loop. Connection state, backoff, held requests and
+    keepalive follow aircon_interface.ACLink and status and settings
+    aircon_interface.ACUnit, exactly as for AirConInterface. Call start()
+    before use
+    """
+
+    def __init__(self, section=get_config.INTERFACE_SECTION, config=None):
+
+        if config is None:
+            config = get_config.get_config(AIRCON.CONFIG_FILE_NAME)
+
+        config = get_config.get_unit_config(config, section)
+
+        log_filename = THIS_DIR + '/' + config['logfile']
+        self.ac_address = (config['ac_addr'], int(config['ac_port']))
+
+        self.name = get_config.get_unit_name(section)
+        self.ac_duid = config['duid']
+        self.encoder = ac_request_encoder.RequestEncoder(self.ac_duid, config['user_token'])
+        self.framer = xml_framer.XMLFramer()
+        self.ssl_context = create_ssl_context()
+
+        log_suffix = '' if section == get_config.INTERFACE_SECTION else '.' + self.name.lower()
+        self.logger1 = log_handler.get_log_handler(log_filename, 'info', 'ac.async' + log_suffix)
+        self.logger2 = log_handler.get_log_handler(log_filename, 'info', 'ac.async.comms' + log_suffix)
+
+        self.unit = AIRCON.ACUnit(self.name, self.ac_duid, self.encoder, config, self.logger1,
+                                  self.__transmit, self.__accepting)
+        self.status = self.unit.status
+
+        self.link = AIRCON.ACLink(self.__open_link, self.__close_link, self.__write_link,
+                                  self.encoder, self.logger2, name=self.name,
+                                  link_lost=self.unit.link_lost,
+                                  link_ready=self.unit.link_ready,
+                                  **AIRCON.link_options(config))
+
+        self.opening = None #Task connecting to A/C
+        self.receiving = None #Task reading from A/C
+        self.writer = None
+        self.wake = None #Set when the link's next deadline may have moved
+        self.received = None #Set once any data has been received from A/C
+        self.tasks = []
+
+
+    async def start(self):
+
+        """
+        Connect to A/C and start polling, returns once A/C has responded
+        or after STARTUP_WAIT, when the unit carries on offline
+        """
+
+        self.logger1.info('Starting: AsyncAirConInterface')
+
+        self.wake = asyncio.Event()
+        self.received = asyncio.Event()
+
+        self.tasks = [asyncio.ensure_future(self.__run_timers())]
+        self.link.start()
+
+        #Polls are timed by the timer shared with every other unit, then run on this loop
+        loop = asyncio.get_running_loop()
+        self.unit.start_polling(lambda: loop.call_soon_threadsafe(self.unit.join_status_flight))
+
+        try:
+            await asyncio.wait_for(self.received.wait(), AIRCON.STARTUP_WAIT)
+        except asyncio.TimeoutError:
+            self.logger1.warning('No response from A/C in %d seconds, starting offline',
+                                 AIRCON.STARTUP_WAIT)
+            return
+
+        self.logger1.info('Established communications with A/C WIFI module')
+
+
+    async def shutdown(self):
+
+        """Stop polling and close connection to A/C"""
+
+        self.logger1.info('Shutting down AsyncAirConInterface')
+
+        self.unit.stop_polling()
+        self.link.close()
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+
+    def __open_link(self):
+        """ACLink callback, connect in the background"""
+        self.opening = asyncio.ensure_future(self.__open())
+
+
+    async def __open(self):
+
+        """Open TLS stream to A/C, telling the link how it went"""
+
+        self.logger2.debug('Connecting to %s...', self.ac_address)
+
+        started = time.time()
+
+        try:
+            reader, writer = await asyncio.open_connection(self.ac_address[0], self.ac_address[1],
+                                                           ssl=self.ssl_context)
+        except OSError as e:
+            self.opening = None
+            self.link.open_failed('%r' % e)
+            self.wake.set()
+            return
+
+        self.opening = None
+        self.writer = writer
+        self.framer.reset()
+        self.receiving = asyncio.ensure_future(self.__receive(reader))
+
+        ssl_object = writer.get_extra_info('ssl_object')
+        self.link.opened(time.time() - started, bool(ssl_object and ssl_object.session_reused))
+        self.wake.set()
+
+
+    def __close_link(self):
+
+        """ACLink callback, drop the connection or connection attempt"""
+
+        if self.opening is not None:
+            self.opening.cancel()
+            self.opening = None
+
+        if self.receiving is not None:
+            self.receiving.cancel()
+            self.receiving = None
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+    def __write_link(self, data):
+
+        """ACLink callback, write to the TLS stream"""
+
+        if self.writer is None or self.writer.is_closing():
+            return False
+
+        try:
+            self.writer.write(data)
+            return True
+        except (OSError, RuntimeError) as e:
+            self.logger2.warning('Error sending data to A/C: %r', e)
+
+        return False
+
+
+    async def __receive(self, reader):
+
+        """Read from A/C until the connection fails"""
+
+        while True:
+
+            try:
+                data = await reader.read(AIRCON.RECEIVE_BUFFER_SIZE)
+            except OSError as e:
+                reason = 'Error receiving data from A/C: %r' % e
+                break
+
+            if not data:
+                reason = 'A/C closed the connection'
+                break
+
+            documents = [document.decode() for document in self.framer.feed(data)]
+
+            self.link.received(len(data), documents)
+            self.wake.set()
+
+            if documents:
+                self.unit.handle_documents(documents)
+                self.received.set()
+
+        self.receiving = None
+        self.link.lost(reason)
+        self.wake.set()
+
+
+    async def __run_timers(self):
+
+        """Act on the link's timers, as the threaded engine's select loop does"""
+
+        while True:
+
+            deadline = self.link.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.time())
+
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wake.clear()
+
+            try:
+                self.link.run_timers()
+            except Exception:
+                self.logger2.exception('Exception running link timers')
+
+
+    def __transmit(self, data):
+        """ACUnit callback, send now or hold per the offline policy"""
+        self.link.transmit(data)
+        self.wake.set()
+
+
+    def __accepting(self):
+        return self.link.accepting()
+
+
+    async def get_all_settings(self):
+
+        """Return A/C status, served from cache where possible"""
+
+        responded = asyncio.get_running_loop().create_future()
+        status = self.unit.read_status(lambda: responded.done() or responded.set_result(True))
+
+        if status is not None:
+            return status
+
+        started = time.time()
+
+        try:
+            await asyncio.wait_for(responded, AIRCON.RESPONSE_WAIT_TIME)
+        except asyncio.TimeoutError:
+            pass
+
+        return self.unit.status_wait_ended(responded.done() and not responded.cancelled(),
+                                           time.time() - started)
+
+    async def get_power(self):
+        await self.get_all_settings()
+        return self.status[AIRCON.AC_POWER]
+
+    async def get_mode(self):
+        await self.get_all_settings()
+        return self.status[AIRCON.AC_MODE]
+
+    async def get_fan(self):
+        await self.get_all_settings()
+        return self.status[AIRCON.AC_FAN]
+
+    async def get_temp(self):
+        await self.get_all_settings()
+        return self.status[AIRCON.AC_TEMP]
+
+    async def get_current_temp(self):
+        await self.get_all_settings()
+        return self.status[AIRCON.AC_CURRENT_TEMP]
+
+
+    async def apply_settings(self, settings):
+
+        """Validate several settings and send them in one DeviceControl request"""
+
+        return self.unit.send_settings(settings) is not None
+
+
+    async def apply_settings_and_wait(self, settings, timeout=AIRCON.COMMAND_WAIT_TIME):
+
+        """Apply settings and wait for the A/C to confirm them, as AirConInterface does"""
+
+        confirmed = asyncio.get_running_loop().create_future()
+        expectation = self.unit.send_settings(settings,
+                                              lambda: confirmed.done() or confirmed.set_result(True))
+
+        if expectation is None:
+            return False, {}, None
+
+        try:
+            await asyncio.wait_for(confirmed, min(timeout, AIRCON.MAX_COMMAND_WAIT_TIME))
+        except asyncio.TimeoutError:
+            pass
+
+        return self.unit.settings_wait_ended(expectation)
+
+    async def set_power(self, val):
+        return await self.apply_settings({AIRCON.AC_POWER: val})
+
+    async def set_mode(self, val):
+        return await self.apply_settings({AIRCON.AC_MODE: val})
+
+    async def set_fan(self, val):
+        return await self.apply_settings({AIRCON.AC_FAN: val})
+
+    async def set_temp(self, val):
+        return await self.apply_settings({AIRCON.AC_TEMP: val})
+
+    async def set_power_on(self):
+        return await self.set_power('On')
+
+    async def set_power_off(self):
+        return await self.set_power('Off')
+
+
+
+class ThreadedAirConInterface(object):
+
+    """
+    Blocking AirConInterface API driving AsyncAirConInterface
+
+    Every unit runs on one shared event loop thread, each call blocks
+    the calling thread until the coroutine completes on that loop
+    """
+
+    loop = None
+    loop_lock = threading.Lock()
+
+    @classmethod
+    def __shared_loop(cls):
+        """Event loop shared by all units, started on first use"""
+        with cls.loop_lock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                threading.Thread(name='aircon_event_loop',
+                                 target=cls.loop.run_forever,
+                                 daemon=True).start()
+        return cls.loop
+
+    def __init__(self, section=get_config.INTERFACE_SECTION, config=None):
+
+        self.loop = self.__shared_loop()
+
+        self.aircon = AsyncAirConInterface(section, config)
+        self.name = self.aircon.name
+        self.ac_duid = self.aircon.ac_duid
+        self.status = self.aircon.status
+        self.link = self.aircon.link
+        self.__call(self.aircon.start())
+
+
+    def __call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+    def shutdown(self):
+        if self.aircon.tasks:
+            self.__call(self.aircon.shutdown())
+
+    def kill(self):
+        self.shutdown()
+
+
+    def get_all_settings(self):
+        return self.__call(self.aircon.get_all_settings())
+
+    def get_power(self):
+        return self.__call(self.aircon.get_power())
+
+    def get_mode(self):
+        return self.__call(self.aircon.get_mode())
+
+    def get_fan(self):
+        return self.__call(self.aircon.get_fan())
+
+    def get_temp(self):
+        return self.__call(self.aircon.get_temp())
+
+    def get_current_temp(self):
+        return self.__call(self.aircon.get_current_temp())
+
+    def apply_settings(self, settings):
+        return self.__call(self.aircon.apply_settings(settings))
+
+    def apply_settings_and_wait(self, settings, timeout=AIRCON.COMMAND_WAIT_TIME):
+        return self.__call(self.aircon.apply_settings_and_wait(settings, timeout))
+
+    def set_power(self, val):
+        return self.__call(self.aircon.set_power(val))
+
+    def set_mode(self, val):
+        return self.__call(self.aircon.set_mode(val))
+
+    def set_fan(self, val):
+        return self.__call(self.aircon.set_fan(val))
+
+    def set_temp(self, val):
+        return self.__call(self.aircon.set_temp(val))
+
+    def set_power_on(self):
+        return self.__call(self.aircon.set_power_on())
+
+    def set_power_off(self):
+        return self.__call(self.aircon.set_power_off())
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+"""
+End-to-end benchmark: UDP JSON request -> aircontroller_server -> A/C module and back
+
+Runs the UDP server in-process against ac_simulator, sends GET SETTINGS
+and SET requests at a fixed rate from several clients and reports
+latency percentiles, throughput, timeouts and bytes on the TLS link per
+request. An estimate of where the time goes (JSON and XML parsing,
+queue hand-offs, module round trip) is measured separately.
+
+Results are written as JSON so runs on different versions can be diffed,
+a one line summary goes to stderr
+
+Usage: python3 benchmarks/bench_e2e.py --rate 200 --concurrency 8 --duration 10 --output results.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import select
+import socket
+import timeit
+import logging
+import argparse
+import threading
+import subprocess
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(THIS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import get_config
+import ac_simulator
+import ac_response_decoder
+import pollable_queue
+import aircon_interface as AIRCON
+import aircontroller_server as SERVER
+
+GET_REQUEST = {'OPERATION': 'GET', 'TYPE': 'SETTINGS'}
+SET_VALUES = (('TEMP', ('20', '21', '22', '23', '24')),
+              ('FAN', ('LOW', 'MID', 'HIGH', 'AUTO')),
+              ('POWER', ('ON',)))
+
+PERCENTILES = (50, 95, 99)
+PARSE_ITERATIONS = 5000
+QUEUE_ITERATIONS = 5000
+
+
+def percentile(ordered, pct):
+    """Nearest rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_config(args, port, duids):
+
+    """Repo config with every unit pointed at the simulator"""
+
+    config = get_config.get_config(AIRCON.CONFIG_FILE_NAME)
+    config['server']['max_workers'] = str(args.workers)
+
+    for section in get_config.get_unit_sections(config):
+        if section != get_config.INTERFACE_SECTION:
+            config.remove_section(section)
+
+    #Unit sections take everything else from [interface]
+    interface = config[get_config.INTERFACE_SECTION]
+    interface['ac_addr'] = '127.0.0.1'
+    interface['ac_port'] = str(port)
+    interface['duid'] = duids[0]
+    interface['engine'] = args.engine
+    interface['status_ttl'] = str(args.status_ttl)
+
+    if len(duids) > 1:
+        for i, duid in enumerate(duids):
+            section = '%sbench%d' % (get_config.UNIT_SECTION_PREFIX, i)
+            config.add_section(section)
+            config[section]['duid'] = duid
+
+    return config
+
+
+def start_server(args, config):
+
+    """Pooled UDP server on an ephemeral port, wired up as its __main__ block does"""
+
+    SERVER.LOGGER1 = logging.getLogger('bench.UDPHandler')
+    SERVER.AIRCON_HANDLER = SERVER.JSONtoACInterface(logging.getLogger('bench.JSONtoAC'), config)
+
+    server = SERVER.PooledUDPServer(('127.0.0.1', 0), SERVER.UDPHandler,
+                                    args.workers, args.max_inflight)
+    threading.Thread(name='bench_udp_server', target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def wait_connected(args, config, deadline):
+
+    """
+    Start the server and wait for every unit to authenticate with the
+    simulator, returns (server, names of units that did not by deadline)
+    """
+
+    started = []
+    thread = threading.Thread(name='bench_start', target=lambda: started.append(start_server(args, config)),
+                              daemon=True)
+    thread.start()
+    thread.join(max(0, deadline - time.time()))
+
+    if not started:
+        return None, [get_config.get_unit_name(section) for section in get_config.get_unit_sections(config)]
+
+    def waiting():
+        return [unit.name for unit in SERVER.AIRCON_HANDLER.units.units
+                if unit.link.state != AIRCON.STATE_READY]
+
+    while waiting() and time.time() < deadline:
+        time.sleep(0.05)
+
+    return started[0], waiting()
+
+
+def make_requests(args, units):
+
+    """Requests to send in order, mixed GET and SET as asked"""
+
+    rng = random.Random(args.seed)
+    requests = []
+
+    for i in range(int(args.rate * args.duration)):
+
+        if rng.random() < args.set_ratio:
+            key, values = rng.choice(SET_VALUES)
+            request = {'OPERATION': 'SET', key: rng.choice(values)}
+        else:
+            request = dict(GET_REQUEST)
+
+        if len(units) > 1:
+            request['UNIT'] = rng.choice(units)
+
+        request['ID'] = i
+        requests.append((request['OPERATION'], json.dumps(request).encode()))
+
+    return requests
+
+
+def client(address, requests, start, interval, timeout, results):
+
+    """Send requests at their scheduled times, one outstanding at a time"""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+
+    for due, (operation, request) in requests:
+
+        delay = start + due * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        sent = time.perf_counter()
+        sock.sendto(request, address)
+
+        try:
+            response = sock.recv(65536)
+        except socket.timeout:
+            results.append((operation, 'timeout', None, len(request), 0))
+            continue
+
+        latency = time.perf_counter() - sent
+        outcome = json.loads(response.decode()).get('RESPONSE', 'OK')
+        results.append((operation, outcome, latency, len(request), len(response)))
+
+    sock.close()
+
+
+def run_load(args, address, requests):
+
+    """Spread requests over args.concurrency clients, returns (results, elapsed)"""
+
+    results = []
+    interval = 1.0 / args.rate
+    start = time.perf_counter() + 0.1
+
+    schedule = list(enumerate(requests))
+    threads = [threading.Thread(target=client,
+                                args=(address, schedule[i::args.concurrency], start,
+                                      interval, args.timeout, results))
+               for i in range(args.concurrency)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.perf_counter() - start
+
+
+def parse_costs(requests, duid):
+
+    """Seconds per call of the parsing done for each request"""
+
+    rng = random.Random(0)
+    unit = ac_simulator.SimulatedUnit(duid, rng)
+    decoder = ac_response_decoder.ResponseDecoder(AIRCON.VALID_OPERATIONS)
+
+    device_state = unit.device_state()
+    control_echo = ac_simulator.CONTROL_TEMPLATE % (b'Okay', unit.quoted_duid, b'"cmd00001"')
+    sample = [request for _, request in requests[:100]]
+
+    def per_call(func, number=PARSE_ITERATIONS):
+        return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+    return {'json_loads': per_call(lambda: [json.loads(r.decode().upper()) for r in sample],
+                                   PARSE_ITERATIONS // 100) / len(sample),
+            'xml_device_state': per_call(lambda: decoder.decode(device_state)),
+            'xml_control_echo': per_call(lambda: decoder.decode(control_echo))}
+
+
+def queue_cost():
+
+    """Seconds for one item to cross a PollableQueue to a thread waiting in select()"""
+
+    forward = pollable_queue.PollableQueue()
+    back = pollable_queue.PollableQueue()
+
+    def echo():
+        while True:
+            select.select([forward], [], [])
+            for item in forward.drain():
+                back.put(item)
+                if item is None:
+                    return
+
+    thread = threading.Thread(target=echo)
+    thread.start()
+
+    started = time.perf_counter()
+    for i in range(QUEUE_ITERATIONS):
+        forward.put(i)
+        select.select([back], [], [])
+        back.drain()
+    elapsed = time.perf_counter() - started
+
+    forward.put(None)
+    thread.join()
+
+    #Each round trip is two hand-offs
+    return elapsed / QUEUE_ITERATIONS / 2
+
+
+def module_rtt(handler):
+    """Smoothed round trip time to the simulator seen by each unit"""
+    return {unit.name: getattr(getattr(unit, 'link', None), 'srtt', None)
+            for unit in handler.units.units}
+
+
+def latency_summary(latencies):
+    """Percentiles, mean and max of a list of latencies in seconds"""
+    latencies = sorted(latencies)
+    summary = {'p%d' % pct: percentile(latencies, pct) for pct in PERCENTILES}
+    summary['mean'] = sum(latencies) / len(latencies) if latencies else None
+    summary['max'] = latencies[-1] if latencies else None
+    return summary
+
+
+def summarise(args, results, elapsed, link, costs, rtts):
+
+    outcomes = {}
+    for _, outcome, _, _, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    completed = [r for r in results if r[2] is not None]
+    requests = len(results) or 1
+
+    return {
+        'revision': git_revision(),
+        'parameters': vars(args),
+        'requests': len(results),
+        'completed': len(completed),
+        'outcomes': outcomes,
+        'timeouts': outcomes.get('timeout', 0),
+        'throughput': len(completed) / elapsed if elapsed else None,
+        'latency': latency_summary([r[2] for r in completed]),
+        'latency_by_operation': {op: latency_summary([r[2] for r in completed if r[0] == op])
+                                 for op in sorted({r[0] for r in completed})},
+        'udp_bytes_per_request': sum(r[3] + r[4] for r in results) / requests,
+        'tls_bytes_per_request': link['bytes'] / requests,
+        #Most GETs are served from the status cache, this is how often the module was asked
+        'module_requests_per_request': link['requests'] / requests,
+        'module_drops': link['drops'],
+        #Cost of each step on the path, seconds per occurrence
+        'costs': {'json_parse': costs['json_loads'],
+                  'xml_parse_device_state': costs['xml_device_state'],
+                  'xml_parse_control_echo': costs['xml_control_echo'],
+                  'queue_handoff': costs['queue_handoff'],
+                  'module_rtt': rtts},
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='UDP to A/C end-to-end benchmark')
+    parser.add_argument('--rate', type=float, default=100, help='requests per second, all clients')
+    parser.add_argument('--concurrency', type=int, default=4, help='clients sending at once')
+    parser.add_argument('--duration', type=float, default=5, help='seconds')
+    parser.add_argument('--set-ratio', type=float, default=0.2, help='fraction of requests that are SET')
+    parser.add_argument('--timeout', type=float, default=AIRCON.RESPONSE_WAIT_TIME + 1)
+    parser.add_argument('--units', type=int, default=1)
+    parser.add_argument('--engine', choices=(SERVER.ENGINE_THREADS, SERVER.ENGINE_ASYNCIO),
+                        default=SERVER.ENGINE_THREADS)
+    parser.add_argument('--status-ttl', type=float, default=AIRCON.STATUS_TTL)
+    parser.add_argument('--workers', type=int, default=SERVER.MAX_WORKERS)
+    parser.add_argument('--max-inflight', type=int, default=SERVER.MAX_INFLIGHT)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated module latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--fragment-size', type=int, default=0)
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--connect-timeout', type=float, default=AIRCON.STARTUP_WAIT,
+                        help='seconds for every unit to authenticate before the run fails')
+    parser.add_argument('--cert', help='certificate for the simulator, generated if not given')
+    parser.add_argument('--key')
+    parser.add_argument('--output', default='bench_e2e_results.json', help='file for JSON results')
+    args = parser.parse_args()
+
+    duids = ac_simulator.generate_duids(args.units)
+    simulator = ac_simulator.ACSimulator(duids, latency=args.latency, jitter=args.jitter,
+                                         fragment_size=args.fragment_size,
+                                         drop_rate=args.drop_rate, seed=args.seed,
+                                         certfile=args.cert, keyfile=args.key)
+    port = simulator.serve_in_thread()
+
+    config = bench_config(args, port, duids)
+    server, waiting = wait_connected(args, config, time.time() + args.connect_timeout)
+
+    if waiting:
+        if server is not None:
+            server.server_close()
+            SERVER.AIRCON_HANDLER.shutdown()
+        simulator.stop()
+        sys.exit('Units %s did not authenticate with the simulator within %.0f seconds, '
+                 'see the log file in the [interface] section' % (', '.join(waiting), args.connect_timeout))
+
+    handler = SERVER.AIRCON_HANDLER
+
+    requests = make_requests(args, handler.units.names())
+
+    before = dict(simulator.stats)
+    results, elapsed = run_load(args, server.server_address, requests)
+    link = {key: simulator.stats[key] - before[key] for key in before}
+    link['bytes'] = link['bytes_sent'] + link['bytes_received']
+
+    costs = parse_costs(requests, duids[0])
+    costs['queue_handoff'] = queue_cost()
+
+    summary = summarise(args, results, elapsed, link, costs, module_rtt(handler))
+
+    server.shutdown()
+    server.server_close()
+    handler.shutdown()
+    simulator.stop()
+
+    output = json.dumps(summary, indent=2, sort_keys=True)
+
+    with open(args.output, 'w') as f:
+        f.write(output + '\n')
+
+    latency = summary['latency']
+    sys.stderr.write('%d/%d completed, %.1f req/s, p50 %s p95 %s p99 %s, %d timeouts\n' %
+                     (summary['completed'], summary['requests'], summary['throughput'] or 0,
+                      *['%.2f ms' % (latency[k] * 1000) if latency[k] is not None else '-'
+                        for k in ('p50', 'p95', 'p99')],
+                      summary['timeouts']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+"""
+Throughput benchmark: byte-per-item socketpair queue vs batched wakeup PollableQueue
+
+A producer thread puts items in bursts while the consumer waits in
+select(), as ACCommunications and AirConInterface do
+
+Usage: python3 benchmarks/bench_pollable_queue.py [items] [burst]
+"""
+
+import os
+import sys
+import time
+import queue
+import select
+import socket
+import threading
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(THIS_DIR))
+
+import pollable_queue
+
+STOP = None
+
+
+class LegacyPollableQueue(queue.Queue):
+
+    """PollableQueue before batched wakeups, one byte on a socketpair per item"""
+
+    def __init__(self):
+        queue.Queue.__init__(self)
+        self._putsocket, self._getsocket = socket.socketpair()
+
+    def fileno(self):
+        return self._getsocket.fileno()
+
+    def put(self, item):
+        queue.Queue.put(self, item)
+        self._putsocket.send(b'x')
+
+    def get(self):
+        self._getsocket.recv(1)
+        return queue.Queue.get(self)
+
+
+def produce(q, items, burst):
+
+    for start in range(0, items, burst):
+        for i in range(start, min(start + burst, items)):
+            q.put(i)
+        time.sleep(0) #Let the consumer run between bursts
+
+    q.put(STOP)
+
+
+def consume_one(q):
+
+    """One item per wakeup, the only way to use the legacy queue"""
+
+    wakeups = 0
+
+    while True:
+        select.select([q], [], [])
+        wakeups += 1
+        if q.get() is STOP:
+            return wakeups
+
+
+def consume_many(q):
+
+    """Every queued item per wakeup"""
+
+    wakeups = 0
+
+    while True:
+        select.select([q], [], [])
+        wakeups += 1
+        for item in q.drain():
+            if item is STOP:
+                return wakeups
+
+
+def run(q, consumer, items, burst):
+
+    producer = threading.Thread(target=produce, args=(q, items, burst))
+
+    started = time.perf_counter()
+    producer.start()
+    wakeups = consumer(q)
+    elapsed = time.perf_counter() - started
+    producer.join()
+
+    return items / elapsed, wakeups
+
+
+def main():
+
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    print('%d items in bursts of %d, wakeup via %s' %
+          (items, burst, 'eventfd' if pollable_queue.USE_EVENTFD else 'socketpair'))
+
+    results = (('legacy, get per wakeup', LegacyPollableQueue(), consume_one),
+               ('new, get per wakeup', pollable_queue.PollableQueue(), consume_one),
+               ('new, drain per wakeup', pollable_queue.PollableQueue(), consume_many))
+
+    baseline = None
+
+    for name, q, consumer in results:
+
+        rate, wakeups = run(q, consumer, items, burst)
+        baseline = baseline or rate
+
+        print('%-24s %10.0f items/s  %8d wakeups  %.2fx' % (name, rate, wakeups, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""
+Microbenchmark: ElementTree response parser vs event driven ResponseDecoder
+
+Usage: python3 benchmarks/bench_response_decoder.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(THIS_DIR))
+
+import ac_response_decoder
+
+VALID_IDS = ('AC_FUN_POWER', 'AC_FUN_OPMODE', 'AC_FUN_WINDLEVEL',
+             'AC_FUN_TEMPSET', 'AC_FUN_TEMPNOW', 'AuthToken')
+
+#Responses as recorded from the A/C WIFI module
+DEVICE_STATE = (
+    '<?xml version="1.0" encoding="utf-8" ?><Response Type="DeviceState" Status="Okay">'
+    '<DeviceState><Device DUID="7825AD109303" GroupID="AC" ModelID="AC" >'
+    '<Attr ID="AC_FUN_ENABLE" Type="RW" Value="Enable"/>'
+    '<Attr ID="AC_FUN_POWER" Type="RW" Value="On"/>'
+    '<Attr ID="AC_FUN_SUPPORTED" Type="R" Value="0"/>'
+    '<Attr ID="AC_FUN_OPMODE" Type="RW" Value="Cool"/>'
+    '<Attr ID="AC_FUN_TEMPSET" Type="RW" Value="24"/>'
+    '<Attr ID="AC_FUN_COMODE" Type="RW" Value="Off"/>'
+    '<Attr ID="AC_FUN_ERROR" Type="RW" Value="00000000"/>'
+    '<Attr ID="AC_FUN_TEMPNOW" Type="R" Value="26"/>'
+    '<Attr ID="AC_FUN_SLEEP" Type="RW" Value="0"/>'
+    '<Attr ID="AC_FUN_WINDLEVEL" Type="RW" Value="Auto"/>'
+    '<Attr ID="AC_FUN_DIRECTION" Type="RW" Value="Fixed"/>'
+    '<Attr ID="AC_ADD_AUTOCLEAN" Type="RW" Value="Off"/>'
+    '<Attr ID="AC_ADD_APMODE_END" Type="W" Value="0"/>'
+    '<Attr ID="AC_ADD_STARTWPS" Type="RW" Value="Default"/>'
+    '<Attr ID="AC_ADD_SPI" Type="RW" Value="Off"/>'
+    '<Attr ID="AC_SG_WIFI" Type="W" Value="Connected"/>'
+    '<Attr ID="AC_SG_INTERNET" Type="W" Value="Connected"/>'
+    '<Attr ID="AC_ADD2_VERSION" Type="RW" Value="0"/>'
+    '<Attr ID="AC_SG_MACHIGH" Type="W" Value="0"/>'
+    '<Attr ID="AC_SG_MACMID" Type="W" Value="0"/>'
+    '<Attr ID="AC_SG_MACLOW" Type="W" Value="0"/>'
+    '<Attr ID="AC_SG_VENDER01" Type="W" Value="0"/>'
+    '<Attr ID="AC_SG_VENDER02" Type="W" Value="0"/>'
+    '<Attr ID="AC_SG_VENDER03" Type="W" Value="0"/>'
+    '</Device></DeviceState></Response>')
+
+STATUS_UPDATE = (
+    '<?xml version="1.0" encoding="utf-8" ?><Update Type="Status">'
+    '<Status DUID="7825AD109303" GroupID="AC" ModelID="AC">'
+    '<Attr ID="AC_FUN_TEMPNOW" Value="25" /></Status></Update>')
+
+CONTROL_ECHO = (
+    '<?xml version="1.0" encoding="utf-8" ?><Response Type="DeviceControl" '
+    'Status="Okay" DUID="7825AD109303" CommandID="cmd00001"/>')
+
+PAYLOADS = (('DeviceState', DEVICE_STATE),
+            ('Status update', STATUS_UPDATE),
+            ('DeviceControl echo', CONTROL_ECHO))
+
+
+def legacy_parse(xml_string):
+
+    """AirConInterface.__parse_xml_input before ResponseDecoder"""
+
+    try:
+
+        root = ET.fromstring(xml_string)
+
+        if root.attrib['Type'] == 'AuthToken':
+            return [{'Type': root.attrib['Type'],
+                     'ID': 'AuthToken',
+                     'Value': root.attrib['Status']}]
+
+        func, value, all_attributes = None, None, []
+
+        for node in root.iter():
+
+            for n in node.keys():
+
+                if n == 'ID':
+                    func = node.get(n)
+                elif n == 'Value':
+                    value = node.get(n)
+
+            if func in VALID_IDS:
+                all_attributes.append({'Type': root.attrib['Type'],
+                                       'ID': func,
+                                       'Value': value})
+
+        return all_attributes
+
+    except (ET.ParseError, KeyError):
+        return None
+
+
+def main():
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    decoder = ac_response_decoder.ResponseDecoder(VALID_IDS)
+
+    for name, payload in PAYLOADS:
+
+        #Both parsers must agree on the resulting status
+        legacy = {a['ID']: a['Value'] for a in legacy_parse(payload)}
+        decoded = {ident: value for _, ident, value in decoder.decode(payload)
+                   if ident != ac_response_decoder.RESPONSE_COMMAND_ID}
+        assert legacy == decoded, (name, legacy, decoded)
+
+        legacy_time = min(timeit.repeat(lambda: legacy_parse(payload),
+                                        number=iterations, repeat=3))
+        decoder_time = min(timeit.repeat(lambda: decoder.decode(payload),
+                                         number=iterations, repeat=3))
+
+        print('%-20s %5d bytes  legacy %7.2f us  decoder %7.2f us  speedup %.2fx' %
+              (name, len(payload),
+               legacy_time / iterations * 1e6,
+               decoder_time / iterations * 1e6,
+               legacy_time / decoder_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+"""
+CPU and datagram size: JSON UDP requests vs the udp_codec binary encoding
+
+Times the server's side of a GET and a SET, decoding the request as
+UDPHandler does and encoding the status reply, for one unit and for
+ALL units
+
+Usage: python3 benchmarks/bench_udp_codec.py [iterations] [units]
+"""
+
+import os
+import sys
+import json
+import time
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(THIS_DIR))
+
+import udp_codec
+
+
+#Translated status as get_all_settings returns it
+STATUS = {'LAST_UPDATE': time.time() - 3, 'AC_CONNECTION_STATUS': 'ONLINE',
+          'POWER': 'On', 'MODE': 'Cool', 'FAN': 'Auto', 'TEMP': '22', 'CURRENT_TEMP': '27',
+          'AUTHENTICATION': 'Okay', 'UNCONFIRMED': []}
+
+
+def json_server(request, statuses):
+
+    """Decode a JSON request and encode its reply the way UDPHandler does"""
+
+    command = json.loads(request.strip().upper().decode())
+
+    if len(statuses) > 1:
+        response = {'UNITS': statuses}
+    else:
+        response = dict(next(iter(statuses.values())))
+
+    if 'ID' in command:
+        response['ID'] = command['ID']
+
+    return json.dumps(response).encode()
+
+
+def binary_server(request, statuses):
+
+    """Decode a binary request and encode its reply the way parse_binary does"""
+
+    opcode, request_id, _, _ = udp_codec.decode_request(request)
+    now = time.time()
+
+    return udp_codec.encode_response(opcode, request_id, udp_codec.RESULT_OK,
+                                     [udp_codec.encode_status(index, status, now)
+                                      for index, status in enumerate(statuses.values())])
+
+
+def measure(server, request, statuses, iterations):
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        response = server(request, statuses)
+    elapsed = time.perf_counter() - started
+
+    return elapsed / iterations * 1e6, len(request), len(response)
+
+
+def main():
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    units = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    one = {'UNIT0': STATUS}
+    every = {'UNIT%d' % i: STATUS for i in range(units)}
+
+    cases = (('GET one unit', one,
+              json.dumps({'OPERATION': 'GET', 'TYPE': 'SETTINGS', 'ID': 1}).encode(),
+              udp_codec.encode_request(udp_codec.OP_GET, 1)),
+             ('SET one unit', one,
+              json.dumps({'OPERATION': 'SET', 'POWER': 'On', 'MODE': 'Cool', 'TEMP': '22', 'ID': 1}).encode(),
+              udp_codec.encode_request(udp_codec.OP_SET, 1, settings={'POWER': 'On', 'MODE': 'Cool',
+                                                                       'TEMP': '22'})),
+             ('GET %d units' % units, every,
+              json.dumps({'OPERATION': 'GET', 'TYPE': 'SETTINGS', 'UNIT': 'ALL', 'ID': 1}).encode(),
+              udp_codec.encode_request(udp_codec.OP_GET, 1, udp_codec.UNIT_ALL)))
+
+    print('%d iterations, server side encode and decode only' % iterations)
+    print('%-14s %-7s %10s %9s %9s' % ('request', 'codec', 'us/req', 'req bytes', 'rsp bytes'))
+
+    for name, statuses, json_request, binary_request in cases:
+
+        json_result = measure(json_server, json_request, statuses, iterations)
+        binary_result = measure(binary_server, binary_request, statuses, iterations)
+
+        for codec, result in (('json', json_result), ('binary', binary_result)):
+            print('%-14s %-7s %10.2f %9d %9d' % ((name, codec) + result))
+
+        print('%-14s %-7s %9.1fx %8.1fx %8.1fx' % ('', 'ratio',
+                                                  json_result[0] / binary_result[0],
+                                                  json_result[1] / binary_result[1],
+                                                  json_result[2] / binary_result[2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Delayed and recurring SET commands
+
+Every schedule sits on the timer shared with status polling, so any
+number of them cost one heap entry each and no thread of their own.
+Schedules are saved to a JSON file whenever they change and reloaded on
+start, so they survive a restart of the server
+"""
+
+import os
+import json
+import time
+import threading
+import concurrent.futures
+
+import poll_scheduler
+
+MAX_SCHEDULES = 256
+MIN_REPEAT = 60 #seconds, shortest interval of a recurring schedule
+MISFIRE_GRACE = 300 #seconds, a one-off missed while stopped still runs if this late or less
+
+
+class Schedule(object):
+
+    """
+    Settings to apply to a unit at a time, then every repeat seconds if set
+
+    Args:
+    schedule_id: number identifying the schedule to clients
+    unit: unit name or DUID, ALL or None for the default unit
+    settings: dict of POWER/MODE/FAN/TEMP to value
+    at: time.time() to run at
+    repeat: seconds between runs, None to run once
+    """
+
+    __slots__ = ('schedule_id', 'unit', 'settings', 'at', 'repeat', 'handle')
+
+    def __init__(self, schedule_id, unit, settings, at, repeat=None):
+        self.schedule_id = schedule_id
+        self.unit = unit
+        self.settings = settings
+        self.at = at
+        self.repeat = repeat
+        self.handle = None
+
+    def to_dict(self):
+        return {'SCHEDULE': self.schedule_id, 'UNIT': self.unit, 'SETTINGS': self.settings,
+                'AT': self.at, 'REPEAT': self.repeat}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(int(data['SCHEDULE']), data.get('UNIT'), dict(data['SETTINGS']),
+                   float(data['AT']), data.get('REPEAT'))
+
+    def advance(self, now):
+        """Move a recurring schedule to its first run after now"""
+        if now >= self.at:
+            self.at += self.repeat * ((now - self.at) // self.repeat + 1)
+
+
+
+class CommandScheduler(object):
+
+    """
+    Run settings on A/C units at scheduled times
+
+    Args:
+    apply: called as apply(unit, settings) when a schedule is due,
+           returns True if the settings were sent
+    log: logger
+    path: JSON file schedules are kept in, None to keep them in memory only
+    wheel: poll_scheduler.TimerWheel to schedule on, the shared one if None
+    """
+
+    def __init__(self, apply, log, path=None, wheel=None):
+
+        self.apply = apply
+        self.logger = log
+        self.path = path
+        self.wheel = wheel or poll_scheduler.shared_wheel(log)
+
+        self.schedules = {} #schedule_id -> Schedule
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+        #Due schedules are applied here so a slow unit never delays the timer
+        self.runner = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                            thread_name_prefix='schedule_runner')
+
+        self.__load()
+
+
+    def __load(self):
+
+        """Reload saved schedules, running or dropping any missed while stopped"""
+
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                saved = [Schedule.from_dict(data) for data in json.load(f)]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.logger.exception('Unable to load schedules from %s', self.path)
+            return
+
+        now = time.time()
+
+        with self.lock:
+
+            for schedule in saved:
+
+                self.next_id = max(self.next_id, schedule.schedule_id + 1)
+
+                if schedule.repeat:
+                    schedule.advance(now)
+                elif schedule.at < now - MISFIRE_GRACE:
+                    self.logger.info('Dropping schedule %d, missed by %d seconds',
+                                     schedule.schedule_id, now - schedule.at)
+                    continue
+
+                self.__start(schedule)
+
+            self.__save()
+
+        self.logger.info('Loaded %d schedules', len(self.schedules))
+
+
+    def __save(self):
+
+        """Write every schedule to self.path, caller holds self.lock"""
+
+        if not self.path:
+            return
+
+        temp_path = self.path + '.tmp'
+
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump([s.to_dict() for s in self.schedules.values()], f)
+            #Replace in one step so a crash never leaves half a file
+            os.replace(temp_path, self.path)
+        except OSError:
+            self.logger.exception('Unable to save schedules to %s', self.path)
+
+
+    def __start(self, schedule):
+        """Put schedule on the timer, caller holds self.lock"""
+        self.schedules[schedule.schedule_id] = schedule
+        schedule.handle = self.wheel.call_at(schedule.at, lambda: self.runner.submit(self.__run, schedule))
+
+
+    def add(self, unit, settings, at, repeat=None):
+
+        """
+        Schedule settings for a unit
+
+        Returns:
+        Schedule, None if there are already MAX_SCHEDULES
+        """
+
+        if repeat is not None:
+            repeat = max(float(repeat), MIN_REPEAT)
+
+        with self.lock:
+
+            if len(self.schedules) >= MAX_SCHEDULES:
+                return None
+
+            schedule = Schedule(self.next_id, unit, settings, float(at), repeat)
+            self.next_id += 1
+
+            self.__start(schedule)
+            self.__save()
+
+        self.logger.info('Schedule %d: %s on %s at %s%s', schedule.schedule_id, settings,
+                         unit or 'default unit', time.ctime(schedule.at),
+                         ' every %d seconds' % repeat if repeat else '')
+
+        return schedule
+
+
+    def cancel(self, schedule_id):
+
+        """Remove a schedule, False if there is no such schedule"""
+
+        with self.lock:
+
+            schedule = self.schedules.pop(schedule_id, None)
+
+            if schedule is None:
+                return False
+
+            schedule.handle.cancel()
+            self.__save()
+
+        self.logger.info('Cancelled schedule %d', schedule_id)
+        return True
+
+
+    def list_schedules(self, unit=None):
+        """Schedules in the order they will run, only those for unit if given"""
+        with self.lock:
+            schedules = sorted(self.schedules.values(), key=lambda s: s.at)
+        return [s.to_dict() for s in schedules if unit is None or s.unit == unit]
+
+
+    def __run(self, schedule):
+
+        """Apply a due schedule, then put it back on the timer or forget it"""
+
+        with self.lock:
+            #Cancelled after it came due but before it ran
+            if self.schedules.get(schedule.schedule_id) is not schedule:
+                return
+
+        try:
+            success = self.apply(schedule.unit, schedule.settings)
+        except Exception:
+            self.logger.exception('Exception running schedule %d:', schedule.schedule_id)
+            success = False
+
+        self.logger.info('Schedule %d: %s on %s %s', schedule.schedule_id, schedule.settings,
+                         schedule.unit or 'default unit', 'sent' if success else 'failed')
+
+        with self.lock:
+
+            if self.schedules.get(schedule.schedule_id) is not schedule:
+                return
+
+            if schedule.repeat:
+                schedule.advance(time.time())
+                self.__start(schedule)
+            else:
+                del self.schedules[schedule.schedule_id]
+
+            self.__save()
+
+
+    def shutdown(self):
+        with self.lock:
+            for schedule in self.schedules.values():
+                schedule.handle.cancel()
+        self.runner.shutdown(wait=False)
@@ -0,0 +1,137 @@
+"""
+Track settings sent to A/C until the A/C confirms them
+
+Settings are published to status as soon as they are sent, so reads see
+them straight away. Until the A/C reports the same value, in a status
+update or by acknowledging a command carrying it, the setting is held as
+unconfirmed. Callers that want to know when a setting has taken effect
+wait on an Expectation.
+
+Settings are matched by value, not CommandID, because a command held
+while the link was down is coalesced into a new command with a new ID.
+"""
+
+import threading
+import time
+
+
+class Expectation(object):
+
+    """
+    Settings a caller is waiting for the A/C to confirm
+
+    Args:
+    attributes: dict of A/C attribute ID to value sent
+    callback: called with no arguments once every setting is confirmed,
+              from the thread handling the A/C's response
+    """
+
+    __slots__ = ('expected', 'pending', 'started', 'latency', 'callback')
+
+    def __init__(self, attributes, callback):
+        self.expected = dict(attributes)
+        self.pending = dict(attributes)
+        self.started = time.time()
+        self.latency = None #Seconds from sending to the last setting confirmed
+        self.callback = callback
+
+    def confirmed(self):
+        """Settings confirmed so far, dict of attribute ID to value"""
+        return {function: value for function, value in self.expected.items()
+                if function not in self.pending}
+
+    def done(self):
+        return not self.pending
+
+
+
+class CommandTracker(object):
+
+    """Unconfirmed settings of one unit and the callers waiting on them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.optimistic = {} #Attribute ID -> value in status that the A/C has not reported
+        self.expectations = []
+
+
+    def sent(self, attributes, callback=None):
+
+        """
+        Note settings sent to A/C
+
+        Args:
+        attributes: iterable of (attribute ID, value) pairs
+        callback: if given, an Expectation is returned that calls it once
+                  all of these settings are confirmed
+
+        Returns:
+        Expectation, or None if no callback was given
+        """
+
+        attributes = dict(attributes)
+        expectation = Expectation(attributes, callback) if callback else None
+
+        with self.lock:
+            self.optimistic.update(attributes)
+            if expectation is not None:
+                self.expectations.append(expectation)
+
+        return expectation
+
+
+    def reported(self, values, acknowledged=False):
+
+        """
+        Apply values the A/C has reported
+
+        Args:
+        values: dict of attribute ID to value
+        acknowledged: True if values are the settings of a command the A/C
+                      acknowledged, rather than values it reported in status
+        """
+
+        finished = []
+        now = time.time()
+
+        with self.lock:
+
+            for function, value in values.items():
+
+                optimistic = self.optimistic.get(function)
+
+                #A status report replaces the value in status whatever it is,
+                #an acknowledgement only confirms the value if it is the latest sent
+                if function in self.optimistic and (not acknowledged or optimistic == value):
+                    del self.optimistic[function]
+
+            if not self.expectations:
+                return
+
+            for expectation in self.expectations:
+
+                for function, value in values.items():
+                    if function in expectation.pending and expectation.pending[function] == value:
+                        del expectation.pending[function]
+
+                if expectation.done():
+                    expectation.latency = now - expectation.started
+                    finished.append(expectation)
+
+            if finished:
+                self.expectations = [e for e in self.expectations if not e.done()]
+
+        for expectation in finished:
+            expectation.callback()
+
+
+    def forget(self, expectation):
+        """Stop tracking an expectation whose caller has given up waiting"""
+        with self.lock:
+            if expectation in self.expectations:
+                self.expectations.remove(expectation)
+
+
+    def unconfirmed(self):
+        """Attribute IDs whose value in status the A/C has not confirmed"""
+        return list(self.optimistic)
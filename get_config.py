@@ -7,6 +7,10 @@ Process config file
 import configparser
 import os
 
+INTERFACE_SECTION = 'interface'
+UNIT_SECTION_PREFIX = 'unit:'
+DEFAULT_UNIT_NAME = 'DEFAULT'
+
 def get_config(config_file_name):
 
     """
@@ -41,3 +45,46 @@ def get_config(config_file_name):
         exit()
 
     return config
+
+
+def get_unit_sections(config):
+
+    """
+    Config sections describing A/C units
+
+    Each [unit:name] section is one unit, if there are none
+    the [interface] section is the only unit
+    """
+
+    sections = [s for s in config.sections() if s.startswith(UNIT_SECTION_PREFIX)]
+
+    return sections or [INTERFACE_SECTION]
+
+
+def get_unit_name(section):
+
+    """Name a unit is addressed by, e.g. BEDROOM for [unit:bedroom]"""
+
+    if section.startswith(UNIT_SECTION_PREFIX):
+        return section[len(UNIT_SECTION_PREFIX):].upper()
+
+    return DEFAULT_UNIT_NAME
+
+
+def get_unit_config(config, section):
+
+    """
+    Options for one A/C unit as a dict
+
+    [unit:name] sections inherit any option they do not set from [interface]
+    """
+
+    options = {}
+
+    if config.has_section(INTERFACE_SECTION):
+        options.update(config.items(INTERFACE_SECTION))
+
+    if section != INTERFACE_SECTION:
+        options.update(config.items(section))
+
+    return options
@@ -1,39 +1,178 @@
-"""Logging handler"""
+"""
+Logging handler
 
+Loggers put records on one queue, a single listener thread writes them
+to the console and to rotating log files, so disk and console I/O never
+block the socket monitor or the UDP handlers
+"""
+
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
 
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 1024 * 1024 #Rotate log files at this size
+LOG_BACKUP_COUNT = 5 #Rotated files kept
+REPEAT_WINDOW = 60 #seconds, the same exception is logged once in this time
+MAX_TRACKED_EXCEPTIONS = 256
 
-def get_log_handler(log_file_name, logging_level, logger_name):
+LEVELS = {'critical': logging.CRITICAL,
+          'error': logging.ERROR,
+          'warning': logging.WARNING,
+          'info': logging.INFO,
+          'debug': logging.DEBUG,
+          'notset': logging.NOTSET}
 
-    """Create a loghandler that logs to file and to console"""
 
-    lvl = logging_level.lower()
+class RepeatedExceptionFilter(logging.Filter):
+
+    """
+    Pass the first of a run of identical exceptions, drop the rest for
+    REPEAT_WINDOW seconds and note how many were dropped on the next one
+    """
+
+    def __init__(self, window=REPEAT_WINDOW):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.seen = {} #(logger, message, exception type, text) -> [first logged, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+
+        if not record.exc_info or record.exc_info[1] is None:
+            return True
+
+        error = record.exc_info[1]
+        key = (record.name, record.msg, type(error), str(error))
+
+        with self.lock:
+
+            entry = self.seen.get(key)
+
+            if entry is not None and record.created - entry[0] < self.window:
+                entry[1] += 1
+                return False
+
+            suppressed = entry[1] if entry is not None else 0
+            self.seen[key] = [record.created, 0]
+
+            if len(self.seen) > MAX_TRACKED_EXCEPTIONS:
+                self.seen = {k: v for k, v in self.seen.items()
+                             if record.created - v[0] < self.window}
+
+        if suppressed:
+            record.msg = '%s (%d repeats suppressed)' % (record.msg, suppressed)
+
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    """
+    Hand records to the listener with as little work as possible
+
+    The message is rendered here so later changes to its arguments do
+    not show up in the log, the traceback is left for the listener
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class _FileRouter(logging.Handler):
+
+    """Write each record to the log file of the logger that made it"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.files = {} #log file name -> handler
+        self.by_logger = {} #logger name -> handler
 
-    if lvl == 'critical':
-        lvl = logging.CRITICAL
-    elif lvl == 'error':
-        lvl = logging.ERROR
-    elif lvl == 'warning':
-        lvl = logging.WARNING
-    elif lvl == 'info':
-        lvl = logging.INFO
-    elif lvl == 'debug':
-        lvl = logging.DEBUG
-    elif lvl == 'notset':
-        lvl = logging.NOTSET
+    def add(self, logger_name, log_file_name, formatter):
 
-    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        handler = self.files.get(log_file_name)
 
-    formatter = logging.Formatter(log_format)
+        if handler is None:
+            handler = logging.handlers.RotatingFileHandler(log_file_name,
+                                                           maxBytes=LOG_MAX_BYTES,
+                                                           backupCount=LOG_BACKUP_COUNT)
+            handler.setFormatter(formatter)
+            self.files[log_file_name] = handler
 
-    logging.basicConfig(filename=log_file_name, level=lvl, format=log_format)
+        self.by_logger[logger_name] = handler
 
-    logger = logging.getLogger(logger_name)
+    def emit(self, record):
+        handler = self.by_logger.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        logging.Handler.close(self)
+
+
+_setup_lock = threading.Lock()
+_queue_handler = None
+_file_router = None
+_listener = None
+
+
+def _start_listener():
+
+    """Shared queue, listener thread and handlers, created on first use"""
+
+    global _queue_handler, _file_router, _listener
+
+    formatter = logging.Formatter(LOG_FORMAT)
 
     log_console = logging.StreamHandler(sys.stdout)
     log_console.setFormatter(formatter)
 
-    logger.addHandler(log_console)
+    _file_router = _FileRouter()
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = _QueueHandler(log_queue)
+    _queue_handler.addFilter(RepeatedExceptionFilter())
+
+    _listener = logging.handlers.QueueListener(log_queue, log_console, _file_router)
+    _listener.start()
+
+    atexit.register(stop)
+
+
+def stop():
+    """Write out queued records and stop the listener thread"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _file_router.close()
+            _listener = None
+
+
+def get_log_handler(log_file_name, logging_level, logger_name):
+
+    """Create a loghandler that logs to file and to console"""
+
+    with _setup_lock:
+
+        if _listener is None:
+            _start_listener()
+
+        _file_router.add(logger_name, log_file_name, logging.Formatter(LOG_FORMAT))
+
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(LEVELS.get(logging_level.lower(), logging.NOTSET))
+
+        #Records go to the shared queue only, not also to any root handlers
+        if _queue_handler not in logger.handlers:
+            logger.addHandler(_queue_handler)
+        logger.propagate = False
 
     return logger
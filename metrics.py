@@ -0,0 +1,254 @@
+"""
+In-process counters, gauges and histograms
+
+Recording is a lock and an addition, reading is done on request by the
+UDP METRICS command or the optional Prometheus text endpoint
+"""
+
+import bisect
+import threading
+import http.server
+
+#Seconds, suits both local work (sub-millisecond) and A/C round trips (tens of ms to seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PROMETHEUS_PATH = '/metrics'
+
+
+def _label_text(labels):
+    """Labels as name="value" pairs in a stable order"""
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels)
+
+
+class Counter(object):
+
+    """Value that only goes up"""
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+
+class Gauge(object):
+
+    """Value that goes up and down, or is read from a function when collected"""
+
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Read value from function when collected, nothing to do on the hot path"""
+        self.function = function
+
+    def collect(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return None
+        return self.value
+
+
+class Histogram(object):
+
+    """Count of observations in fixed buckets, with their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1) #Last is above the largest bound
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def collect(self):
+
+        """dict of count, sum and cumulative count at or below each bound"""
+
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        buckets = {}
+        running = 0
+        for bound, count in zip(self.bounds, counts):
+            running += count
+            buckets[repr(bound)] = running
+
+        return {'count': sum(counts), 'sum': total, 'buckets': buckets}
+
+
+
+class MetricsRegistry(object):
+
+    """
+    Every metric in the process, by name and labels
+
+    Asking for a metric that already exists returns it, so modules
+    can look up their metrics without sharing references
+    """
+
+    def __init__(self):
+        self.metrics = {} #name -> {labels tuple: metric}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def __get(self, cls, name, help_text, labels, *args):
+
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+
+            family = self.metrics.setdefault(name, {})
+            metric = family.get(key)
+
+            if metric is None:
+                metric = family[key] = cls(*args)
+                self.help.setdefault(name, help_text)
+
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self.__get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', **labels):
+        return self.__get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+        return self.__get(Histogram, name, help_text, labels, buckets)
+
+    def __families(self):
+        with self.lock:
+            return [(name, list(family.items())) for name, family in sorted(self.metrics.items())]
+
+    def snapshot(self):
+
+        """
+        Current value of every metric
+
+        Returns:
+        dict of metric name to dict of 'label=value,...' ('' if none) to value
+        """
+
+        return {name: {','.join('%s=%s' % label for label in labels): metric.collect()
+                       for labels, metric in family}
+                for name, family in self.__families()}
+
+    def prometheus(self):
+
+        """Every metric in Prometheus text exposition format"""
+
+        lines = []
+
+        for name, family in self.__families():
+
+            if not family:
+                continue
+
+            lines.append('# HELP %s %s' % (name, self.help.get(name, '')))
+            lines.append('# TYPE %s %s' % (name, family[0][1].kind))
+
+            for labels, metric in family:
+
+                value = metric.collect()
+
+                if metric.kind != 'histogram':
+                    if value is not None:
+                        lines.append('%s%s %s' % (name, _braces(_label_text(labels)), value))
+                    continue
+
+                for bound, count in list(value['buckets'].items()) + [('+Inf', value['count'])]:
+                    lines.append('%s_bucket%s %d' % (name, _braces(_label_text(labels + (('le', bound),))),
+                                                     count))
+                lines.append('%s_sum%s %s' % (name, _braces(_label_text(labels)), value['sum']))
+                lines.append('%s_count%s %d' % (name, _braces(_label_text(labels)), value['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _braces(text):
+    return '{%s}' % text if text else ''
+
+
+#Registry used by every module in the process
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help_text='', **labels):
+    return REGISTRY.counter(name, help_text, **labels)
+
+def gauge(name, help_text='', **labels):
+    return REGISTRY.gauge(name, help_text, **labels)
+
+def histogram(name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help_text, buckets, **labels)
+
+
+
+class PrometheusHandler(http.server.BaseHTTPRequestHandler):
+
+    """Serve the registry on PROMETHEUS_PATH"""
+
+    registry = REGISTRY
+
+    def do_GET(self):
+
+        if self.path.split('?')[0] != PROMETHEUS_PATH:
+            self.send_error(404)
+            return
+
+        body = self.registry.prometheus().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        #Scrapes are not worth a line in the log
+        pass
+
+
+def start_http_server(host, port, registry=REGISTRY):
+
+    """Serve Prometheus text on http://host:port/metrics from a daemon thread"""
+
+    handler = type('RegistryHandler', (PrometheusHandler,), {'registry': registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(name='metrics_http_server', target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -0,0 +1,314 @@
+"""
+Status polling for every A/C unit from one timer thread
+
+TimerWheel runs callbacks at given times from a heap, so any number of
+units share a single long lived thread rather than a Timer thread each.
+AdaptivePoller decides when a unit is next asked for its status: quickly
+after a command, more often while the room temperature is moving, less
+often while nothing changes and nobody is reading, and not at all while
+the A/C has recently sent its full status unprompted
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+
+POLL_INTERVAL = 60 #seconds, between polls of a unit that is read or changing
+MAX_POLL_INTERVAL = 300 #seconds, idle units back off to this
+FAST_POLL_INTERVAL = 2 #seconds, after a command until CONFIRM_WINDOW ends
+CONFIRM_WINDOW = 10 #seconds after a command
+RAMP_POLL_INTERVAL = 20 #seconds, while room temperature changed within RAMP_WINDOW
+RAMP_WINDOW = 120 #seconds
+SKIP_FRACTION = 0.5 #Skip a poll if full status is younger than this fraction of the interval
+
+CURRENT_TEMP = 'AC_FUN_TEMPNOW'
+LAST_UPDATE = 'LAST_UPDATE'
+
+
+class TimerHandle(object):
+
+    """A scheduled callback, cancel() stops it running if it has not yet"""
+
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+
+class TimerWheel(object):
+
+    """
+    Run callbacks at set times from a single thread
+
+    Callbacks must be quick, anything slow should be handed to another
+    thread or queue. Cancelled handles are left in the heap and dropped
+    when they come due
+
+    Args:
+    log: logger for callbacks that raise
+    name: thread name
+    """
+
+    def __init__(self, log, name='timer_wheel'):
+
+        self.logger = log
+        self.heap = [] #(when, sequence, handle)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(name=name, target=self.__run, daemon=True)
+        self.thread.start()
+
+
+    def call_at(self, when, callback):
+
+        """Run callback at time.time() == when, returns a TimerHandle"""
+
+        handle = TimerHandle(when, callback)
+
+        with self.condition:
+            heapq.heappush(self.heap, (when, next(self.sequence), handle))
+            #Only wake the thread if this is now the first callback due
+            if self.heap[0][2] is handle:
+                self.condition.notify()
+
+        return handle
+
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.time() + delay, callback)
+
+
+    def __next_due(self):
+
+        """Pop the next callback due, waiting for it, None once stopped"""
+
+        with self.condition:
+
+            while self.running:
+
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                when, _, handle = self.heap[0]
+
+                if handle.cancelled:
+                    heapq.heappop(self.heap)
+                    continue
+
+                delay = when - time.time()
+
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.heap)
+                return handle
+
+        return None
+
+
+    def __run(self):
+
+        while True:
+
+            handle = self.__next_due()
+
+            if handle is None:
+                return
+
+            try:
+                handle.callback()
+            except Exception:
+                #One unit's failure must not stop every other unit's timers
+                self.logger.exception('Exception in timer callback %r', handle.callback)
+
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+
+_wheel = None
+_wheel_lock = threading.Lock()
+
+
+def shared_wheel(log):
+
+    """
+    TimerWheel shared by everything in the process, started on first use
+
+    Args:
+    log: logger for failing callbacks, kept if this call starts the wheel
+    """
+
+    global _wheel
+
+    with _wheel_lock:
+        if _wheel is None:
+            _wheel = TimerWheel(log)
+
+    return _wheel
+
+
+
+class AdaptivePoller(object):
+
+    """
+    Poll one unit's status at an interval that follows its activity
+
+    Args:
+    status: the unit's ac_status.StatusRecord, watched for changes
+    poll: called with no arguments to request status, must not block
+    log: logger
+    name: unit name, for metrics
+    interval: poll interval of a unit that is being read or is changing
+    max_interval: longest interval an idle unit backs off to
+    wheel: TimerWheel to schedule on, the shared one if None
+    """
+
+    def __init__(self, status, poll, log, name, interval=POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL, wheel=None):
+
+        self.status = status
+        self.poll = poll
+        self.logger = log
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.wheel = wheel or shared_wheel(log)
+
+        self.lock = threading.Lock()
+        self.handle = None
+        self.command_at = float(0) #Last command sent
+        self.ramp_at = float(0) #Last change of room temperature
+        self.idle_polls = 0 #Polls since anything changed or was read
+
+        polls = 'ac_status_polls_total'
+        polls_help = 'Scheduled status polls, sent or skipped as status was recent'
+        self.metric_polls_sent = metrics.counter(polls, polls_help, unit=name, result='sent')
+        self.metric_polls_skipped = metrics.counter(polls, polls_help, unit=name, result='skipped')
+        metrics.gauge('ac_poll_interval_seconds', 'Current interval between status polls',
+                      unit=name).set_function(self.next_interval)
+
+        self.status.subscribe(self.__status_changed)
+
+
+    def start(self):
+        """Poll now, then adaptively"""
+        self.__schedule(0)
+
+
+    def stop(self):
+        self.status.unsubscribe(self.__status_changed)
+        with self.lock:
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+
+
+    def command_sent(self):
+        """Poll quickly to confirm a command took effect"""
+        self.command_at = time.time()
+        self.idle_polls = 0
+        self.__schedule(FAST_POLL_INTERVAL)
+
+
+    def status_read(self):
+        """Someone wants this unit's status, stop backing off"""
+        if self.idle_polls:
+            self.idle_polls = 0
+            self.__schedule(self.next_interval())
+
+
+    def __status_changed(self, previous, current):
+
+        """StatusRecord observer, runs on the publishing thread"""
+
+        changed = [key for key, index in current.fields.items()
+                   if key != LAST_UPDATE and current.values[index] != previous.values[index]]
+
+        if not changed:
+            return
+
+        self.idle_polls = 0
+
+        if CURRENT_TEMP in changed and previous[CURRENT_TEMP]:
+            self.ramp_at = time.time()
+
+        #A unit backed off while idle should be polled sooner now it is changing
+        self.__schedule(self.next_interval())
+
+
+    def next_interval(self, now=None):
+
+        """Seconds until the next poll"""
+
+        now = now or time.time()
+
+        if now - self.command_at < CONFIRM_WINDOW:
+            return FAST_POLL_INTERVAL
+
+        if now - self.ramp_at < RAMP_WINDOW:
+            return min(RAMP_POLL_INTERVAL, self.interval)
+
+        return min(self.interval * 2 ** min(self.idle_polls, 16), self.max_interval)
+
+
+    def __schedule(self, delay):
+
+        """Poll in delay seconds, unless a poll is already due sooner"""
+
+        when = time.time() + delay
+
+        with self.lock:
+
+            if self.handle is not None:
+                if self.handle.when <= when:
+                    return
+                self.handle.cancel()
+
+            self.handle = self.wheel.call_at(when, self.__poll)
+
+
+    def __poll(self):
+
+        """Timer callback, request status if the last full status is old enough"""
+
+        with self.lock:
+            self.handle = None
+
+        now = time.time()
+        interval = self.next_interval(now)
+        age = now - (self.status[LAST_UPDATE] or 0)
+
+        if age < interval * SKIP_FRACTION:
+            #The A/C sent its status recently without being asked
+            self.metric_polls_skipped.inc()
+            self.__schedule(interval - age)
+            return
+
+        self.metric_polls_sent.inc()
+
+        #Back off only while polling at the normal rate
+        if interval >= self.interval:
+            self.idle_polls += 1
+
+        try:
+            self.poll()
+        except Exception:
+            self.logger.exception('Exception polling status:')
+
+        self.__schedule(interval)
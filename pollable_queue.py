@@ -3,17 +3,39 @@ Source:
 http://chimera.labs.oreilly.com/books/1230000000393/ch12.html#_solution_209
 
 Tweaked by me to make it work
+
+Wakeups are batched: the file descriptor becomes readable when the queue
+goes from empty to non-empty and is cleared when it is emptied again, so
+a burst of items costs one wakeup rather than one per item
 """
 
 import queue
 import socket
 import os
 
+#Linux has eventfd, a single kernel counter instead of a pair of sockets
+USE_EVENTFD = hasattr(os, 'eventfd')
+
+WAKEUP_BYTE = b'x'
+WAKEUP_DRAIN_SIZE = 64 #bytes read per call when clearing a socket wakeup
+
+
 class PollableQueue(queue.Queue):
 
-    def __init__(self):
+    """Queue that can be passed to select(), readable while it holds items"""
+
+    def __init__(self, maxsize=0):
+
+        queue.Queue.__init__(self, maxsize)
 
-        queue.Queue.__init__(self)
+        self._signalled = False #True while the wakeup fd is readable, guarded by self.mutex
+
+        if USE_EVENTFD:
+            self._eventfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._putsocket = self._getsocket = None
+            return
+
+        self._eventfd = None
 
         # Create a pair of connected sockets
         if os.name == 'posix':
@@ -28,13 +50,68 @@ class PollableQueue(queue.Queue):
             self._getsocket, _ = server.accept()
             server.close()
 
+        self._getsocket.setblocking(False)
+
     def fileno(self):
+        if self._eventfd is not None:
+            return self._eventfd
         return self._getsocket.fileno()
 
-    def put(self, item):
-        queue.Queue.put(self, item)
-        self._putsocket.send(b'x')
+    def __signal(self):
+        """Make fileno readable, caller holds self.mutex"""
+        if self._eventfd is not None:
+            os.eventfd_write(self._eventfd, 1)
+        else:
+            self._putsocket.send(WAKEUP_BYTE)
+        self._signalled = True
+
+    def __clear(self):
+        """Make fileno unreadable, caller holds self.mutex"""
+        try:
+            if self._eventfd is not None:
+                os.eventfd_read(self._eventfd)
+            else:
+                while self._getsocket.recv(WAKEUP_DRAIN_SIZE):
+                    pass
+        except BlockingIOError:
+            pass
+        self._signalled = False
+
+    #Queue.put and Queue.get call these with self.mutex held
+
+    def _put(self, item):
+        queue.Queue._put(self, item)
+        if not self._signalled:
+            self.__signal()
+
+    def _get(self):
+        item = queue.Queue._get(self)
+        if not self.queue and self._signalled:
+            self.__clear()
+        return item
+
+    def get_many(self, max_items=None):
+
+        """
+        Remove up to max_items without blocking, all queued items if None
+
+        Returns:
+        list of items, empty if the queue is empty
+        """
+
+        with self.not_empty:
+
+            count = len(self.queue)
+            if max_items is not None:
+                count = min(count, max_items)
+
+            items = [self._get() for _ in range(count)]
+
+            if items:
+                self.not_full.notify(len(items))
+
+        return items
 
-    def get(self):
-        self._getsocket.recv(1)
-        return queue.Queue.get(self)
+    def drain(self):
+        """Remove and return every queued item without blocking"""
+        return self.get_many()
@@ -0,0 +1,323 @@
+"""
+Append-only history of A/C status, one file of fixed width records per DUID
+
+Records are queued by the receive path and written by a background
+thread. Files are rotated to <DUID>.bin.1 at a size limit, the same way
+log files are, and queries map both and read only the records in range
+"""
+
+import os
+import mmap
+import bisect
+import struct
+import threading
+import queue
+import time
+
+#timestamp, power, mode, fan, set temperature, room temperature, padding to 16 bytes
+RECORD = struct.Struct('<dBBBbb3x')
+RECORD_SIZE = RECORD.size
+FILE_SUFFIX = '.bin'
+ROTATED_SUFFIX = '.1'
+
+MAX_BYTES = 8 * 1024 * 1024 #Rotate a unit's file at this size, 0 never
+MAX_POINTS = 500 #Largest query result, longer ranges are downsampled to fit
+UNKNOWN = 255
+UNKNOWN_TEMP = -128
+
+POWER = 'AC_FUN_POWER'
+MODE = 'AC_FUN_OPMODE'
+FAN = 'AC_FUN_WINDLEVEL'
+TEMP = 'AC_FUN_TEMPSET'
+CURRENT_TEMP = 'AC_FUN_TEMPNOW'
+
+#Settings are stored as their index in these, new values must be appended.
+#Values are spelled as in status, where fan mode is Fan rather than the A/C's Wind
+POWER_VALUES = ('Off', 'On')
+MODE_VALUES = ('Auto', 'Cool', 'Dry', 'Fan', 'Heat')
+FAN_VALUES = ('Auto', 'Low', 'Mid', 'High', 'Turbo')
+
+TIME_KEY = 'TIME'
+
+
+def _index(values, value):
+    try:
+        return values.index(value)
+    except ValueError:
+        return UNKNOWN
+
+
+def _temp(value):
+    try:
+        temp = int(value)
+    except (TypeError, ValueError):
+        return UNKNOWN_TEMP
+    return max(-127, min(127, temp))
+
+
+def encode(timestamp, status):
+
+    """Fixed width record for a status dict keyed by A/C attribute ID"""
+
+    return RECORD.pack(timestamp,
+                       _index(POWER_VALUES, status.get(POWER)),
+                       _index(MODE_VALUES, status.get(MODE)),
+                       _index(FAN_VALUES, status.get(FAN)),
+                       _temp(status.get(TEMP)),
+                       _temp(status.get(CURRENT_TEMP)))
+
+
+def _value(values, index):
+    return values[index] if index < len(values) else None
+
+
+def decode(timestamp, power, mode, fan, temp, current_temp):
+
+    """Query result for one unpacked record"""
+
+    return {TIME_KEY: timestamp,
+            'POWER': _value(POWER_VALUES, power),
+            'MODE': _value(MODE_VALUES, mode),
+            'FAN': _value(FAN_VALUES, fan),
+            'TEMP': None if temp == UNKNOWN_TEMP else temp,
+            'CURRENT_TEMP': None if current_temp == UNKNOWN_TEMP else current_temp}
+
+
+class _Timestamps(object):
+
+    """Timestamps of the records in a buffer or mapped file, as a sequence for bisect"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // RECORD_SIZE
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<d', self.data, index * RECORD_SIZE)[0]
+
+
+def downsample(points, step):
+
+    """
+    One point per step seconds: mean of temperatures, last of settings
+
+    Args:
+    points: decoded records in time order
+    step: bucket width in seconds
+    """
+
+    result = []
+    bucket = None
+    sums = None
+
+    for point in points:
+
+        key = int(point[TIME_KEY] // step)
+
+        if key != bucket:
+            if sums is not None:
+                result.append(_close_bucket(current, sums))
+            bucket = key
+            sums = {'TEMP': [0, 0], 'CURRENT_TEMP': [0, 0]}
+
+        current = dict(point, **{TIME_KEY: bucket * step})
+
+        for name, total in sums.items():
+            if point[name] is not None:
+                total[0] += point[name]
+                total[1] += 1
+
+    if sums is not None:
+        result.append(_close_bucket(current, sums))
+
+    return result
+
+
+def _close_bucket(point, sums):
+    for name, (total, count) in sums.items():
+        point[name] = round(total / count, 1) if count else None
+    return point
+
+
+
+class StatusHistory(object):
+
+    """
+    History of every unit's status under one directory
+
+    Args:
+    directory: where <DUID>.bin files are kept, created if missing
+    max_bytes: size at which a unit's file is rotated, 0 never
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = queue.SimpleQueue()
+        self.files = {} #DUID -> open file, used by the writer thread only
+        self.file_lock = threading.Lock() #Held while a file is rotated
+
+        self.writer = threading.Thread(name='status_history_writer', target=self.__write, daemon=True)
+        self.writer.start()
+
+
+    def __path(self, duid):
+        return os.path.join(self.directory, duid.upper() + FILE_SUFFIX)
+
+
+    def record(self, duid, status, timestamp=None):
+
+        """Queue one status sample, never blocks"""
+
+        self.queue.put((duid.upper(), timestamp or time.time(), status))
+
+
+    def __write(self):
+
+        """Append queued samples, writing each file once per batch"""
+
+        while True:
+
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            pending = {}
+            stopping = False
+
+            for item in batch:
+
+                if item is None:
+                    stopping = True
+                    continue
+
+                duid, timestamp, status = item
+                pending.setdefault(duid, []).append(encode(timestamp, status))
+
+            for duid, records in pending.items():
+                try:
+                    self.__append(duid, b''.join(records))
+                except OSError:
+                    #History is best effort, the A/C link must not suffer for it
+                    pass
+
+            if stopping:
+                self.__close()
+                return
+
+
+    def __append(self, duid, data):
+
+        f = self.files.get(duid)
+        if f is None:
+            f = self.files[duid] = open(self.__path(duid), 'ab')
+
+        f.write(data)
+        f.flush()
+
+        if self.max_bytes and f.tell() >= self.max_bytes:
+
+            f.close()
+            del self.files[duid]
+
+            path = self.__path(duid)
+            with self.file_lock:
+                os.replace(path, path + ROTATED_SUFFIX)
+
+
+    def __close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+    def close(self):
+        """Write out queued samples and stop the writer"""
+        self.queue.put(None)
+        self.writer.join()
+
+
+    def __map(self, duid):
+
+        """Every file of duid mapped read-only, oldest first"""
+
+        path = self.__path(duid)
+        maps = []
+
+        #Both files are mapped before a rotation can move one of them
+        with self.file_lock:
+            for name in (path + ROTATED_SUFFIX, path):
+                try:
+                    with open(name, 'rb') as f:
+                        #Drop a partly written last record
+                        size = os.fstat(f.fileno()).st_size
+                        size -= size % RECORD_SIZE
+                        if size:
+                            maps.append(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ))
+                except FileNotFoundError:
+                    continue
+
+        return maps
+
+
+    def query(self, duid, start, end, step=None):
+
+        """
+        Status samples for a unit between two times
+
+        Args:
+        duid: unit to query
+        start, end: range of timestamps, inclusive
+        step: downsample to one point per step seconds, chosen to
+              return at most MAX_POINTS if None or too small
+
+        Returns:
+        list of dicts of TIME and the status at that time
+        """
+
+        chunks = []
+
+        for data in self.__map(duid):
+            with data:
+                #Bisect touches a few pages, only the records in range are copied
+                times = _Timestamps(data)
+                first = bisect.bisect_left(times, start)
+                last = bisect.bisect_right(times, end)
+                chunks.append(data[first * RECORD_SIZE:last * RECORD_SIZE])
+
+        if sum(len(chunk) for chunk in chunks) // RECORD_SIZE > MAX_POINTS:
+            step = max(step or 0, (end - start) / MAX_POINTS)
+
+        points = (decode(*fields) for chunk in chunks for fields in RECORD.iter_unpack(chunk))
+
+        if step:
+            points = downsample(points, step)
+
+        return list(points)[-MAX_POINTS:]
+
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(directory, max_bytes=MAX_BYTES):
+
+    """StatusHistory for a directory, shared by everything in the process using it"""
+
+    directory = os.path.abspath(directory)
+
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = StatusHistory(directory, max_bytes)
+
+    return store
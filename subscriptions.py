@@ -0,0 +1,158 @@
+"""Push A/C status changes to UDP clients holding a subscription lease"""
+
+import json
+import queue
+import threading
+import time
+
+import aircon_interface as AIRCON
+import metrics
+
+DEFAULT_LEASE = 300 #seconds
+MAX_LEASE = 3600 #seconds
+MAX_SUBSCRIBERS = 64
+
+#Fields that change with every poll, not worth a push on their own
+IGNORED_FIELDS = frozenset((AIRCON.LAST_UPDATE,))
+
+
+def changes(previous, current):
+
+    """Translated fields that differ between two snapshots of the same record"""
+
+    delta = {}
+
+    for key, index in current.fields.items():
+        value = current.values[index]
+        if value != previous.values[index] and key not in IGNORED_FIELDS:
+            delta[AIRCON.TRANSLATE.get(key, key)] = value
+
+    return delta
+
+
+class Subscription(object):
+
+    """One client address and the units it wants updates for, None for all"""
+
+    __slots__ = ('sock', 'address', 'units', 'expires')
+
+    def __init__(self, sock, address, units, expires):
+        self.sock = sock
+        self.address = address
+        self.units = units
+        self.expires = expires
+
+
+
+class SubscriptionManager(object):
+
+    """
+    Subscriptions to the status of every unit in a registry
+
+    Status records call back on each publish, the snapshots are queued
+    and a sender thread turns them into change-only deltas for every
+    subscriber. Subscriptions lapse unless renewed before their lease ends
+
+    Args:
+    units: objects with name and status (an ac_status.StatusRecord)
+    log: logger
+    """
+
+    def __init__(self, units, log):
+
+        self.logger = log
+        self.subscribers = {} #address -> Subscription
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+
+        self.metric_pushes = metrics.counter('udp_status_pushes_total', 'Status deltas sent to subscribers')
+        metrics.gauge('udp_subscribers', 'Clients holding a subscription lease').set_function(
+            lambda: len(self.subscribers))
+
+        self.observers = []
+        for unit in units:
+            observer = lambda previous, current, name=unit.name: self.queue.put((name, previous, current))
+            unit.status.subscribe(observer)
+            self.observers.append((unit.status, observer))
+
+        self.sender = threading.Thread(name='status_push', target=self.__send, daemon=True)
+        self.sender.start()
+
+
+    def subscribe(self, sock, address, units=None, lease=DEFAULT_LEASE):
+
+        """
+        Start or renew a subscription
+
+        Args:
+        sock: socket to send updates on
+        address: client address
+        units: set of unit names, None for every unit
+        lease: seconds until the subscription lapses, capped at MAX_LEASE
+
+        Returns:
+        Lease granted in seconds, None if there are too many subscribers
+        """
+
+        lease = max(1, min(float(lease), MAX_LEASE))
+        now = time.time()
+
+        with self.lock:
+
+            self.__expire(now)
+
+            if address not in self.subscribers and len(self.subscribers) >= MAX_SUBSCRIBERS:
+                return None
+
+            self.subscribers[address] = Subscription(sock, address, units, now + lease)
+
+        self.logger.debug('%s subscribed to %s for %d seconds', address, units or 'all units', lease)
+        return lease
+
+
+    def unsubscribe(self, address):
+        with self.lock:
+            return self.subscribers.pop(address, None) is not None
+
+
+    def __expire(self, now):
+        """Drop lapsed subscriptions, caller holds self.lock"""
+        for address in [a for a, s in self.subscribers.items() if s.expires <= now]:
+            self.logger.debug('Subscription for %s lapsed', address)
+            del self.subscribers[address]
+
+
+    def __send(self):
+
+        """Send each change to every subscriber of its unit"""
+
+        while True:
+
+            item = self.queue.get()
+            if item is None:
+                return
+
+            name, previous, current = item
+            delta = changes(previous, current)
+
+            if not delta:
+                continue
+
+            payload = json.dumps({'UNIT': name, 'UPDATE': delta, 'VERSION': current.version}).encode()
+
+            with self.lock:
+                self.__expire(time.time())
+                targets = [s for s in self.subscribers.values() if s.units is None or name in s.units]
+
+            for subscription in targets:
+                try:
+                    subscription.sock.sendto(payload, subscription.address)
+                    self.metric_pushes.inc()
+                except OSError as e:
+                    self.logger.info('Unable to push status to %s: %r', subscription.address, e)
+
+
+    def shutdown(self):
+        for status, observer in self.observers:
+            status.unsubscribe(observer)
+        self.queue.put(None)
@@ -0,0 +1,218 @@
+"""
+Compact binary UDP protocol, an alternative to JSON for small clients
+
+A datagram starting with MAGIC is binary, anything else is JSON, so
+clients choose an encoding per request and are answered in the same one.
+
+Request:  MAGIC, opcode, request ID (uint16), unit, then for SET the
+          settings as power, mode, fan codes and temperature
+Response: MAGIC, opcode | REPLY, request ID, result, record count, then
+          one STATUS record per unit
+
+Units are numbered in the order they are configured, UNIT_DEFAULT is the
+first and UNIT_ALL every unit. Settings are sent as their index in the
+*_VALUES tables, UNCHANGED (or NO_TEMP) leaves a setting as it is.
+"""
+
+import struct
+import time
+
+MAGIC = 0xAC #Not a byte JSON can start with
+
+OP_GET = 0x01
+OP_SET = 0x02
+REPLY = 0x80
+
+UNIT_DEFAULT = 0xFF
+UNIT_ALL = 0xFE
+
+RESULT_OK = 0
+RESULT_FAIL = 1
+RESULT_BUSY = 2
+
+HEADER = struct.Struct('<BBHB') #magic, opcode, request ID, unit
+SETTINGS = struct.Struct('<BBBb') #power, mode, fan, temperature
+REPLY_HEADER = struct.Struct('<BBHBB') #magic, opcode, request ID, result, record count
+#unit, connection, unconfirmed flags, power, mode, fan, temperature, room temperature, age in seconds
+STATUS = struct.Struct('<BBBBBBbbH')
+
+UNCHANGED = 0xFF
+NO_TEMP = -128
+MAX_AGE = 0xFFFF
+
+#Values as they appear in translated status, new values must be appended
+POWER_VALUES = ('Off', 'On')
+MODE_VALUES = ('Auto', 'Cool', 'Dry', 'Fan', 'Heat')
+FAN_VALUES = ('Auto', 'Low', 'Mid', 'High', 'Turbo')
+CONNECTION_VALUES = ('ONLINE', 'CACHED', 'OFFLINE')
+
+#Bit set in the unconfirmed flags for each setting not yet confirmed by the A/C
+UNCONFIRMED_FLAGS = {'POWER': 0x01, 'MODE': 0x02, 'FAN': 0x04, 'TEMP': 0x08}
+
+def _codes(values):
+    """Code of each value, as written in status and in upper case as in requests"""
+    codes = {value.upper(): code for code, value in enumerate(values)}
+    codes.update((value, code) for code, value in enumerate(values))
+    return codes
+
+POWER_CODES = _codes(POWER_VALUES)
+MODE_CODES = _codes(MODE_VALUES)
+FAN_CODES = _codes(FAN_VALUES)
+CONNECTION_CODES = _codes(CONNECTION_VALUES)
+
+#Settings in the order they follow the header of a SET request
+SETTING_VALUES = (('POWER', POWER_VALUES, POWER_CODES),
+                  ('MODE', MODE_VALUES, MODE_CODES),
+                  ('FAN', FAN_VALUES, FAN_CODES))
+
+
+class CodecError(ValueError):
+    """Datagram is not a valid binary request"""
+
+
+
+def is_binary(data):
+    return data[:1] == bytes((MAGIC,))
+
+
+def decode_request(data):
+
+    """
+    Decode a binary request
+
+    Returns:
+    (opcode, request ID, unit, settings), settings being a dict of
+    POWER/MODE/FAN/TEMP to value as a JSON SET would give them
+
+    Raises:
+    CodecError if the datagram is short, unknown or has bad settings
+    """
+
+    if len(data) < HEADER.size:
+        raise CodecError('Short request')
+
+    _, opcode, request_id, unit = HEADER.unpack_from(data)
+    settings = {}
+
+    if opcode == OP_SET:
+
+        if len(data) < HEADER.size + SETTINGS.size:
+            raise CodecError('Short SET request')
+
+        codes = SETTINGS.unpack_from(data, HEADER.size)
+
+        for (name, values, _), code in zip(SETTING_VALUES, codes):
+            if code == UNCHANGED:
+                continue
+            if code >= len(values):
+                raise CodecError('Unknown %s %d' % (name, code))
+            #Upper case, as every JSON request is
+            settings[name] = values[code].upper()
+
+        if codes[3] != NO_TEMP:
+            settings['TEMP'] = str(codes[3])
+
+    elif opcode != OP_GET:
+        raise CodecError('Unknown opcode %d' % opcode)
+
+    return opcode, request_id, unit, settings
+
+
+def encode_request(opcode, request_id=0, unit=UNIT_DEFAULT, settings=None):
+
+    """Binary request, settings as POWER/MODE/FAN/TEMP to value, for clients and tests"""
+
+    data = HEADER.pack(MAGIC, opcode, request_id, unit)
+
+    if opcode == OP_SET:
+        settings = settings or {}
+        codes = [_code(value_codes, settings.get(name)) for name, _, value_codes in SETTING_VALUES]
+        temp = settings.get('TEMP')
+        data += SETTINGS.pack(*codes, int(temp) if temp is not None else NO_TEMP)
+
+    return data
+
+
+def _code(codes, value):
+    code = codes.get(value)
+    if code is None and isinstance(value, str):
+        code = codes.get(value.upper())
+    return UNCHANGED if code is None else code
+
+
+def _temp(value):
+    try:
+        return max(-127, min(127, int(value)))
+    except (TypeError, ValueError):
+        return NO_TEMP
+
+
+def encode_status(unit, status, now=None):
+
+    """STATUS record for a unit's translated status, as get_all_settings returns it"""
+
+    now = now or time.time()
+    unconfirmed = 0
+
+    for name in status.get('UNCONFIRMED', ()):
+        unconfirmed |= UNCONFIRMED_FLAGS.get(name, 0)
+
+    return STATUS.pack(unit,
+                       _code(CONNECTION_CODES, status.get('AC_CONNECTION_STATUS')),
+                       unconfirmed,
+                       _code(POWER_CODES, status.get('POWER')),
+                       _code(MODE_CODES, status.get('MODE')),
+                       _code(FAN_CODES, status.get('FAN')),
+                       _temp(status.get('TEMP')),
+                       _temp(status.get('CURRENT_TEMP')),
+                       int(min(max(now - (status.get('LAST_UPDATE') or 0), 0), MAX_AGE)))
+
+
+def encode_response(opcode, request_id, result, records=()):
+
+    """Response header and the STATUS records already encoded"""
+
+    return REPLY_HEADER.pack(MAGIC, opcode | REPLY, request_id, result, len(records)) + b''.join(records)
+
+
+def error_response(data, result):
+
+    """FAIL or BUSY response to a binary request, without decoding more than its header"""
+
+    opcode, request_id = (HEADER.unpack_from(data)[1:3] if len(data) >= HEADER.size else (0, 0))
+    return encode_response(opcode, request_id, result)
+
+
+def _value(values, code):
+    return values[code] if code < len(values) else None
+
+
+def decode_response(data):
+
+    """
+    Decode a binary response, for clients and tests
+
+    Returns:
+    (opcode, request ID, result, list of status dicts with a UNIT index)
+    """
+
+    _, opcode, request_id, result, count = REPLY_HEADER.unpack_from(data)
+    records = []
+
+    for index in range(count):
+
+        (unit, connection, unconfirmed, power, mode, fan, temp, current_temp,
+         age) = STATUS.unpack_from(data, REPLY_HEADER.size + index * STATUS.size)
+
+        records.append({'UNIT': unit,
+                        'AC_CONNECTION_STATUS': _value(CONNECTION_VALUES, connection),
+                        'POWER': _value(POWER_VALUES, power),
+                        'MODE': _value(MODE_VALUES, mode),
+                        'FAN': _value(FAN_VALUES, fan),
+                        'TEMP': None if temp == NO_TEMP else temp,
+                        'CURRENT_TEMP': None if current_temp == NO_TEMP else current_temp,
+                        'AGE': age,
+                        'UNCONFIRMED': [name for name, flag in UNCONFIRMED_FLAGS.items()
+                                        if unconfirmed & flag]})
+
+    return opcode & ~REPLY, request_id, result, records
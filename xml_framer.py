@@ -0,0 +1,139 @@
+"""Split the byte stream received from A/C into complete XML documents"""
+
+import re
+
+XML_DECLARATION = b'<?xml'
+WHITESPACE = b' \t\r\n\x00'
+ROOT_ELEMENT = re.compile(rb'<([A-Za-z_][\w:.-]*)')
+
+MAX_DOCUMENT_SIZE = 65536 #bytes
+
+
+class XMLFramer(object):
+
+    """
+    Accumulate received bytes and emit complete XML documents
+
+    Documents are delimited by line endings or by the XML declaration of
+    the next document. A document is only emitted once its root element
+    is closed, so a response split across several reads is held until
+    the rest of it arrives, and responses coalesced into one read are
+    emitted separately
+    """
+
+    def __init__(self, max_size=MAX_DOCUMENT_SIZE):
+        self.buffer = bytearray()
+        self.search_from = 0 #Offset already searched for a delimiter
+        self.max_size = max_size
+        self.discarded = 0 #Count of incomplete fragments thrown away
+
+
+    def reset(self):
+        """Discard any partial document, e.g. after reconnecting"""
+        del self.buffer[:]
+        self.search_from = 0
+
+
+    def __complete(self, start, end):
+
+        """
+        Check whether buffer[start:end] holds a complete document
+
+        Returns True or False, or None if no XML root element was found
+        """
+
+        buf = self.buffer
+
+        while end > start and buf[end - 1] in WHITESPACE:
+            end -= 1
+
+        body = start
+
+        if buf.startswith(XML_DECLARATION, start):
+            declaration_end = buf.find(b'?>', start, end)
+            if declaration_end == -1:
+                return False
+            body = declaration_end + 2
+
+        root = ROOT_ELEMENT.search(buf, body, end)
+
+        if root is None:
+            return None
+
+        tag_end = buf.find(b'>', root.end(), end)
+
+        if tag_end == -1:
+            return False
+
+        #Self closing root element, e.g. <Request Type="DeviceState" />
+        if tag_end == end - 1 and buf[tag_end - 1] == ord('/'):
+            return True
+
+        return buf.endswith(b'</' + root.group(1) + b'>', start, end)
+
+
+    def feed(self, data):
+
+        """
+        Add received bytes to the buffer
+
+        Args:
+        bytes-like object received from A/C
+
+        Returns:
+        List of complete documents as bytes, may be empty
+        """
+
+        buf = self.buffer
+        buf += data
+
+        documents = []
+        start, search, end_of_data = 0, self.search_from, len(buf)
+
+        while start < end_of_data:
+
+            #Skip line endings between documents
+            if buf[start] in WHITESPACE:
+                start += 1
+                continue
+
+            search = max(search, start)
+            newline = buf.find(b'\n', search)
+            header = buf.find(XML_DECLARATION, max(search, start + 1))
+
+            if newline == -1 or (header != -1 and header < newline):
+                boundary = header
+            else:
+                boundary = newline
+
+            if boundary == -1:
+                #No delimiter yet, emit only if the root element is already closed
+                if self.__complete(start, end_of_data):
+                    documents.append(bytes(buf[start:end_of_data]).rstrip())
+                    start = end_of_data
+                else:
+                    #Partial declaration may straddle the next read
+                    search = max(start, end_of_data - len(XML_DECLARATION))
+                break
+
+            complete = self.__complete(start, boundary)
+
+            if complete or (complete is None and boundary == newline):
+                documents.append(bytes(buf[start:boundary]).rstrip())
+                start = search = boundary
+            elif boundary == header:
+                #Next document started before this one was closed
+                self.discarded += 1
+                start = search = boundary
+            else:
+                #Line ending inside a document, keep looking
+                search = boundary + 1
+
+        if end_of_data - start > self.max_size:
+            self.discarded += 1
+            start = search = end_of_data
+
+        del buf[:start]
+        self.search_from = max(0, search - start)
+
+        return documents